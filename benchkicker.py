@@ -0,0 +1,253 @@
+#
+#  SwitchBot Kicker benchmarks
+#       Peak allocation and timing of main.py under CPython (tracemalloc), on the shims of simkicker.py
+#
+#  python benchkicker.py --schedules 10,100,500 --scenes 10,100,500,2000
+#
+import sys
+import os
+import gc
+import time
+import json
+import random
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+
+import simkicker
+
+
+def Measure(f, *args):
+    # (result, peak bytes above the starting heap, ms)
+    gc.collect()
+    base = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    t = time.perf_counter()
+    r = f(*args)
+    ms = (time.perf_counter() - t)*1000
+    return r, tracemalloc.get_traced_memory()[1] - base, ms
+
+async def MeasureAsync(f, *args, collect=True):
+    if collect:
+        gc.collect()
+    base = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    t = time.perf_counter()
+    r = await f(*args)
+    ms = (time.perf_counter() - t)*1000
+    return r, tracemalloc.get_traced_memory()[1] - base, ms
+
+def Schedules(main, n, scenes=20):
+    rng = random.Random(n)
+    patterns = ((0,1,2,3,4,5,6), (0,1,2,3,4), (5,6), (0,2,4), (0,1,2,3,4,7))
+    return [(f'sched{i}', rng.choice(patterns), -1 if i % 10 == 9 else rng.randrange(24), rng.randrange(60),
+             rng.randrange(60), 0, 0, 0, f'scene{i % scenes}', True, rng.choice((0, rng.randrange(-999, 1000))))
+            for i in range(n)]
+
+def Fill(main, n):
+    main.SCENEDIC.clear()
+    for k in range(20):
+        main.SCENEDIC[f'scene{k}'] = f'id{k}'
+    main.InvalidateFragment('scene')
+    main.DataBase[:] = Schedules(main, n)
+    for k in range(main.USER.LOG_LINES):
+        main.log('Bench log line %d', False, (k,))
+
+
+class FormRequest:
+    # All the page handlers read from a Microdot request
+    def __init__(self, form):
+        self.form = form
+
+async def Render(handler, form):
+    # (first chunk ms, total ms, bytes) of a page written to a null stream, as Microdot would
+    t = time.perf_counter()
+    body = (await handler(FormRequest(form)))[0]
+    first = None
+    size = 0
+    for chunk in body:
+        if first is None:
+            first = (time.perf_counter() - t)*1000
+        size += len(chunk.encode() if isinstance(chunk, str) else chunk)
+    return first, (time.perf_counter() - t)*1000, size
+
+async def BenchPages(main, counts):
+    # [user-009] Index and edit pages streamed from generators. The handlers are taken
+    # from the Microdot app web_server() builds, which is not started.
+    import microdot
+    apps = []
+    run = microdot.Microdot.run
+    async def capture(self, *args, **kw):
+        apps.append(self)
+    microdot.Microdot.run = capture
+    await main.web()
+    microdot.Microdot.run = run
+    handlers = {(m, p.url_pattern): f for methods, p, f, _, _ in apps[0].url_map for m in methods}
+    rows = []
+    for n in counts:
+        Fill(main, n)
+        for page, key, form in (('index', ('GET', '/'), {}), ('edit', ('POST', '/edit'), {'id': '0', 'action': 'change'})):
+            # gc.collect() empties CPython's tuple free lists, which the rows then refill;
+            # a warm-up render right before keeps that out of the peak
+            gc.collect()
+            await Render(handlers[key], form)
+            (first, total, size), peak, ms = await MeasureAsync(Render, handlers[key], form, collect=False)
+            rows.append({'page': page, 'schedules': n, 'bytes': size, 'peak_kb': round(peak/1024, 1),
+                         'first_byte_ms': round(first, 2), 'total_ms': round(total, 2)})
+    return rows
+
+def BenchStore(main, counts, repeat=20):
+    # [user-008] JSON-lines snapshot and journal, and eval() of the former format for reference
+    rows = []
+    for n in counts:
+        db = Schedules(main, n)
+        main.DataBase[:] = db
+        _, save_peak, save = Measure(lambda: [main.StoreSave(main.CnfFileName, main.DataBase) for k in range(repeat)])
+        t = time.perf_counter()
+        for k in range(repeat):
+            main.StoreJournal(main.CnfFileName, [['put', k % n, main.DataBase[k % n]]])
+        edit = (time.perf_counter() - t)*1000/repeat
+        main.StoreSave(main.CnfFileName, main.DataBase)
+        _, load_peak, load = Measure(lambda: [main.SetupDataBase() for k in range(repeat)])
+        assert len(main.DataBase) == n
+        with open('legacy.cnf', 'w') as file:
+            file.write(repr(db))
+        def LoadEval():
+            with open('legacy.cnf') as file:
+                return eval(file.read())
+        _, eval_peak, evalms = Measure(lambda: [LoadEval() for k in range(repeat)])
+        rows.append({'schedules': n, 'bytes': os.stat(main.CnfFileName)[6],
+                     'save_ms': round(save/repeat, 2), 'edit_ms': round(edit, 3),
+                     'load_ms': round(load/repeat, 2), 'load_peak_kb': round(load_peak/1024, 1),
+                     'eval_ms': round(evalms/repeat, 2), 'eval_peak_kb': round(eval_peak/1024, 1)})
+    return rows
+
+
+def ScenesBody(n):
+    body = [{'sceneId': f'{i:08x}-aaaa-bbbb-cccc-{i:012x}', 'sceneName': f'Scene "{i}"' if i % 3 else f'照明 {i}'}
+            for i in range(n)]
+    return json.dumps({'statusCode': 100, 'body': body, 'message': 'success'}).encode()
+
+async def BenchScenes(main, counts):
+    # [user-016] /v1.0/scenes from simkicker's FakeSwitchBot over local HTTP: APIClient.Stream()
+    # through SceneStream() against Request() and json.loads() of the whole body into a dict
+    # CPython's transports recv() into a fresh 256 KB buffer and stream readers read ahead up to
+    # 128 KB, which would be most of the peak; MicroPython reads the socket as the caller asks
+    transport = asyncio.selector_events._SelectorSocketTransport
+    max_size = transport.max_size
+    transport.max_size = 2048
+    open_connection = main.uasyncio.open_connection
+    main.uasyncio.open_connection = lambda *a, **kw: asyncio.open_connection(*a, limit=2048, **kw)
+    args = argparse.Namespace(seed=1, latency=0, jitter=0, fail=0, drop=0, stall=0, stall_seconds=0, server_quota=0)
+    fake = simkicker.FakeSwitchBot(args, main.LocalMs, main.NowMs)
+    server = await asyncio.start_server(fake.handle, '127.0.0.1', 0)
+    api = main.APIClient('127.0.0.1', {}, port=server.sockets[0].getsockname()[1], ssl=False, poolsize=1)
+    rows = []
+    for n in counts:
+        fake.catalog = ScenesBody(n)
+
+        async def Stream():
+            k = 0
+            status, body = await api.Stream('GET', '/v1.0/scenes')
+            async for name, sceneId in main.SceneStream(body):
+                k += 1
+            await body.close()
+            return k
+
+        async def Whole():
+            status, data = await api.Request('GET', '/v1.0/scenes')
+            return len({S['sceneName']: S['sceneId'] for S in json.loads(data)['body']})
+        # Warm connection for both, so neither pays the connect
+        await Whole()
+        streamed, stream_peak, stream = await MeasureAsync(Stream)
+        whole, whole_peak, wholems = await MeasureAsync(Whole)
+        assert streamed == whole == n
+        rows.append({'scenes': n, 'bytes': len(fake.catalog),
+                     'stream_peak_kb': round(stream_peak/1024, 1), 'stream_ms': round(stream, 2),
+                     'loads_peak_kb': round(whole_peak/1024, 1), 'loads_ms': round(wholems, 2)})
+    for conn in api.idle:
+        await api._close(conn)
+    server.close()
+    main.uasyncio.open_connection = open_connection
+    transport.max_size = max_size
+    return rows
+
+def BenchTable(main, counts):
+    # [user-019] ScheduleTable columns against a list of tuples
+    rows = []
+    for n in counts:
+        db = Schedules(main, n)
+        main.DataBase.clear()
+        gc.collect()
+        base = tracemalloc.get_traced_memory()[0]
+        tuples = [tuple(S) for S in json.loads(json.dumps(db))]
+        tuple_kb = (tracemalloc.get_traced_memory()[0] - base)/1024
+        del tuples
+        gc.collect()
+        base = tracemalloc.get_traced_memory()[0]
+        main.DataBase[:] = json.loads(json.dumps(db))
+        gc.collect()
+        table_kb = (tracemalloc.get_traced_memory()[0] - base)/1024
+        now = main.LocalMs()
+        _, _, rebuild = Measure(lambda: [main.RebuildFireIndex(now + k*3600000) for k in range(10)])
+        t = time.perf_counter()
+        for i in range(n):
+            main.NextFireMs(i, now)
+        nextfire = (time.perf_counter() - t)*1e6/n
+        rows.append({'schedules': n, 'tuples_kb': round(tuple_kb, 1), 'table_kb': round(table_kb, 1),
+                     'rebuild_ms': round(rebuild/10, 2), 'next_fire_us': round(nextfire, 1)})
+    return rows
+
+
+def PrintRows(title, rows):
+    print(title)
+    if not rows:
+        return
+    keys = list(rows[0])
+    print('  ' + '  '.join(f'{k:>14}' for k in keys))
+    for r in rows:
+        print('  ' + '  '.join(f'{r[k]:>14}' for k in keys))
+
+async def Bench(main, args):
+    report = {}
+    if 'pages' in args.only:
+        report['pages'] = await BenchPages(main, args.schedules)
+    if 'store' in args.only:
+        report['store'] = BenchStore(main, args.schedules)
+    if 'scenes' in args.only:
+        report['scenes'] = await BenchScenes(main, args.scenes)
+    if 'table' in args.only:
+        report['table'] = BenchTable(main, args.schedules)
+    return report
+
+def Main():
+    p = argparse.ArgumentParser(description='Measure peak allocation and timing of main.py under CPython.')
+    ints = lambda v: [int(x) for x in v.split(',')]
+    p.add_argument('--schedules', type=ints, default=[10, 100, 500], help='schedule counts, comma separated')
+    p.add_argument('--scenes', type=ints, default=[10, 100, 500, 2000], help='scene list sizes, comma separated')
+    p.add_argument('--only', default='pages,store,scenes,table', help='benchmarks to run, comma separated')
+    p.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = p.parse_args()
+
+    simkicker.CLOCK = simkicker.WallClock(time.time())
+    simkicker.InstallShims()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import usersettings
+    usersettings.LOG_FLASH = False
+    os.chdir(tempfile.mkdtemp(prefix='benchkicker'))
+    import main
+    main.loginit()
+    main.print = lambda *a, **k: None
+    tracemalloc.start()
+    report = asyncio.run(Bench(main, args))
+    if args.json:
+        print(json.dumps(report))
+        return
+    titles = {'pages': 'pages (rendered to a null stream)', 'store': 'config store (ms per call)',
+              'scenes': 'scene list over HTTP', 'table': 'schedule table'}
+    for k, rows in report.items():
+        PrintRows(titles[k], rows)
+
+if __name__ == '__main__':
+    Main()
@@ -9,11 +9,16 @@ import ubinascii
 import uasyncio
 import utime
 import gc
-import aiohttp
+import os
 import ujson
 import select
+import heapq
+import hashlib
+import random
+from array import array
 from collections import OrderedDict
-from microdot import Microdot
+from microdot import Microdot, Request
+import machine
 from machine import Pin
 
 import usersettings as USER
@@ -27,32 +32,262 @@ def ledoff():
     LED.low()
 
 
+# Software clock: UTC milliseconds from ticks_ms, corrected by the drift estimated from NTP
+ClockBaseMs = utime.time()*1000
+ClockBaseTicks = utime.ticks_ms()
+ClockDrift = 0.0
+
+BootMs = ClockBaseMs
+
+def NowMs():
+    global ClockBaseMs, ClockBaseTicks
+    t = utime.ticks_ms()
+    el = utime.ticks_diff(t, ClockBaseTicks)
+    now = ClockBaseMs + el - int(el*ClockDrift)
+    if el > 0x10000000:
+        # Rebase well before ticks_diff() wraps
+        ClockBaseMs = now
+        ClockBaseTicks = t
+    return now
+
+def SetClockMs(ms):
+    global ClockBaseMs, ClockBaseTicks, BootMs
+    BootMs += ms - NowMs()
+    ClockBaseTicks = utime.ticks_ms()
+    ClockBaseMs = ms
+    SetRTC(utime.localtime(ms//1000))
+
 def OffsetUTCtime():
-    utc_time = utime.localtime()
-    ret = utime.mktime(utc_time) + USER.UTC_OFFSET
+    ret = NowMs()//1000 + USER.UTC_OFFSET
     return ret if ret>=0 else 0
 
+def LocalMs():
+    return NowMs() + USER.UTC_OFFSET*1000
+
 def DatetimeString(nowtime):
     lt = utime.localtime(nowtime)
     wdnames = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
     return f'{lt[0]:04d}/{lt[1]:02d}/{lt[2]:02d} {wdnames[lt[6]]:s} {lt[3]:02d}:{lt[4]:02d}:{lt[5]:02d}'
 
-logqueue = []
-def loginit():
-    for i in range(16):
-        logqueue.append('')
+# Log ring buffer of preallocated [TIME, LEVEL, MESSAGE, ARGS] records.
+# MESSAGE is a %-format string; text is only produced when the log is rendered.
+LOG_INFO = 0
+LOG_WARN = 1
+LOG_ERROR = 2
+LOG_ACTIVE = 'Worker Active'
+LogRing = []
+LogHead = 0
+LogCount = 0
+LogFlushed = 0
+LogFlushedAt = 0
+LogErrorPending = False
+LogFileSize = -1
+LogFileName = 'SwBotKicker.log'
 
-def log(s,d=True):
-    global logqueue
-    if len(logqueue)>=16:
-        logqueue.pop(0)
-    logqueue.append(f'{DatetimeString(OffsetUTCtime())} | {s}')
-    if d: print(s)
+def loginit():
+    LogRing[:] = [[0, LOG_INFO, '', None] for i in range(USER.LOG_LINES)]
+
+def LogText(rec):
+    return rec[2] % rec[3] if rec[3] else rec[2]
+
+def LogLine(rec):
+    mark = ('', 'W: ', 'E: ')[rec[1]]
+    return f'{DatetimeString(rec[0])} | {mark}{LogText(rec)}'
+
+def LogLines():
+    # Oldest to newest
+    n = len(LogRing)
+    for i in range(max(0, LogCount-n), LogCount):
+        yield LogLine(LogRing[i%n])
+
+def log(s, d=True, args=None, level=LOG_INFO):
+    global LogHead, LogCount, LogErrorPending
+    rec = LogRing[LogHead]
+    rec[0] = OffsetUTCtime()
+    rec[1] = level
+    rec[2] = s
+    rec[3] = args
+    LogHead = (LogHead+1)%len(LogRing)
+    LogCount += 1
+    if d: print(LogText(rec))
+    if level == LOG_ERROR:
+        # Written out soon, so it survives a WDT reset that may follow
+        LogErrorPending = True
+        LogFlush()
+
+def LogRepr(v):
+    # Exceptions and response bodies would stay referenced by the ring until it wraps
+    return repr(v)[:80]
 
 def logActive():
-    if '| Worker Active' in logqueue[-1]:
-        logqueue.pop()
-    log('Worker Active', False)
+    last = LogRing[LogHead-1]
+    if LogCount and last[2] is LOG_ACTIVE:
+        last[0] = OffsetUTCtime()
+    else:
+        log(LOG_ACTIVE, False)
+
+def LogFlush():
+    # Append pending records to the flash log in batches, rotating segments
+    global LogFlushed, LogFlushedAt, LogFileSize, LogErrorPending
+    if not USER.LOG_FLASH or LogFlushed==LogCount:
+        return
+    now = utime.ticks_ms()
+    age = utime.ticks_diff(now, LogFlushedAt)
+    due = USER.LOG_FLASH_ERROR_SECONDS if LogErrorPending else USER.LOG_FLASH_SECONDS
+    if LogCount-LogFlushed < USER.LOG_FLASH_BATCH and age < due*1000:
+        return
+    LogErrorPending = False
+    n = len(LogRing)
+    if LogCount-LogFlushed > n:
+        LogFlushed = LogCount-n
+    if LogFileSize < 0:
+        try:
+            LogFileSize = os.stat(LogFileName)[6]
+        except OSError:
+            LogFileSize = 0
+    with open(LogFileName, 'a', encoding='utf-8') as file:
+        for i in range(LogFlushed, LogCount):
+            rec = LogRing[i%n]
+            if rec[2] is not LOG_ACTIVE:
+                line = LogLine(rec)
+                file.write(line)
+                file.write('\n')
+                LogFileSize += len(line)+1
+    LogFlushed = LogCount
+    LogFlushedAt = now
+    if LogFileSize >= USER.LOG_FLASH_SEGMENT:
+        for i in range(USER.LOG_FLASH_SEGMENTS-1, 0, -1):
+            RemoveFile(f'{LogFileName}.{i}')
+            try:
+                os.rename(f'{LogFileName}.{i-1}' if i>1 else LogFileName, f'{LogFileName}.{i}')
+            except OSError:
+                pass
+        LogFileSize = 0
+
+
+# Runtime metrics in fixed-size arrays, so recording never allocates
+METRIC_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+HIST_KICK_DISPATCH = 0
+HIST_KICK_API = 1
+HIST_KICK_TOTAL = 2
+HIST_LOOP_LAG = 3
+HIST_NAMES = ('kick_dispatch_ms', 'kick_api_ms', 'kick_total_ms', 'worker_lag_ms')
+HistCounts = array('i', [0]*(len(HIST_NAMES)*(len(METRIC_BUCKETS)+1)))
+HistSums = array('i', [0]*len(HIST_NAMES))
+# ExecuteScene() results: these HTTP codes, then other codes, then connection errors
+HTTP_CODES = (200, 401, 403, 404, 429, 500, 503)
+StatusCounts = array('i', [0]*(len(HTTP_CODES)+2))
+# Lowest gc.mem_free() and highest gc.mem_alloc() seen by the worker
+MemMarks = array('i', [0x3FFFFFFF, 0])
+BootCause = 'unknown'
+# (phase, ms since main.py started); time-to-ready after a reset
+BootTicks = utime.ticks_ms()
+BootPhases = []
+
+def BootPhase(name):
+    ms = utime.ticks_diff(utime.ticks_ms(), BootTicks)
+    BootPhases.append((name, ms))
+    log('Boot phase %s at %dms.', args=(name, ms))
+
+def Observe(h, ms):
+    b = 0
+    while b < len(METRIC_BUCKETS) and ms > METRIC_BUCKETS[b]:
+        b += 1
+    HistCounts[h*(len(METRIC_BUCKETS)+1)+b] += 1
+    HistSums[h] += ms
+
+def CountStatus(status):
+    # status None for a failed connection
+    i = len(HTTP_CODES)+1
+    if status is not None:
+        i = HTTP_CODES.index(status) if status in HTTP_CODES else len(HTTP_CODES)
+    StatusCounts[i] += 1
+
+def SampleMemory():
+    f = gc.mem_free()
+    a = gc.mem_alloc()
+    if f < MemMarks[0]:
+        MemMarks[0] = f
+    if a > MemMarks[1]:
+        MemMarks[1] = a
+
+def QuotaDict(q):
+    return {'limit': q.limit, 'remaining': q.Remaining(), 'reserve': q.reserve,
+            'denied': {'scheduled': q.denied[QUOTA_SCHEDULED], 'retry': q.denied[QUOTA_RETRY], 'manual': q.denied[QUOTA_MANUAL]}}
+
+def MetricsDict():
+    nb = len(METRIC_BUCKETS)+1
+    d = {
+        'uptime_s': (NowMs()-BootMs)//1000,
+        'boot_cause': BootCause,
+        'boot_phases_ms': dict(BootPhases),
+        'clock_source': ClockSource,
+        'clock_bound_ms': ClockBound(),
+        'mem_free_low': MemMarks[0],
+        'mem_alloc_high': MemMarks[1],
+        'ntp_offset_ms': NTPOffset,
+        'ntp_delay_ms': NTPDelay,
+        'clock_drift_ppm': ClockDrift*1e6,
+        'api_status': dict(zip([str(c) for c in HTTP_CODES]+['other', 'error'], StatusCounts)),
+        'api_connections': {a.name or 'default': a.api.Stats() for a in Accounts.values()},
+        'retries': {'scheduled': RetryCounts[RETRY_SCHEDULED], 'succeeded': RetryCounts[RETRY_SUCCEEDED], 'gave_up': RetryCounts[RETRY_GAVEUP]},
+        'quota': {a.name or 'default': QuotaDict(a.quota) for a in Accounts.values()},
+        'leader': int(Leader),
+        'peers': list(Peers),
+        'catchup': {'fired': CatchupCounts[CATCHUP_FIRED], 'missed': CatchupCounts[CATCHUP_MISSED], 'superseded': CatchupCounts[CATCHUP_SUPERSEDED]},
+        'buckets_ms': METRIC_BUCKETS,
+    }
+    for h in range(len(HIST_NAMES)):
+        d[HIST_NAMES[h]] = {'counts': list(HistCounts[h*nb:(h+1)*nb]), 'sum': HistSums[h]}
+    return d
+
+def MetricsText():
+    # Prometheus text exposition, one chunk per line
+    nb = len(METRIC_BUCKETS)+1
+    yield f'kicker_uptime_seconds {(NowMs()-BootMs)//1000}\n'
+    yield f'kicker_boot_info{{cause="{BootCause}"}} 1\n'
+    for name, ms in BootPhases:
+        yield f'kicker_boot_phase_ms{{phase="{name}"}} {ms}\n'
+    yield f'kicker_clock_info{{source="{ClockSource}"}} 1\n'
+    yield f'kicker_clock_bound_ms {ClockBound()}\n'
+    yield f'kicker_mem_free_low_bytes {MemMarks[0]}\n'
+    yield f'kicker_mem_alloc_high_bytes {MemMarks[1]}\n'
+    yield f'kicker_ntp_offset_ms {NTPOffset}\n'
+    yield f'kicker_ntp_delay_ms {NTPDelay}\n'
+    yield f'kicker_clock_drift_ppm {ClockDrift*1e6}\n'
+    for i in range(len(HTTP_CODES)):
+        yield f'kicker_api_responses_total{{code="{HTTP_CODES[i]}"}} {StatusCounts[i]}\n'
+    yield f'kicker_api_responses_total{{code="other"}} {StatusCounts[-2]}\n'
+    yield f'kicker_api_responses_total{{code="error"}} {StatusCounts[-1]}\n'
+    for a in Accounts.values():
+        st = a.api.Stats()
+        for k in ('opened', 'reused', 'stale'):
+            yield f'kicker_api_connections_total{{account="{a.name}",kind="{k}"}} {st[k]}\n'
+    yield f'kicker_retries_total{{result="scheduled"}} {RetryCounts[RETRY_SCHEDULED]}\n'
+    yield f'kicker_retries_total{{result="succeeded"}} {RetryCounts[RETRY_SUCCEEDED]}\n'
+    yield f'kicker_retries_total{{result="gave_up"}} {RetryCounts[RETRY_GAVEUP]}\n'
+    for a in Accounts.values():
+        q = a.quota
+        yield f'kicker_api_quota_limit{{account="{a.name}"}} {q.limit}\n'
+        yield f'kicker_api_quota_remaining{{account="{a.name}"}} {q.Remaining()}\n'
+        yield f'kicker_api_quota_denied_total{{account="{a.name}",class="scheduled"}} {q.denied[QUOTA_SCHEDULED]}\n'
+        yield f'kicker_api_quota_denied_total{{account="{a.name}",class="retry"}} {q.denied[QUOTA_RETRY]}\n'
+        yield f'kicker_api_quota_denied_total{{account="{a.name}",class="manual"}} {q.denied[QUOTA_MANUAL]}\n'
+    yield f'kicker_leader {int(Leader)}\n'
+    yield f'kicker_peers {len(Peers)}\n'
+    yield f'kicker_catchup_total{{result="fired"}} {CatchupCounts[CATCHUP_FIRED]}\n'
+    yield f'kicker_catchup_total{{result="missed"}} {CatchupCounts[CATCHUP_MISSED]}\n'
+    yield f'kicker_catchup_total{{result="superseded"}} {CatchupCounts[CATCHUP_SUPERSEDED]}\n'
+    for h in range(len(HIST_NAMES)):
+        name = HIST_NAMES[h]
+        yield f'# TYPE kicker_{name} histogram\n'
+        c = 0
+        for b in range(nb):
+            c += HistCounts[h*nb+b]
+            le = METRIC_BUCKETS[b] if b < nb-1 else '+Inf'
+            yield f'kicker_{name}_bucket{{le="{le}"}} {c}\n'
+        yield f'kicker_{name}_sum {HistSums[h]}\n'
+        yield f'kicker_{name}_count {c}\n'
 
 
 def DispMACAddress():
@@ -61,162 +296,1257 @@ def DispMACAddress():
     mac = ubinascii.hexlify(wlan.config('mac'), ':').decode()
     log(f'MAC address = {mac}')
 
-def ConnectNetwork():
+def StartNetwork():
+    # Returns at once; the WiFi join goes on in the background
     network.hostname(USER.HOSTNAME)
     wlan = network.WLAN(network.STA_IF)
     wlan.active(True)
     wlan.connect(USER.NET_SSID, USER.NET_PASS)
-
     log('Connecting...')
-    while not wlan.isconnected():
-        utime.sleep(1)
-        print('Connecting...')
 
-    log(f'WiFi Connected. IP address: {wlan.ifconfig()[0]}')
+NetworkReady = False
 
+async def WaitNetwork():
+    global NetworkReady
+    wlan = network.WLAN(network.STA_IF)
+    while not wlan.isconnected():
+        await uasyncio.sleep_ms(100)
+    NetworkReady = True
+    WakeEvent.set()
+    log(f'WiFi Connected. IP address: {wlan.ifconfig()[0]}')
 
-def ResetRTC():
-    SetRTC(utime.localtime(0))
 
 def SetRTC(rtct):
     machine.RTC().datetime((rtct[0], rtct[1], rtct[2], rtct[6], rtct[3], rtct[4], rtct[5], 0))
 
-def TimeFromNTP():
-    NTP_DELTA = 2208988800
-    NTP_QUERY = bytearray(48)
-    NTP_QUERY[0] = 0x1B
-    addr = socket.getaddrinfo(USER.NTP_HOST, 123)[0][-1]
+NTP_DELTA = 2208988800
+NTPaddr = None
+NTPOffset = 0
+NTPDelay = 0
+NTPInterval = 3600
+NTPLastSync = 0
+
+# Where the clock comes from: 'none', 'saved' (last-known time, a lower bound),
+# 'rtc' (the RTC ran through the reset) or 'ntp'. Kicks fire only on a trusted clock.
+ClockSource = 'none'
+# UTC ms of the last NTP sync, also across reboots
+ClockSyncMs = 0
+ClkFileName = 'SwBotKicker.clk'
+ClockSavedAt = 0
+
+def SaveClock():
+    global ClockSavedAt
+    ClockSavedAt = NowMs()
+    WriteAtomic(ClkFileName, ([ClockSavedAt, ClockDrift, ClockSyncMs],))
+
+def RestoreClock():
+    global ClockSource, ClockDrift, ClockSyncMs
+    saved = None
+    for v in ReadJSONLines(ClkFileName):
+        saved = v
+    if saved is None:
+        SetClockMs(0)
+        return
+    t, ClockDrift, ClockSyncMs = saved
+    if NowMs() >= t:
+        ClockSource = 'rtc'
+        log('Clock kept from RTC, error bound %dms.', args=(ClockBound(),))
+    else:
+        SetClockMs(t)
+        ClockSource = 'saved'
+        log('Clock restored to last known %s.', args=(DatetimeString(t//1000 + USER.UTC_OFFSET),))
+
+def ClockBound():
+    # Worst-case clock error (ms) from RTC drift since the last NTP sync, -1 when unknown
+    if ClockSource == 'ntp':
+        return NTPDelay//2
+    if ClockSource == 'rtc':
+        return 1000 + (NowMs() - ClockSyncMs)*USER.CLOCK_DRIFT_PPM//1000000
+    return -1
+
+def ClockTrusted():
+    return ClockSource == 'ntp' or 0 <= ClockBound() <= USER.CLOCK_BOUND_MS
+
+def NTPStamp(msg, i):
+    sec, frac = struct.unpack_from('!II', msg, i)
+    return (sec-NTP_DELTA)*1000 + ((frac*1000)>>32)
+
+async def NTPSample(addr, timeout=1000):
+    # One NTP exchange: (offset ms, round-trip delay ms), or None
+    query = bytearray(48)
+    query[0] = 0x1B
+    t1 = NowMs()
+    struct.pack_into('!II', query, 40, t1//1000+NTP_DELTA, ((t1%1000)<<32)//1000)
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.settimeout(1)
-    s.sendto(NTP_QUERY, addr)
+    s.setblocking(False)
     try:
-        msg = s.recv(48)
-    except OSError:
-        log('No responce from NTP server.')
-        return 0
+        s.sendto(query, addr)
+        # Sleeps until the reply arrives, like the mDNS responder, instead of polling
+        try:
+            msg = await uasyncio.wait_for_ms(uasyncio.StreamReader(s).read(48), timeout)
+        except uasyncio.TimeoutError:
+            return None
+        t4 = NowMs()
+    except OSError as e:
+        # No route, or the server's port unreachable
+        log('NTP request failed: %s', args=(LogRepr(e),), level=LOG_WARN)
+        return None
     finally:
         s.close()
-
-    val = struct.unpack('!I', msg[40:44])[0]
-    return val - NTP_DELTA
-
-def AdjustTime():
-    ntp_time = TimeFromNTP()
-    if ntp_time != 0:
-        SetRTC(utime.localtime(ntp_time))
-        log('Adjust RTC with NTP.')
-        return OffsetUTCtime()
-    else:
-        log('Adjust RTC failure.')
+    if len(msg)<48 or msg[24:32]!=query[40:48] or msg[1]==0:
+        return None
+    t2 = NTPStamp(msg, 32)
+    t3 = NTPStamp(msg, 40)
+    return ((t2-t1)+(t3-t4))//2, (t4-t1)-(t3-t2)
+
+async def TimeFromNTP():
+    # Best (lowest delay) of USER.NTP_SAMPLES exchanges
+    global NTPaddr
+    if NTPaddr is None:
+        try:
+            NTPaddr = socket.getaddrinfo(USER.NTP_HOST, USER.NTP_PORT)[0][-1]
+        except OSError as e:
+            # DNS not answering yet; the caller retries
+            log('NTP server lookup failed: %s', args=(LogRepr(e),), level=LOG_WARN)
+            return None
+    best = None
+    for i in range(USER.NTP_SAMPLES):
+        sample = await NTPSample(NTPaddr)
+        if sample and (best is None or sample[1]<best[1]):
+            best = sample
+        await uasyncio.sleep_ms(50)
+    if best is None:
+        NTPaddr = None
+        log('No responce from NTP server.', level=LOG_WARN)
+    return best
+
+async def AdjustTime():
+    global ClockDrift, NTPOffset, NTPDelay, NTPInterval, NTPLastSync, ClockSource, ClockSyncMs
+    best = await TimeFromNTP()
+    if best is None:
+        log('Adjust RTC failure.', level=LOG_WARN)
         return 0
 
+    NTPOffset, NTPDelay = best
+    now = NowMs()
+    elapsed = now - NTPLastSync
+    if NTPLastSync and elapsed > 600000 and abs(NTPOffset) < 5000:
+        # Residual offset over the last interval is the error of the drift model
+        ClockDrift = min(max(ClockDrift - NTPOffset/elapsed, -0.001), 0.001)
+        rate = abs(NTPOffset)/elapsed
+        NTPInterval = int(min(max(USER.NTP_ERROR_MS/rate/1000 if rate else 86400, 3600), 86400))
+    SetClockMs(now+NTPOffset)
+    NTPLastSync = NowMs()
+    ClockSource = 'ntp'
+    ClockSyncMs = NTPLastSync
+    SaveClock()
+    log('Adjust RTC with NTP. offset:%dms delay:%dms drift:%.1fppm', args=(NTPOffset, NTPDelay, ClockDrift*1e6))
+    return OffsetUTCtime()
+
 def DispBootReason():
+    global BootCause
     reset_cause = machine.reset_cause()
     if reset_cause == machine.PWRON_RESET:
+        BootCause = 'power-on'
         log('Boot cause Power-ON.')
     elif reset_cause == machine.WDT_RESET:
+        BootCause = 'wdt'
         log('Reboot cause WDT reset.')
     else:
         log('Reboot cause unknown reason.')
 
 
-# (NAME,WEEKDAYS,HOUR,MINUTE,SECOND,YEAR,MONTH,DAY,SCENENAME,ACTIVE)
-DataBase=[]
-CnfFileName='SwBotKicker.cnf'
+# Config store: a JSON-lines snapshot (first line is [sequence number, StoreStamp])
+# plus an append-only journal of [seq, op, ...] lines, compacted every JOURNAL_MAX entries.
+# An edit journals [seq, 'stamp', StoreStamp] with its ops, so it costs no extra write.
+JOURNAL_MAX = 32
+# fname: [seq, journal entries, stamp]
+StoreSeq = {}
+
+def ReadJSONLines(fname):
+    try:
+        file = open(fname, 'r', encoding='utf-8')
+    except OSError:
+        return
+    with file:
+        for line in file:
+            try:
+                yield ujson.loads(line)
+            except ValueError:
+                # Torn write at power loss
+                pass
+
+def WriteAtomic(fname, lines):
+    tmp = fname + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as file:
+        for v in lines:
+            file.write(ujson.dumps(v))
+            file.write('\n')
+    os.rename(tmp, fname)
+
+def RemoveFile(fname):
+    try:
+        os.remove(fname)
+    except OSError:
+        pass
+
+def StoreLoad(fname, records, apply):
+    # Appends the snapshot records to records, replays newer journal entries through
+    # apply(records, op), and returns whether the store exists. Line by line, so the
+    # records are never held twice.
+    seq = -1
+    stamp = 0
+    for v in ReadJSONLines(fname):
+        if seq < 0:
+            seq, stamp = v
+        else:
+            records.append(v)
+    found = seq >= 0
+    jcount = 0
+    for v in ReadJSONLines(fname + '.jnl'):
+        if v[0] > seq:
+            if v[1] == 'stamp':
+                stamp = v[2]
+            else:
+                apply(records, v[1:])
+                jcount += 1
+                found = True
+            seq = v[0]
+    StoreSeq[fname] = [max(seq, 0), jcount, stamp]
+    if jcount:
+        # Fold the journal in now so a torn tail line is never appended to
+        StoreSave(fname, records)
+    else:
+        RemoveFile(fname + '.jnl')
+    return found
+
+def StoreSave(fname, records):
+    st = StoreSeq.setdefault(fname, [0, 0, 0])
+    st[0] += 1
+    st[1] = 0
+    # Compaction at load time runs before SetupStoreStamp()
+    st[2] = max(st[2], StoreStamp)
+
+    def lines():
+        yield [st[0], st[2]]
+        for r in records:
+            yield r
+    WriteAtomic(fname, lines())
+    RemoveFile(fname + '.jnl')
+
+def StoreJournal(fname, ops):
+    # Returns True when the journal is due for compaction
+    st = StoreSeq.setdefault(fname, [0, 0, 0])
+    if StoreStamp > st[2]:
+        st[2] = StoreStamp
+        ops = ops + [['stamp', st[2]]]
+    with open(fname + '.jnl', 'a', encoding='utf-8') as file:
+        for op in ops:
+            st[0] += 1
+            if op[0] != 'stamp':
+                st[1] += 1
+            file.write(ujson.dumps([st[0]] + op))
+            file.write('\n')
+    return st[1] >= JOURNAL_MAX
+
+# UTC ms of the last edit of schedules, scenes or skip dates. Peers copy the store
+# of whichever kicker has the newest stamp. Each store file keeps the stamp of its
+# last write; loading and compaction keep it.
+StoreStamp = 0
+
+def SetupStoreStamp():
+    # After the stores are loaded
+    global StoreStamp
+    for st in StoreSeq.values():
+        StoreStamp = max(StoreStamp, st[2])
+
+def StoreChanged(stamp=0):
+    # Before the store is written, which records the stamp
+    global StoreStamp
+    StoreStamp = stamp or NowMs()
+
+def StoreMigrate(oldname, fname, torecords):
+    # One-time conversion of the former eval() based files
+    try:
+        with open(oldname, 'r', encoding='utf-8') as file:
+            old = eval(file.read())
+    except Exception:
+        return
+    StoreSave(fname, torecords(old))
+    os.rename(oldname, oldname + '.bak')
+    log(f'{oldname} migrated.')
+
+
+def ScheduleMsec(S):
+    # MSEC was added later; older tuples have 10 fields
+    return S[10] if len(S)>10 else 0
+
+class ScheduleTable:
+    # Schedules packed column-wise: one array per field instead of a tuple (and a
+    # weekday tuple) per schedule. Indexing still gives/takes the tuple form
+    # (NAME,WEEKDAYS,HOUR,MINUTE,SECOND,YEAR,MONTH,DAY,SCENENAME,ACTIVE,MSEC)
+    # for pages and storage; the scheduler reads the columns directly.
+    # Weekday 7 means "skip on SkipDates". MONTH/DAY > 0 make a dated schedule:
+    # every year on that date, or once when YEAR is set too.
+    SKIP = 0x80
+    ACTIVE = 0x100
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.name = []
+        # Bits 0-6: weekdays (0=Monday), bit 7: skip dates, bit 8: active
+        self.wmask = array('H')
+        self.hour = array('b')
+        self.minute = array('b')
+        self.second = array('b')
+        self.msec = array('h')
+        self.year = array('h')
+        self.month = bytearray()
+        self.day = bytearray()
+        # Index into self.scenes; schedules sharing a scene share one name string
+        self.scene = array('H')
+        self.scenes = []
+        # Last fire time (local seconds) dispatched; runtime only
+        self.fired = array('i')
+
+    def __len__(self):
+        return len(self.name)
+
+    def SceneIndex(self, scenename):
+        try:
+            return self.scenes.index(scenename)
+        except ValueError:
+            self.scenes.append(scenename)
+            return len(self.scenes)-1
+
+    def SceneName(self, i):
+        return self.scenes[self.scene[i]]
+
+    def Active(self, i):
+        return self.wmask[i] & ScheduleTable.ACTIVE
+
+    def Dated(self, i):
+        return self.month[i]>0
+
+    def _set(self, i, S):
+        m = ScheduleTable.ACTIVE if S[9] else 0
+        for d in S[1]:
+            if 0<=d<=7:
+                m |= 1<<d
+        self.name[i] = S[0]
+        self.wmask[i] = m
+        self.hour[i] = S[2]
+        self.minute[i] = S[3]
+        self.second[i] = S[4]
+        self.year[i] = S[5]
+        self.month[i] = S[6]
+        self.day[i] = S[7]
+        self.scene[i] = self.SceneIndex(S[8])
+        self.msec[i] = ScheduleMsec(S)
+
+    def append(self, S):
+        self.name.append('')
+        for col in (self.wmask, self.hour, self.minute, self.second, self.msec, self.year, self.month, self.day, self.scene, self.fired):
+            col.append(0)
+        self._set(len(self.name)-1, S)
+
+    def __getitem__(self, i):
+        if i<0:
+            i += len(self.name)
+        m = self.wmask[i]
+        return (self.name[i], tuple(d for d in range(8) if m>>d & 1), self.hour[i], self.minute[i], self.second[i],
+                self.year[i], self.month[i], self.day[i], self.SceneName(i), bool(m & ScheduleTable.ACTIVE), self.msec[i])
+
+    def __setitem__(self, i, S):
+        if isinstance(i, int):
+            self._set(i, S)
+            return
+        # DataBase[:] = records
+        self.clear()
+        for r in S:
+            self.append(r)
+
+    def __delitem__(self, i):
+        # MicroPython arrays cannot delete items; deletes are rare, so rebuild the columns
+        del self.name[i]
+        for k in ('wmask', 'hour', 'minute', 'second', 'msec', 'year', 'month', 'day', 'scene', 'fired'):
+            col = getattr(self, k)
+            setattr(self, k, col[:i] + col[i+1:])
+
+    def __iter__(self):
+        for i in range(len(self.name)):
+            yield self[i]
+
+DataBase=ScheduleTable()
+CnfFileName='SwBotKicker.sch'
+
+def ApplyScheduleOp(records, op):
+    if op[0] == 'put':
+        if op[1] < len(records):
+            records[op[1]] = op[2]
+        else:
+            records.append(op[2])
+    elif op[0] == 'del':
+        del records[op[1]]
+
 def SetupDataBase():
-    global DataBase
+    StoreMigrate('SwBotKicker.cnf', CnfFileName, lambda old: old)
     DataBase.clear()
-    try:
-        with open(CnfFileName, 'r', encoding='utf-8') as file:
-            DataBase = eval(file.read())
-        log('Configulation loaded.')
-    except Exception as e:
+    if not StoreLoad(CnfFileName, DataBase, ApplyScheduleOp):
         log('No Configulation')
-        DataBase.clear()
+        return
+    log('Configulation loaded.')
 
-def SaveDataBase():
-    global DataBase
-    with open(CnfFileName, 'w', encoding='utf-8') as file:
-        print(f'{DataBase}', file=file)
+def SaveDataBase(stamp=0):
+    StoreChanged(stamp)
+    StoreSave(CnfFileName, DataBase)
     log('Configulation saved.')
 
+def PutSchedule(i):
+    StoreChanged()
+    if StoreJournal(CnfFileName, [['put', i, DataBase[i]]]):
+        SaveDataBase()
+
+def DeleteSchedule(i):
+    del DataBase[i]
+    StoreChanged()
+    if StoreJournal(CnfFileName, [['del', i]]):
+        SaveDataBase()
+
+def ParseWeekdays(v):
+    # "(0, 1, 2)" from the edit form, or a JSON list
+    if isinstance(v, str):
+        v = [x for x in v.strip().strip('()[]').split(',') if x.strip()]
+    W = tuple(sorted(set(int(x) for x in v)))
+    if not W or W[0]<0 or W[-1]>7:
+        raise ValueError('weekdays must be 0..7')
+    return W
+
+def ParseDate(v):
+    # "YYYY-MM-DD" (once) or "MM-DD" (every year) to (YEAR, MONTH, DAY); empty is (0, 0, 0)
+    if not v:
+        return (0, 0, 0)
+    if not isinstance(v, str):
+        raise ValueError('date must be YYYY-MM-DD or MM-DD')
+    f = [int(x) for x in v.split('-')]
+    if len(f) == 2:
+        f.insert(0, 0)
+    if len(f) != 3 or not (f[0]==0 or 2000<=f[0]<=9999) or not 1<=f[1]<=12 or not 1<=f[2]<=31:
+        raise ValueError('date must be YYYY-MM-DD or MM-DD')
+    # A yearly MM-DD is checked against a leap year, so 02-29 is allowed
+    if DateDay(f[0] or 2000, f[1], f[2]) < 0:
+        raise ValueError(f'no such date {v}')
+    return tuple(f)
+
+def DateString(Y, M, D):
+    if M == 0:
+        return ''
+    return f'{Y:04d}-{M:02d}-{D:02d}' if Y else f'{M:02d}-{D:02d}'
+
+def CheckRange(o, key, lo, hi, default):
+    v = o.get(key, default)
+    if not isinstance(v, int) or isinstance(v, bool) or v<lo or v>hi:
+        raise ValueError(f'{key} must be {lo}..{hi}')
+    return v
+
+def ScheduleFromJSON(o, S=None, scenes=None):
+    # Validated schedule tuple from a JSON object; omitted keys keep the values of S.
+    # With scenes, the scene must be one of its captions.
+    if not isinstance(o, dict):
+        raise ValueError('schedule must be an object')
+    d = {} if S is None else ScheduleJSON(S)
+    d.update(o)
+    name = d.get('name', '(noname)')
+    scene = d.get('scene', '')
+    active = d.get('active', True)
+    Y, M, D = ParseDate(d.get('date'))
+    if not isinstance(name, str) or not isinstance(scene, str):
+        raise ValueError('name and scene must be strings')
+    if scenes is not None and (S is None or 'scene' in o) and (scene not in scenes or scene == '(_initial_)'):
+        raise ValueError(f'no scene {scene}')
+    if not isinstance(active, bool):
+        raise ValueError('active must be true or false')
+    # (NAME,WEEKDAYS,HOUR,MINUTE,SECOND,YEAR,MONTH,DAY,SCENENAME,ACTIVE,MSEC)
+    return (name, ParseWeekdays(d.get('weekdays', (0,1,2,3,4,5,6))),
+            CheckRange(d, 'hour', -1, 23, 12), CheckRange(d, 'minute', -1, 59, 0),
+            CheckRange(d, 'second', 0, 59, 0), Y, M, D, scene,
+            active, CheckRange(d, 'msec', -999, 999, 0))
+
+def ScheduleJSON(S):
+    return {'name': S[0], 'weekdays': list(S[1]), 'hour': S[2], 'minute': S[3], 'second': S[4],
+            'msec': ScheduleMsec(S), 'scene': S[8], 'active': S[9], 'date': DateString(S[5], S[6], S[7]) or None}
+
+# Exception dates for schedules with weekday 7: [YEAR, MONTH, DAY], YEAR 0 is every year
+SkipDates = []
+SkipFileName = 'SwBotKicker.skp'
+# Local day numbers (days since epoch) of SkipDates in SkipYear and the year after
+SkipDays = set()
+SkipYear = 0
+
+def SetupSkipDates():
+    # Line 1 is the dates, line 2 the StoreStamp of the write
+    stamp = 0
+    for i, v in enumerate(ReadJSONLines(SkipFileName)):
+        if i == 0:
+            SkipDates[:] = [tuple(d) for d in v]
+        else:
+            stamp = v
+    StoreSeq[SkipFileName] = [0, 0, stamp]
+    CompileSkipDays(utime.localtime(LocalMs()//1000)[0])
+
+def SaveSkipDates(stamp=0):
+    StoreChanged(stamp)
+    StoreSeq[SkipFileName] = [0, 0, StoreStamp]
+    WriteAtomic(SkipFileName, (SkipDates, StoreStamp))
+    CompileSkipDays(utime.localtime(LocalMs()//1000)[0])
+
+def DateDay(Y, M, D):
+    # Local day number of a date, or -1 if it does not exist (Feb 29)
+    t = utime.mktime((Y, M, D, 0, 0, 0, 0, 0))
+    lt = utime.localtime(t)
+    return t//86400 if lt[1]==M and lt[2]==D else -1
+
+def CompileSkipDays(year):
+    global SkipYear
+    SkipYear = year
+    SkipDays.clear()
+    for Y, M, D in SkipDates:
+        for y in ((Y,) if Y else (year, year+1)):
+            day = DateDay(y, M, D)
+            if day >= 0:
+                SkipDays.add(day)
+
 
 SCENEDIC = OrderedDict([('(_initial_)','')])
-DicFileName='SwBotKicker.dic'
+DicFileName='SwBotKicker.scn'
+def ApplySceneOp(records, op):
+    if op[0] == 'put':
+        for r in records:
+            if r[0] == op[1]:
+                r[1] = op[2]
+                return
+        records.append(op[1:])
+    elif op[0] == 'del':
+        records[:] = [r for r in records if r[0] != op[1]]
+    elif op[0] == 'clr':
+        records.clear()
+
 def SetupSceneDic():
     global SCENEDIC
-    try:
-        with open(DicFileName, 'r', encoding='utf-8') as file:
-            SCENEDIC = eval(file.read())
-        log('Scene dictionary loaded.')
-    except Exception as e:
+    StoreMigrate('SwBotKicker.dic', DicFileName, lambda old: list(old.items()))
+    records = []
+    if not StoreLoad(DicFileName, records, ApplySceneOp):
         log('No scene dictionary')
-
-def SaveSceneDic():
-    global SCENEDIC
-    with open(DicFileName, 'w', encoding='utf-8') as file:
-        print(f'{SCENEDIC}', file=file)
+        return
+    SCENEDIC = OrderedDict((r[0], r[1]) for r in records)
+    InvalidateFragment('scene')
+    log('Scene dictionary loaded.')
+
+def SaveSceneDic(stamp=0):
+    StoreChanged(stamp)
+    StoreSave(DicFileName, SCENEDIC.items())
+    InvalidateFragment('scene')
+    FlagMissingScenes()
     log('Scene dictionary saved.')
 
+def JournalSceneDic(ops):
+    StoreChanged()
+    InvalidateFragment('scene')
+    FlagMissingScenes()
+    if StoreJournal(DicFileName, ops):
+        SaveSceneDic()
+
+
+# Rolling API response time per scene ID (EWMA, ms)
+SceneLatency = {}
+LatFileName='SwBotKicker.lat'
+LatencySavedAt = 0
+def SetupSceneLatency():
+    global SceneLatency
+    SceneLatency = {}
+    for v in ReadJSONLines(LatFileName):
+        SceneLatency = v
+        log('API latency loaded.')
+
+def SaveSceneLatency():
+    global LatencySavedAt
+    WriteAtomic(LatFileName, (SceneLatency,))
+    LatencySavedAt = utime.ticks_ms()
+
+def UpdateSceneLatency(SCENE_ID, ms):
+    est = SceneLatency.get(SCENE_ID)
+    SceneLatency[SCENE_ID] = ms if est is None else est + (ms-est)//4
+    # Flash writes at most every 10 minutes
+    if est is None or utime.ticks_diff(utime.ticks_ms(), LatencySavedAt) > 600000:
+        SaveSceneLatency()
+    if est is None and USER.KICK_EARLY:
+        ScheduleChanged()
+
+def KickLead(i):
+    # How early to fire schedule i so the scene lands on its scheduled time
+    if not USER.KICK_EARLY:
+        return 0
+    # The scene runs about when the request reaches the server, not when the answer is back
+    return SceneLatency.get(SCENEDIC.get(DataBase.SceneName(i), ''), 0)*USER.KICK_EARLY_SHARE//100
+
+
+class APIClient:
+    # Keep-alive HTTP/1.1 client with a small pool of idle connections
+    def __init__(self, host, headers, port=443, ssl=True, poolsize=2, idlemax=50, timeout=10):
+        self.host = host
+        self.timeout = timeout
+        self.port = port
+        self.ssl = ssl
+        self.poolsize = poolsize
+        self.idlemax = idlemax*1000
+        self.head = ''.join(f'{k}: {v}\r\n' for k, v in headers.items())
+        self.idle = []
+        self.opened = 0
+        self.reused = 0
+        self.stale = 0
+
+    async def _open(self):
+        r, w = await uasyncio.wait_for(uasyncio.open_connection(self.host, self.port, ssl=self.ssl), self.timeout)
+        self.opened += 1
+        return [r, w, 0]
+
+    async def _close(self, conn):
+        try:
+            conn[1].close()
+            await conn[1].wait_closed()
+        except Exception:
+            pass
+
+    def _alive(self, conn, margin=0):
+        # An idle keep-alive socket that became readable has been closed by the server
+        if utime.ticks_diff(utime.ticks_ms(), conn[2]) + margin >= self.idlemax:
+            return False
+        s = getattr(conn[1], 's', None)
+        if s is None:
+            return not conn[0].at_eof()
+        p = select.poll()
+        p.register(s, select.POLLIN)
+        return not p.poll(0)
+
+    async def _acquire(self):
+        while self.idle:
+            conn = self.idle.pop()
+            if self._alive(conn):
+                return conn, True
+            self.stale += 1
+            await self._close(conn)
+        return await self._open(), False
+
+    async def Prewarm(self, margin=0, count=1):
+        # Make sure count verified connections (up to poolsize) will still be usable margin seconds from now
+        for conn in self.idle[:]:
+            if not self._alive(conn, margin*1000):
+                self.idle.remove(conn)
+                self.stale += 1
+                await self._close(conn)
+        while len(self.idle) < min(count, self.poolsize):
+            self._release(await self._open())
+
+    def _release(self, conn):
+        conn[2] = utime.ticks_ms()
+        if len(self.idle) < self.poolsize:
+            self.idle.append(conn)
+            return True
+        return False
+
+    def Build(self, method, path, body=b'', extra=''):
+        return (f'{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n{self.head}{extra}'
+                f'Content-Length: {len(body)}\r\nConnection: keep-alive\r\n\r\n').encode() + body
+
+    async def _head(self, conn, req):
+        r, w = conn[0], conn[1]
+        w.write(req)
+        await w.drain()
+        line = await r.readline()
+        if not line:
+            raise OSError('Connection closed')
+        status = int(line.split(None, 2)[1])
+        length = 0 if status in (204, 304) else -1
+        chunked = False
+        keep = True
+        etag = None
+        while True:
+            line = await r.readline()
+            if not line or line == b'\r\n':
+                break
+            k, _, v = line.decode().partition(':')
+            k = k.strip().lower()
+            v = v.strip().lower()
+            if k == 'content-length':
+                length = int(v)
+            elif k == 'transfer-encoding':
+                chunked = 'chunked' in v
+            elif k == 'connection':
+                keep = v != 'close'
+            elif k == 'etag':
+                etag = line.decode().partition(':')[2].strip()
+        return status, length, chunked, keep, etag
+
+    async def _exchange(self, conn, req):
+        r = conn[0]
+        status, length, chunked, keep, etag = await self._head(conn, req)
+        if chunked:
+            body = b''
+            while True:
+                n = int((await r.readline()).split(b';')[0], 16)
+                if n:
+                    body += await r.readexactly(n)
+                await r.readline()
+                if n == 0:
+                    break
+        elif length >= 0:
+            body = await r.readexactly(length) if length else b''
+        else:
+            body = await r.read(-1)
+            keep = False
+        return status, body, keep
+
+    async def Request(self, method, path, body=b'', req=None):
+        # Returns (status, body bytes). A reused socket that turns out stale is reopened once.
+        if req is None:
+            req = self.Build(method, path, body)
+        conn, reused = await self._acquire()
+        try:
+            status, data, keep = await uasyncio.wait_for(self._exchange(conn, req), self.timeout)
+        except Exception as e:
+            await self._close(conn)
+            # A timed out request may have reached the server; never resend it here
+            if not reused or isinstance(e, uasyncio.TimeoutError):
+                raise
+            self.stale += 1
+            conn = await self._open()
+            try:
+                status, data, keep = await uasyncio.wait_for(self._exchange(conn, req), self.timeout)
+            except Exception:
+                await self._close(conn)
+                raise
+        else:
+            if reused:
+                self.reused += 1
+        if not (keep and self._release(conn)):
+            await self._close(conn)
+        return status, data
+
+    async def Stream(self, method, path, extra=''):
+        # Like Request(), but returns (status, APIBody) so the body can be read piecewise
+        req = self.Build(method, path, extra=extra)
+        conn, reused = await self._acquire()
+        try:
+            head = await uasyncio.wait_for(self._head(conn, req), self.timeout)
+        except Exception as e:
+            await self._close(conn)
+            if not reused or isinstance(e, uasyncio.TimeoutError):
+                raise
+            self.stale += 1
+            conn = await self._open()
+            try:
+                head = await uasyncio.wait_for(self._head(conn, req), self.timeout)
+            except Exception:
+                await self._close(conn)
+                raise
+        else:
+            if reused:
+                self.reused += 1
+        return head[0], APIBody(self, conn, head[1], head[2], head[3], head[4])
+
+    def Stats(self):
+        return {'opened': self.opened, 'reused': self.reused, 'stale': self.stale, 'idle': len(self.idle)}
+
+class APIBody:
+    # Response body of APIClient.Stream(); the connection goes back to the pool at the end
+    def __init__(self, client, conn, length, chunked, keep, etag=None):
+        self.client = client
+        self.etag = etag
+        self.conn = conn
+        self.left = 0 if chunked else length
+        self.chunked = chunked
+        self.keep = keep
+        self.done = False
+
+    async def read(self, n):
+        # Up to n bytes, b'' at the end of the body
+        if self.done:
+            return b''
+        r = self.conn[0]
+        if self.chunked and self.left == 0:
+            self.left = int((await uasyncio.wait_for(r.readline(), self.client.timeout)).split(b';')[0], 16)
+            if self.left == 0:
+                await r.readline()
+        if self.left == 0:
+            await self._finish()
+            return b''
+        data = await uasyncio.wait_for(r.read(n if self.left < 0 else min(n, self.left)), self.client.timeout)
+        if not data:
+            if self.left > 0:
+                await self.close()
+                raise OSError('Connection closed')
+            self.keep = False
+            await self._finish()
+            return b''
+        if self.left > 0:
+            self.left -= len(data)
+            if self.chunked and self.left == 0:
+                await r.readline()
+        return data
+
+    async def _finish(self):
+        self.done = True
+        if not (self.keep and self.client._release(self.conn)):
+            await self.client._close(self.conn)
+
+    async def close(self):
+        # Abandon the rest of the body
+        if not self.done:
+            self.done = True
+            await self.client._close(self.conn)
+
+QUOTA_SCHEDULED = 0
+QUOTA_RETRY = 1
+QUOTA_MANUAL = 2
+QUOTA_SAVE_EVERY = 16
+
+class RateLimiter:
+    # Token bucket in front of the daily API request budget. The day's count is saved
+    # every QUOTA_SAVE_EVERY requests, and assumed that much higher after a reboot.
+    # Retries and manual traffic stop short of the last `reserve` requests of the day,
+    # which are kept for scheduled kicks, and wait while the bucket is down to `keep` tokens.
+    def __init__(self, fname, limit, reserve, rate, burst, keep=0):
+        self.fname = fname
+        self.limit = limit
+        self.reserve = reserve
+        self.rate = rate
+        self.burst = burst
+        self.keep = keep
+        self.tokens = burst
+        self.stamp = utime.ticks_ms()
+        self.day = -1
+        self.used = 0
+        self.saved = 0
+        self.denied = array('i', [0, 0, 0])
+
+    def Load(self):
+        # The clock may not be set yet: the day is compared once it is trusted
+        for v in ReadJSONLines(self.fname):
+            self.day, self.used = v['day'], min(self.limit, v['used'] + QUOTA_SAVE_EVERY)
+        self.saved = self.used
+
+    def Save(self):
+        WriteAtomic(self.fname, ({'day': self.day, 'used': self.used},))
+        self.saved = self.used
+
+    def _rollover(self):
+        # Before NTP (or a trusted RTC) the day is unknown; the loaded count stands until then
+        if not ClockTrusted():
+            return
+        day = NowMs()//86400000
+        if day != self.day:
+            self.day = day
+            self.used = 0
+            self.saved = 0
+
+    def Remaining(self):
+        self._rollover()
+        return self.limit - self.used
+
+    def Exhausted(self):
+        # The API answered 429: nothing more goes out until the day rolls over
+        self._rollover()
+        if self.used < self.limit:
+            log('API quota exhausted after %d requests.', args=(self.used,), level=LOG_ERROR)
+            self.used = self.limit
+            self.Save()
+
+    async def Acquire(self, prio):
+        # True when a request of class prio may be sent now; waits for a token if needed
+        if self.Remaining() <= (0 if prio == QUOTA_SCHEDULED else self.reserve):
+            self.denied[prio] += 1
+            return False
+        need = 1 if prio == QUOTA_SCHEDULED else 1 + self.keep
+        while True:
+            t = utime.ticks_ms()
+            self.tokens = min(self.burst, self.tokens + utime.ticks_diff(t, self.stamp)*self.rate/1000)
+            self.stamp = t
+            if self.tokens >= need:
+                break
+            await uasyncio.sleep_ms(int((need-self.tokens)*1000/self.rate)+1)
+        self.tokens -= 1
+        self._rollover()
+        self.used += 1
+        if self.used - self.saved >= QUOTA_SAVE_EVERY:
+            self.Save()
+        return True
+
+class Account:
+    # One SwitchBot account: credentials, connection pool, rate limiter and scene catalog.
+    # The default account '' keeps the file names of a single-account kicker.
+    def __init__(self, name, token, host='api.switch-bot.com', port=443, ssl=True):
+        self.name = name
+        headers = {'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json'}
+        self.api = APIClient(host, headers, port=port, ssl=ssl, poolsize=USER.KICK_PARALLEL, timeout=USER.API_TIMEOUT)
+        base = f'SwBotKicker.{name}' if name else 'SwBotKicker'
+        self.quota = RateLimiter(base + '.quo', USER.API_DAILY_LIMIT, USER.API_RESERVE, USER.API_RATE, USER.API_BURST,
+                                 USER.API_BURST_RESERVE)
+        self.catname = base + '.cat'
+        self.metaname = base + '.cat.meta'
+        self.meta = None
+        self.busy = False
+        # Kicks in flight on this account's connections, and those waiting for one
+        self.running = 0
+        self.pending = []
+
+Accounts = OrderedDict([('', Account('', USER.SB_API_TOKEN))])
+for name, token in USER.SB_ACCOUNTS.items():
+    Accounts[name] = Account(name, token)
+
+def TagScene(name, sceneId):
+    # Scene IDs of further accounts are stored as 'account:sceneId'
+    return f'{name}:{sceneId}' if name else sceneId
+
+def SceneAccount(SCENE_ID):
+    # (Account or None, bare scene ID)
+    name, _, sceneId = SCENE_ID.rpartition(':')
+    return Accounts.get(name), sceneId
+
+KickRequests = {}
+def KickRequest(SCENE_ID):
+    req = KickRequests.get(SCENE_ID)
+    if req is None:
+        acct, sceneId = SceneAccount(SCENE_ID)
+        req = acct.api.Build('POST', f'/v1.0/scenes/{sceneId}/execute')
+        KickRequests[SCENE_ID] = req
+    return req
+
+async def PrewarmAccount(acct, count):
+    try:
+        await acct.api.Prewarm(USER.PREWARM_SECONDS, count)
+    except Exception as e:
+        log('Prewarm failed: %s', args=(LogRepr(e),), level=LOG_WARN)
+
+async def PrewarmKick(SCENE_ID):
+    acct = SceneAccount(SCENE_ID)[0]
+    if acct:
+        KickRequest(SCENE_ID)
+        await PrewarmAccount(acct, 1)
+
+class SceneStream:
+    # Incremental reader of the /v1.0/scenes response: async iterator of (sceneName, sceneId).
+    # Only the current read buffer and one string are held, whatever the number of scenes.
+    def __init__(self, body, bufsize=256):
+        self.body = body
+        self.bufsize = bufsize
+        self.buf = b''
+        self.i = 0
+        self.stack = bytearray()
+        self.expectkey = False
+        self.key = None
+        self.top = None
+        self.scene = {}
+
+    def __aiter__(self):
+        return self
+
+    async def _more(self):
+        data = await self.body.read(self.bufsize)
+        if not data:
+            raise StopAsyncIteration
+        self.buf = self.buf[self.i:] + data
+        self.i = 0
+
+    async def _string(self):
+        # self.buf[self.i] is the opening quote
+        k = self.i + 1
+        while True:
+            j = self.buf.find(b'"', k)
+            if j < 0:
+                k = len(self.buf) - self.i
+                await self._more()
+                continue
+            b = j
+            while self.buf[b-1] == 0x5C:
+                b -= 1
+            if (j-b) % 2 == 0:
+                break
+            k = j + 1
+        raw = self.buf[self.i:j+1]
+        self.i = j + 1
+        return ujson.loads(raw) if b'\\' in raw else raw[1:-1].decode()
+
+    async def __anext__(self):
+        while True:
+            if self.i >= len(self.buf):
+                self.buf = b''
+                self.i = 0
+                await self._more()
+            c = self.buf[self.i]
+            if c == 0x22:
+                v = await self._string()
+                if self.expectkey:
+                    self.key = v
+                    if len(self.stack) == 1:
+                        self.top = v
+                elif len(self.stack) == 3 and self.top == 'body':
+                    self.scene[self.key] = v
+                continue
+            self.i += 1
+            if c == 0x7B or c == 0x5B:
+                self.stack.append(c)
+                self.expectkey = c == 0x7B
+            elif c == 0x3A:
+                self.expectkey = False
+            elif c == 0x2C:
+                self.expectkey = self.stack[-1] == 0x7B
+            elif c == 0x7D or c == 0x5D:
+                closed = len(self.stack) == 3 and self.top == 'body'
+                self.stack.pop()
+                self.expectkey = False
+                if closed:
+                    S = self.scene
+                    self.scene = {}
+                    if 'sceneName' in S and 'sceneId' in S:
+                        return S['sceneName'], S['sceneId']
+
+    async def close(self):
+        await self.body.close()
+
+class HashedBody:
+    # Passes an APIBody through while hashing the raw bytes
+    def __init__(self, body):
+        self.body = body
+        self.hash = hashlib.sha256()
+
+    async def read(self, n):
+        data = await self.body.read(n)
+        self.hash.update(data)
+        return data
+
+    async def close(self):
+        await self.body.close()
+
+# Scene catalog cached on flash: [sceneName, sceneId] lines, and a metadata file
+# {"t": fetched UTC seconds, "etag": ..., "hash": sha256 of the raw response}, per account
+# Captions in SCENEDIC whose scene ID is no longer in the catalog
+MissingScenes = []
+
+def SetupSceneCatalog():
+    for acct in Accounts.values():
+        for v in ReadJSONLines(acct.metaname):
+            acct.meta = v
+    FlagMissingScenes()
+
+def CatalogScenes(acct=None):
+    # (sceneName, tagged sceneId) of one account, or of all of them
+    for a in ((acct,) if acct else Accounts.values()):
+        for v in ReadJSONLines(a.catname):
+            yield v[0], TagScene(a.name, v[1])
+
+def CatalogAge(acct):
+    if acct.meta is None:
+        return -1
+    return NowMs()//1000 - acct.meta['t']
+
+def FlagMissingScenes():
+    # Only scenes of accounts with a catalog can be checked
+    ids = set()
+    for i in SCENEDIC.values():
+        acct = SceneAccount(i)[0] if i else None
+        if acct and acct.meta:
+            ids.add(i)
+    for name, sceneId in CatalogScenes():
+        ids.discard(sceneId)
+    MissingScenes[:] = [c for c, i in SCENEDIC.items() if i in ids]
+    if MissingScenes:
+        log('Scenes not found in SwitchBot: %s', args=(', '.join(MissingScenes),), level=LOG_WARN)
+
+async def RefreshCatalog(acct):
+    # Conditional GET of the scene list into the flash catalog; True when the catalog is current
+    if acct.busy:
+        return False
+    acct.busy = True
+    body = None
+    tmp = acct.catname + '.tmp'
+    try:
+        if not await acct.quota.Acquire(QUOTA_MANUAL):
+            log('Scene list not retrieved: API quota reserved.', level=LOG_WARN)
+            return False
+        etag = acct.meta.get('etag') if acct.meta else None
+        status, body = await acct.api.Stream('GET', '/v1.0/scenes', f'If-None-Match: {etag}\r\n' if etag else '')
+        if status == 304:
+            await body.read(1)
+            acct.meta['t'] = NowMs()//1000
+            WriteAtomic(acct.metaname, (acct.meta,))
+            log('Scene catalog not modified.')
+            return True
+        if status != 200:
+            await body.close()
+            if status == 429:
+                acct.quota.Exhausted()
+            log('Retrieve scenes failed: %d', args=(status,), level=LOG_WARN)
+            return False
+        hb = HashedBody(body)
+        n = 0
+        with open(tmp, 'w', encoding='utf-8') as file:
+            async for name, sceneId in SceneStream(hb):
+                file.write(ujson.dumps((name, sceneId)))
+                file.write('\n')
+                n += 1
+        digest = ubinascii.hexlify(hb.hash.digest()).decode()
+        if acct.meta and acct.meta.get('hash') == digest:
+            RemoveFile(tmp)
+            log('Scene catalog unchanged.')
+        else:
+            os.rename(tmp, acct.catname)
+            log('Scene catalog updated: %d scenes.', args=(n,))
+        acct.meta = {'t': NowMs()//1000, 'etag': body.etag, 'hash': digest}
+        WriteAtomic(acct.metaname, (acct.meta,))
+        FlagMissingScenes()
+        return True
+    except Exception as e:
+        log('Retrieve scenes failed: %s', args=(LogRepr(e),), level=LOG_WARN)
+        if body:
+            await body.close()
+        RemoveFile(tmp)
+        return False
+    finally:
+        acct.busy = False
+        gc.collect()
 
-APIheaders = {
-    'Authorization': 'Bearer ' + USER.SB_API_TOKEN,
-    'Content-Type': 'application/json'
-}
-async def RetrieveScenes():
-    url = 'https://api.switch-bot.com/v1.0/scenes'
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, json=None, headers=APIheaders) as response:
-            jsontext = await response.text() if response.status==200 else ''
-    return jsontext
-
-async def ExecuteScene(SCENE_ID):
+async def CatalogTask():
+    # Keeps the scene catalog of every account within USER.SCENE_CACHE_TTL
+    while True:
+        wait = USER.SCENE_CACHE_TTL
+        for acct in Accounts.values():
+            age = CatalogAge(acct)
+            if age < 0 or age >= USER.SCENE_CACHE_TTL:
+                # Failed refreshes are tried again in 10 minutes
+                age = 0 if await RefreshCatalog(acct) else USER.SCENE_CACHE_TTL-600
+            wait = min(wait, USER.SCENE_CACHE_TTL - age)
+        await uasyncio.sleep(max(60, wait))
+
+async def ExecuteScene(SCENE_ID, prio=QUOTA_SCHEDULED):
+    # True on success, False on a server error (5xx), None when not worth retrying (4xx);
+    # connection failures and timeouts raise
     if SCENE_ID=='':
-        log(f'SceneID is empty.')
-        return
-
-    log(f'Execute scene {SCENE_ID}')
-    url = f'https://api.switch-bot.com/v1.0/scenes/{SCENE_ID}/execute'
+        log('SceneID is empty.', level=LOG_WARN)
+        return None
+    acct = SceneAccount(SCENE_ID)[0]
+    if acct is None:
+        log('Scene %s: no such account in SB_ACCOUNTS.', args=(SCENE_ID,), level=LOG_ERROR)
+        return None
+    if not await acct.quota.Acquire(prio):
+        log('Scene %s not executed: API quota %s.', args=(SCENE_ID, 'exhausted' if acct.quota.Remaining()<=0 else 'reserved'), level=LOG_ERROR)
+        return None
+
+    log('Execute scene %s', args=(SCENE_ID,))
     ledon()
     gc.collect()
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=None, headers=APIheaders) as response:
-            if response.status == 200:
-                log(f'Scene {SCENE_ID} is executed successfully.')
-            else:
-                log(f'Failed to execute scene:{response.text}')
-    ledoff()
+    start = utime.ticks_ms()
+    try:
+        status, body = await acct.api.Request('POST', '', req=KickRequest(SCENE_ID))
+    finally:
+        ledoff()
+    CountStatus(status)
+    if status == 200:
+        UpdateSceneLatency(SCENE_ID, utime.ticks_diff(utime.ticks_ms(), start))
+        log('Scene %s is executed successfully.', args=(SCENE_ID,))
+    else:
+        log('Failed to execute scene:%d %s', args=(status, LogRepr(body)), level=LOG_ERROR)
+    if status == 429:
+        acct.quota.Exhausted()
+    if status == 200:
+        return True
+    # A bad token, an unknown scene or an exhausted quota fails the same way every time
+    return False if status >= 500 else None
+
+
+WDPAT = (
+    ((0,1,2,3,4,5,6),USER.DESC_TEXT_EVERYDAY),
+    ((0,1,2,3,4,5,6,7),USER.DESC_TEXT_EVERYDAY_SKIP),
+    ((0,1,2,3,4),USER.DESC_TEXT_WEEKDAYS),
+    ((0,1,2,3,4,7),USER.DESC_TEXT_WEEKDAYS_SKIP),
+    ((0,1,2,3),USER.DESC_TEXT_MON2THU),
+    ((0,2,4),USER.DESC_TEXT_MONWEFRI),
+    ((1,3,5),USER.DESC_TEXT_TUETHSAT),
+    ((0,),USER.DESC_TEXT_MONDAY),
+    ((1,),USER.DESC_TEXT_TUESDAY),
+    ((2,),USER.DESC_TEXT_WEDNESDAY),
+    ((3,),USER.DESC_TEXT_THURSDAY),
+    ((4,),USER.DESC_TEXT_FRIDAY),
+    ((5,),USER.DESC_TEXT_SATURDAY),
+    ((6,),USER.DESC_TEXT_SUNDAY),
+    ((4,5,6),USER.DESC_TEXT_FRI2SUN),
+    ((5,6),USER.DESC_TEXT_WEEKEND),
+)
+
+def WeekdayLabel(W):
+    # The WDPAT caption, or for other sets from the API the days one by one
+    for D in WDPAT:
+        if D[0]==W:
+            return D[1]
+    return ' '.join(WDPAT[7+d][1] for d in W if d<7) + (USER.DESC_TEXT_SKIP if 7 in W else '')
+
+# Pre-rendered <option> lists for the edit page. Only ' selected' is patched in per request.
+FragmentCache = {}
+
+def BuildFragment(key):
+    if key == 'hour':
+        opts = ((j, f'{j}' if j>=0 else '**') for j in range(-1,24))
+    elif key == 'minute':
+        opts = ((j, f'{j:02d}' if j>=0 else '**') for j in range(-1,60))
+    elif key == 'second':
+        opts = ((j, f'{j:02d}') for j in range(60))
+    elif key == 'weekday':
+        opts = WDPAT
+    else:
+        opts = ((s, s) for s in SCENEDIC.keys())
+    return ''.join(f'<option value="{v}">{c}</option>' for v, c in opts).encode()
+
+def Fragment(key):
+    frag = FragmentCache.get(key)
+    if frag is None:
+        frag = BuildFragment(key)
+        FragmentCache[key] = frag
+    return frag
+
+def InvalidateFragment(key):
+    if key in FragmentCache:
+        del FragmentCache[key]
+
+def SelectFragment(key, value, caption=None):
+    # Yields the cached option list with value marked selected, without copying it.
+    # A value the list lacks is added as a selected option when it has a caption,
+    # so submitting the form keeps it.
+    frag = Fragment(key)
+    mv = memoryview(frag)
+    marker = f'<option value="{value}"'.encode()
+    k = frag.find(marker)
+    if k < 0:
+        if caption is not None:
+            yield f'<option value="{value}" selected>{caption}</option>'
+        yield mv
+        return
+    k += len(marker)
+    yield mv[:k]
+    yield b' selected'
+    yield mv[k:]
+
 
 
-# Interface variables between web server and worker
 testtime = 0
 testscene = ''
 adjusttime = 0
 
-# Share variable between web pages
-parsed_scenes = None
-
 async def web_server():
 
     TITLE = 'SwitchBot Kicker'
     HEADLINE = 'SwitchBot Kicker v1.37'
 
-    WDPAT = (
-        ((0,1,2,3,4,5,6),USER.DESC_TEXT_EVERYDAY),
-        ((0,1,2,3,4),USER.DESC_TEXT_WEEKDAYS),
-        ((0,1,2,3),USER.DESC_TEXT_MON2THU),
-        ((0,2,4),USER.DESC_TEXT_MONWEFRI),
-        ((1,3,5),USER.DESC_TEXT_TUETHSAT),
-        ((0,),USER.DESC_TEXT_MONDAY),
-        ((1,),USER.DESC_TEXT_TUESDAY),
-        ((2,),USER.DESC_TEXT_WEDNESDAY),
-        ((3,),USER.DESC_TEXT_THURSDAY),
-        ((4,),USER.DESC_TEXT_FRIDAY),
-        ((5,),USER.DESC_TEXT_SATURDAY),
-        ((6,),USER.DESC_TEXT_SUNDAY),
-        ((4,5,6),USER.DESC_TEXT_FRI2SUN),
-        ((5,6),USER.DESC_TEXT_WEEKEND),
-    )
 
     html_backhome = f'''
 <!DOCTYPE html><html><head>
@@ -240,19 +1570,15 @@ async def web_server():
 </head><body></body></html>
 '''
     html_headers = {'Content-Type': 'text/html'}
+    for key in ('weekday', 'hour', 'minute', 'second'):
+        Fragment(key)
 
     app = Microdot()
 
-    # Log display / select edit schedule
-    @app.route('/')
-    async def _index(request):
-        gc.collect()
-        LOGS=''
-        for s in logqueue:
-            LOGS += f' {s}\n'
-
-        gc.collect()
-        forms = f'''
+    # Pages are streamed from generators, one chunk per row, so peak RAM
+    # does not grow with the number of schedules or scenes.
+    def IndexPage():
+        yield f'''
 <!DOCTYPE html><html lang="ja"><head><meta charset="UTF-8">
 <meta http-equiv="refresh" content="60">
 <title>{TITLE}</title><style> body {{color: #ffffff; background-color: #000000;}}
@@ -260,11 +1586,25 @@ async def web_server():
 .form-row {{ display: flex; align-items: center; gap: 8px; }}
 </style></head><body><h1>{HEADLINE}</h1>
 <pre>Log updated: {DatetimeString(OffsetUTCtime())}</pre><p></p>
-<pre>{LOGS}</pre><hr><div class="form-container">
-'''
-        for i in range(len(DataBase)):
-            gc.collect()
-            # (NAME,WEEKDAYS,HOUR,MINUTE,SECOND,YEAR,MONTH,DAY,SCENENAME,ACTIVE)
+<pre>'''
+        for s in LogLines():
+            yield f' {s}\n'
+        yield '</pre>\n<pre>API latency:'
+        for caption, sceneId in SCENEDIC.items():
+            if sceneId in SceneLatency:
+                yield f' {caption}:{SceneLatency[sceneId]}ms'
+        yield f'</pre>\n<pre>{USER.DESC_TEXT_QUOTA}:'
+        for a in Accounts.values():
+            yield f' {a.name}{":" if a.name else ""}{a.quota.Remaining()}/{a.quota.limit}'
+        if USER.PEER_ENABLE:
+            yield f'</pre>\n<pre>{USER.DESC_TEXT_LEADER if Leader else USER.DESC_TEXT_STANDBY}: {USER.HOSTNAME} / {" ".join(Peers)}'
+        if MissingScenes:
+            yield f'</pre>\n<pre>{USER.DESC_TEXT_MISSINGSCENES}: {", ".join(MissingScenes)}'
+        yield '</pre><hr><div class="form-container">\n'
+
+        i = 0
+        while i < len(DataBase):
+            # (NAME,WEEKDAYS,HOUR,MINUTE,SECOND,YEAR,MONTH,DAY,SCENENAME,ACTIVE,MSEC)
             n = DataBase[i]
             IDNO=i
             NAME=n[0]
@@ -272,29 +1612,28 @@ async def web_server():
             HOUR=n[2]
             MINU=n[3]
             SECO=n[4]
+            MSEC=ScheduleMsec(n)
             ACTV=' checked' if n[9] else '' 
 
             HD = f'{HOUR:02d}' if HOUR>=0 else '**'
             MD = f'{MINU:02d}' if MINU>=0 else '**'
-            WKDN=''
-            for D in WDPAT:
-                if D[0]==WKDY:
-                    WKDN=D[1]
-                    break
-            forms += f'''
+            SD = f'{SECO:02d}' if MSEC==0 else f'{SECO:02d}{MSEC:+04d}ms'
+            WKDN=DateString(n[5], n[6], n[7]) or WeekdayLabel(WKDY)
+            yield f'''
 <form action="/edit" method="post" class="form-row">
 <input type="hidden" name="id" value="{IDNO}">
 <button type="submit" name="action" value="change">{USER.DESC_BUTTON_CHANGE}</button>
 <button type="submit" name="action" value="test">{USER.DESC_BUTTON_EXECTEST}</button>
 <input type="checkbox"{ACTV} disabled>
-{WKDN} {HD}:{MD}:{SECO:02d}　{NAME}
+{WKDN} {HD}:{MD}:{SD}　{NAME}
 </form>
 '''
+            i += 1
         if len(DataBase)==0:
-            forms += f'<label>{USER.DESC_TEXT_NOSCHEDULE}</label>'
+            yield f'<label>{USER.DESC_TEXT_NOSCHEDULE}</label>'
 
         DISABLE = ' disabled' if '(_initial_)' in SCENEDIC.keys() or len(SCENEDIC) == 0 else ''
-        forms += f'''
+        yield f'''
 </div><hr><form action="/edit" method="post" class="form-row">
 <input type="hidden" name="id" value="-1">
 <button type="submit" name="action" value="change"{DISABLE}>{USER.DESC_BUTTON_ADDSCHEDULE}</button>
@@ -303,40 +1642,9 @@ async def web_server():
 <button type="submit" name="action" value="delete"{DISABLE}>{USER.DESC_BUTTON_SCENEDELETE}</button>
 </form></body></html>
 '''
-        gc.collect()
-        return forms, 200, html_headers
 
-
-    # Edit schedule (and interface with worker)
-    @app.route('/edit', methods=['POST'])
-    async def _edit(request):
-        global testtime
-        global testscene
-        global adjusttime
-
-        gc.collect()
-        action = request.form.get('action')
-        if action =='test':
-            i = int(request.form.get('id',-1))
-            scenename = DataBase[i][8]
-            testscene = SCENEDIC[scenename]
-            testtime = OffsetUTCtime()+1
-            log(f'Kick test scheduled: {testscene}')
-            return html_backhome, 200, html_headers
-
-        if action == 'adjust':
-            adjusttime = OffsetUTCtime()+1
-            log('Time adjust scheduled.')
-            return html_backhome, 200, html_headers
-
-        if action == 'regist':
-            return html_transregist, 200, html_headers
-
-        if action == 'delete':
-            return html_transdelete, 200, html_headers
-
-        gc.collect()
-        forms = f'''
+    def EditPage(i):
+        yield f'''
 <!DOCTYPE html><html lang="ja"><head><meta charset="UTF-8">
 <title>{TITLE}</title>
 <style> body {{color: #ffffff; background-color: #000000;}}
@@ -347,82 +1655,93 @@ async def web_server():
 <p>{USER.DESC_TEXT_SCHEDULESETTING}</p>
 <div class="form-container">
 '''
-        i = int(request.form.get('id',-1))
-        n = DataBase[i] if i>=0 else ('(noname)',(0,1,2,3,4,5,6),12,0,0,0,0,0,next(iter(SCENEDIC)),True)
+        n = DataBase[i] if i>=0 else ('(noname)',(0,1,2,3,4,5,6),12,0,0,0,0,0,next(iter(SCENEDIC)),True,0)
         itsnew = i==-1
         IDNO=i
-        # (NAME,WEEKDAYS,HOUR,MINUTE,SECOND,YEAR,MONTH,DAY,SCENENAME,ACTIVE)
+        # (NAME,WEEKDAYS,HOUR,MINUTE,SECOND,YEAR,MONTH,DAY,SCENENAME,ACTIVE,MSEC)
         NAME=n[0]
         WKDY=n[1]
         HOUR=n[2]
         MINU=n[3]
         SECO=n[4]
         SNAM=n[8]
+        MSEC=ScheduleMsec(n)
+        DATE=DateString(n[5], n[6], n[7])
         ACTV=' checked' if n[9]==True else ''
-        gc.collect()
 
-        forms += f'''
+        yield f'''
 <form action="/apply" method="post" class="form-row">
 <input type="hidden" name="id" value="{IDNO}">
 <input type="checkbox" name="active" value="1"{ACTV}>
 <input type="text" name="name" value="{NAME}">
 '''
-        temp = '<select name="weekday">'
-        for j in range(len(WDPAT)):
-            sel = ' selected' if WDPAT[j][0]==WKDY else ''
-            temp += f'<option value="{WDPAT[j][0]}"{sel}>{WDPAT[j][1]}</option>'
-        temp += '</select>'
-        forms += temp
-
-        temp = '<select name="hour">'
-        for j in range(-1,24):
-            cap = f'{j}' if j>=0 else '**'
-            sel = ' selected' if j==HOUR else ''
-            temp += f'<option value="{j}"{sel}>{cap}</option>'
-        temp += '</select>'
-        forms += temp
-
-        temp = '<select name="minute">'
-        for j in range(-1,60):
-            cap = f'{j:02d}' if j>=0 else '**'
-            sel = ' selected' if j==MINU else ''
-            temp += f'<option value="{j}"{sel}>{cap}</option>'
-        temp += '</select>'
-        forms += temp
-
-        temp = '<select name="second">'
-        for j in range(60):
-            sel = ' selected' if j==SECO else ''
-            temp += f'<option value="{j}"{sel}>{j:02d}</option>'
-        temp += '</select>'
-        forms += temp
-
-        temp = '<select name="scenename">'
-        for s in SCENEDIC.keys():
-            sel = ' selected' if s==SNAM else ''
-            temp += f'<option value="{s}"{sel}>{s}</option>'
-        temp += '</select>'
-        forms += temp
-
-        del temp
-        temp = None
-        gc.collect()
-        
+        yield '<select name="weekday">'
+        yield from SelectFragment('weekday', WKDY, WeekdayLabel(WKDY))
+        yield '</select><select name="hour">'
+        yield from SelectFragment('hour', HOUR)
+        yield '</select><select name="minute">'
+        yield from SelectFragment('minute', MINU)
+        yield '</select><select name="second">'
+        yield from SelectFragment('second', SECO)
+        yield '</select>'
+        yield f'<input type="number" name="msec" value="{MSEC}" min="-999" max="999" step="10" style="width:5em">ms'
+        yield f'<input type="text" name="date" value="{DATE}" placeholder="YYYY-MM-DD" size="10">'
+        yield '<select name="scenename">'
+        yield from SelectFragment('scene', SNAM)
+        yield '</select>'
+
         if itsnew:
-            forms += f'''
+            yield f'''
 <button type="submit" name="action" value="change">{USER.DESC_BUTTON_APPEND}</button>
 <button type="submit" name="action" value="cancel">{USER.DESC_BUTTON_APPENDCANCEL}</button>
 '''
         else:
-            forms += f'''
+            yield f'''
 <button type="submit" name="action" value="change">{USER.DESC_BUTTON_CHANGE}</button>
 <button type="submit" name="action" value="cancel">{USER.DESC_BUTTON_CHANGECANCEL}</button>
 <button type="submit" name="action" value="delete">{USER.DESC_BUTTON_DELETE}</button>
 '''
-        forms += '</form></div></body></html>'
+        yield '</form></div></body></html>'
 
+    # Log display / select edit schedule
+    @app.route('/')
+    async def _index(request):
         gc.collect()
-        return forms, 200, html_headers
+        return IndexPage(), 200, html_headers
+
+
+    # Edit schedule (and interface with worker)
+    @app.route('/edit', methods=['POST'])
+    async def _edit(request):
+        global testtime
+        global testscene
+        global adjusttime
+
+        gc.collect()
+        action = request.form.get('action')
+        if action =='test':
+            i = int(request.form.get('id',-1))
+            scenename = DataBase[i][8]
+            testscene = SCENEDIC[scenename]
+            testtime = OffsetUTCtime()+1
+            log(f'Kick test scheduled: {testscene}')
+            uasyncio.create_task(PrewarmKick(testscene))
+            WakeEvent.set()
+            return html_backhome, 200, html_headers
+
+        if action == 'adjust':
+            adjusttime = OffsetUTCtime()+1
+            log('Time adjust scheduled.')
+            WakeEvent.set()
+            return html_backhome, 200, html_headers
+
+        if action == 'regist':
+            return html_transregist, 200, html_headers
+
+        if action == 'delete':
+            return html_transdelete, 200, html_headers
+
+        return EditPage(int(request.form.get('id',-1))), 200, html_headers
 
     # Apply edited schedule
     @app.route('/apply', methods=['POST'])
@@ -435,46 +1754,41 @@ async def web_server():
 
         if action == 'delete':
             if id >= 0:
-                del DataBase[id]
-                SaveDataBase()
+                DeleteSchedule(id)
+                ScheduleChanged()
             return html_backhome, 200, html_headers
 
-        # (NAME,WEEKDAYS,HOUR,MINUTE,SECOND,YEAR,MONTH,DAY,SCENENAME,ACTIVE)
-        if id == -1:
-            DataBase.append(('(empty)',(-1,),0,0,0,0,0,0,'',True))
-            id = len(DataBase)-1
-
-        L = list(DataBase[id])
+        # (NAME,WEEKDAYS,HOUR,MINUTE,SECOND,YEAR,MONTH,DAY,SCENENAME,ACTIVE,MSEC)
+        L = list(DataBase[id] if id >= 0 else ('(empty)',(-1,),0,0,0,0,0,0,'',True,0))
+        if len(L)<11:
+            L.append(0)
         L[0] = request.form.get('name','(noname)')
-        L[1] = eval(request.form.get('weekday','(0,1,2,3,4,5,6)'))
-        L[2] = int(request.form.get('hour',12))
-        L[3] = int(request.form.get('minute',0))
-        L[4] = int(request.form.get('second',0))
+        try:
+            L[1] = ParseWeekdays(request.form.get('weekday','(0,1,2,3,4,5,6)'))
+            L[2] = int(request.form.get('hour',12))
+            L[3] = int(request.form.get('minute',0))
+            L[4] = int(request.form.get('second',0))
+            L[10] = min(max(int(request.form.get('msec',0)), -999), 999)
+            L[5], L[6], L[7] = ParseDate(request.form.get('date','').strip())
+        except ValueError:
+            log('Invalid schedule form.', level=LOG_WARN)
+            return html_backhome, 200, html_headers
         L[8] = request.form.get('scenename','')
         L[9] = request.form.get('active','0')=='1'
-        DataBase[id] = tuple(L)
+        if id == -1:
+            DataBase.append(tuple(L))
+            id = len(DataBase)-1
+        else:
+            DataBase[id] = tuple(L)
         print(f'Update DataBase: {id} {DataBase[id]}')
-        SaveDataBase()
+        PutSchedule(id)
+        ScheduleChanged()
         gc.collect()
         return html_backhome, 200, html_headers
 
 
-    # Select Switchbot scenes to regist
-    @app.route('/regist')
-    async def _regist(request):
-        global parsed_scenes
-        if parsed_scenes==None:
-            jsontext = await RetrieveScenes()
-            if jsontext=='':
-                log('Retrieve scenes failed.')
-                return html_backhome, 200, html_headers
-            parsed_json = ujson.loads(jsontext)
-            parsed_scenes = {}
-            for S in parsed_json['body']:
-                parsed_scenes[S['sceneName']] = S['sceneId']
-            del parsed_json
-
-        forms = f'''
+    def RegistPage():
+        yield f'''
 <!DOCTYPE html><html lang="ja"><head><meta charset="UTF-8">
 <title>{TITLE}</title>
 <style> body {{color: #ffffff; background-color: #000000;}}
@@ -485,48 +1799,56 @@ async def web_server():
 <p>{USER.DESC_TEXT_REGISTSCENES}</p>
 <form action="/regapply" method="post">
 '''
+        registered = set(SCENEDIC.values())
         idx = 0
-        for S in parsed_scenes.keys():
-            gc.collect()
-            sceneId = parsed_scenes[S]
-            if not sceneId in SCENEDIC.values():
-                forms += f'''
+        for S, sceneId in CatalogScenes():
+            if not sceneId in registered:
+                yield f'''
 <div>
+{sceneId.rpartition(':')[0]}
 <input type="checkbox" name="active" value="{idx}">
 <input type="text" name="caption" value="{S}">
 <input type="hidden" name="sID" value="{sceneId}">
 </div>
 '''
                 idx += 1
-                gc.collect
-
-        forms += f'''
+        yield f'''
 <hr><div>
 <button type="submit">{USER.DESC_BUTTON_REGIST}</button>
 <button type="submit" name="action" value="cancel">{USER.DESC_BUTTON_REGISTCANCEL}</button>
 </div></form></body></html>
 '''
+
+    # Select Switchbot scenes to regist (from the flash catalog, refreshed in the background)
+    @app.route('/regist')
+    async def _regist(request):
         gc.collect()
-        return forms, 200, html_headers
-        
+        for acct in Accounts.values():
+            age = CatalogAge(acct)
+            if age < 0:
+                if not await RefreshCatalog(acct):
+                    return html_backhome, 200, html_headers
+            elif age >= USER.SCENE_CACHE_TTL or request.args.get('refresh'):
+                uasyncio.create_task(RefreshCatalog(acct))
+        return RegistPage(), 200, html_headers
+
     # Regist selected Switchbot scenes
     @app.route('/regapply', methods=['POST'])
     async def _regapply(request):
-        global parsed_scenes
         if request.form.get('action')!='cancel':
             actives  = request.form.getlist('active')
             captions = request.form.getlist('caption')
             sIDs = request.form.getlist('sID')
+            ops = []
             if '(_initial_)' in SCENEDIC.keys():
                 SCENEDIC.clear()
+                ops.append(['clr'])
             for ID in actives:
                 id = int(ID)
                 SCENEDIC[captions[id]] = sIDs[id]
+                ops.append(['put', captions[id], sIDs[id]])
                 print(f'SCENEDIC add:("{captions[id]}":"{sIDs[id]}")')
-            SaveSceneDic()
-
-        del parsed_scenes
-        parsed_scenes = None
+            JournalSceneDic(ops)
         gc.collect()
         return html_backhome, 200, html_headers
 
@@ -567,38 +1889,436 @@ async def web_server():
     async def _delapply(request):
         if request.form.get('action')!='cancel':
             deletes = request.form.getlist('delete')
+            ops = []
             for caption in deletes:
                 if caption in SCENEDIC:
                     del SCENEDIC[caption]
+                    ops.append(['del', caption])
                     print(f'SCENEDIC delete: "{caption}"')
-            SaveSceneDic()
+            JournalSceneDic(ops)
         return html_backhome, 200, html_headers
 
+    # Runtime metrics: Prometheus text, or JSON with ?format=json
+    @app.route('/metrics')
+    async def _metrics(request):
+        if request.args.get('format')=='json':
+            return ujson.dumps(MetricsDict()), 200, {'Content-Type': 'application/json'}
+        return MetricsText(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+    # JSON API for bulk import/export. PUT replaces the whole list, PATCH applies
+    # a batch of changes. Every batch is validated first and saved in one write.
+    json_headers = {'Content-Type': 'application/json'}
+    Request.max_content_length = USER.API_BODY_MAX
+    Request.max_body_length = USER.API_BODY_MAX
+
+    def JSONError(msg, status=400):
+        return ujson.dumps({'error': msg}), status, json_headers
+
+    def SchedulesJSON():
+        yield '['
+        for i, S in enumerate(DataBase):
+            yield (',' if i else '') + ujson.dumps(ScheduleJSON(S))
+        yield ']'
+
+    def ScenesJSON():
+        yield '{'
+        sep = ''
+        for caption, sceneId in SCENEDIC.items():
+            if caption != '(_initial_)':
+                yield f'{sep}{ujson.dumps(caption)}:{ujson.dumps(sceneId)}'
+                sep = ','
+        yield '}'
+
+    @app.route('/api/schedules', methods=['GET', 'PUT', 'PATCH'])
+    async def _api_schedules(request):
+        if request.method == 'GET':
+            return SchedulesJSON(), 200, json_headers
+        try:
+            body = request.json
+            if request.method == 'PUT':
+                # [schedule, ...]
+                if not isinstance(body, list):
+                    raise ValueError('expected a list')
+                records = [ScheduleFromJSON(o, scenes=SCENEDIC) for o in body]
+            else:
+                # [{"id": n, ...changes}, {"id": n, "delete": true}, {...new schedule}]
+                if not isinstance(body, list):
+                    raise ValueError('expected a list')
+                records = list(DataBase)
+                deletes = set()
+                for o in body:
+                    i = o.get('id') if isinstance(o, dict) else None
+                    if i is None:
+                        records.append(ScheduleFromJSON(o, scenes=SCENEDIC))
+                        continue
+                    # JSON true is a bool, which is an int in Python
+                    if type(i) is not int or i<0 or i>=len(DataBase):
+                        raise ValueError(f'no schedule {i}')
+                    if o.get('delete'):
+                        deletes.add(i)
+                    else:
+                        records[i] = ScheduleFromJSON({k: v for k, v in o.items() if k != 'id'}, records[i], SCENEDIC)
+                records = [S for i, S in enumerate(records) if i not in deletes]
+        except (ValueError, TypeError) as e:
+            return JSONError(str(e))
+        DataBase[:] = records
+        SaveDataBase()
+        ScheduleChanged()
+        gc.collect()
+        return SchedulesJSON(), 200, json_headers
+
+    # ["YYYY-MM-DD" or "MM-DD", ...] skipped by schedules with weekday 7
+    @app.route('/api/skipdates', methods=['GET', 'PUT'])
+    async def _api_skipdates(request):
+        if request.method == 'PUT':
+            try:
+                body = request.json
+                if not isinstance(body, list):
+                    raise ValueError('expected a list')
+                dates = [ParseDate(v) for v in body if v]
+            except (ValueError, TypeError) as e:
+                return JSONError(str(e))
+            SkipDates[:] = dates
+            SaveSkipDates()
+            ScheduleChanged()
+        return ujson.dumps([DateString(*d) for d in SkipDates]), 200, json_headers
+
+    @app.route('/api/scenes', methods=['GET', 'PUT', 'PATCH'])
+    async def _api_scenes(request):
+        if request.method == 'GET':
+            return ScenesJSON(), 200, json_headers
+        # {"caption": "sceneId", ...}; PATCH deletes captions mapped to null
+        try:
+            body = request.json
+        except ValueError:
+            body = None
+        if not isinstance(body, dict):
+            return JSONError('expected an object')
+        for caption, sceneId in body.items():
+            if not caption or not ((isinstance(sceneId, str) and SceneAccount(sceneId)[0]) or (sceneId is None and request.method == 'PATCH')):
+                return JSONError(f'invalid scene {caption}')
+        if request.method == 'PUT' or '(_initial_)' in SCENEDIC:
+            SCENEDIC.clear()
+        for caption, sceneId in body.items():
+            if sceneId is None:
+                if caption in SCENEDIC:
+                    del SCENEDIC[caption]
+            else:
+                SCENEDIC[caption] = sceneId
+        SaveSceneDic()
+        gc.collect()
+        return ScenesJSON(), 200, json_headers
+
     log('Start Web server.')
-    await app.run(port=80)
+    BootPhase('web')
+    await app.run(port=WEB_PORT)
 
 async def web():
     await web_server()
 
 
-async def checkScheduleAndKick(dtime):
-    for S in DataBase:
-        # S = (NAME,WEEKDAYS,HOUR,MINUTE,SECOND,YEAR,MONTH,DAY,SCENENAME,ACTIVE)
-        # Check schedule active and weekdays
-        if S[9] and dtime[6] in S[1]:
-            # Hour?
-            if S[2]<0 or dtime[3]==S[2]:
-                # Minute?
-                if S[3]<0 or dtime[4]==S[3]:
-                    # Second?
-                    if dtime[5]==S[4]:
-                        scenename = S[8]
-                        if scenename in SCENEDIC:
-                            await ExecuteScene(SCENEDIC[scenename])
-                        else:
-                            log(f'Scene name "{scenename}" does not found.')
+# Next fire index: min-heap of (KICKTIME, DataBase index, FIRETIME) in local ms.
+# KICKTIME is FIRETIME moved earlier by the scene's API latency when USER.KICK_EARLY.
+FireHeap = []
+WakeEvent = uasyncio.Event()
+# Local ms at which the next FireHeap entry comes within USER.PREWARM_SECONDS
+PrewarmAt = 0
+
+def NextFireOnDay(i, lb):
+    # Earliest second-of-day >= lb matching HOUR/MINUTE/SECOND of schedule i, or -1
+    H = DataBase.hour[i]
+    M = DataBase.minute[i]
+    S = DataBase.second[i]
+    for h in ((H,) if H>=0 else range(lb//3600, 24)):
+        base = h*3600 + S
+        if M>=0:
+            t = base + M*60
+            if t>=lb:
+                return t
+        else:
+            m = 0 if base>=lb else (lb-base+59)//60
+            if m<60:
+                return base + m*60
+    return -1
+
+# Per-day firing table: DayTable[i] is 1 when schedule i fires on TableDay.
+# Built once a day (and on changes), so weekdays, dates and skip dates are
+# not re-evaluated for every fire.
+TableDay = -1
+DayTable = bytearray()
+
+def ScheduleOnDay(i, day, lt):
+    # lt = utime.localtime() of the day
+    m = DataBase.wmask[i]
+    if not m & ScheduleTable.ACTIVE:
+        return 0
+    if DataBase.month[i]:
+        return DataBase.month[i]==lt[1] and DataBase.day[i]==lt[2] and DataBase.year[i] in (0, lt[0])
+    if m & ScheduleTable.SKIP and day in SkipDays:
+        return 0
+    return m>>lt[6] & 1
+
+def BuildDayTable(day):
+    global TableDay, DayTable
+    lt = utime.localtime(day*86400)
+    if lt[0] != SkipYear:
+        CompileSkipDays(lt[0])
+    TableDay = day
+    DayTable = bytearray(ScheduleOnDay(i, day, lt) for i in range(len(DataBase)))
+
+def DayFires(i, day):
+    if day == TableDay:
+        return DayTable[i]
+    return ScheduleOnDay(i, day, utime.localtime(day*86400))
+
+def NextDateDay(i, day):
+    # First local day number >= day on the date of dated schedule i, or -1
+    Y = DataBase.year[i]
+    y0 = utime.localtime(day*86400)[0]
+    for y in ((Y,) if Y else range(y0, y0+9)):
+        d = DateDay(y, DataBase.month[i], DataBase.day[i])
+        if d >= day:
+            return d
+    return -1
+
+def NextFireTime(i, after):
+    if not DataBase.wmask[i] & ScheduleTable.ACTIVE:
+        return -1
+    day = after//86400
+    for d in range(8):
+        if DayFires(i, day+d):
+            lb = after%86400+1 if d==0 else 0
+            if lb<86400:
+                t = NextFireOnDay(i, lb)
+                if t>=0:
+                    return (day+d)*86400 + t
+    if DataBase.month[i]:
+        d = NextDateDay(i, day+8)
+        if d >= 0:
+            return d*86400 + NextFireOnDay(i, 0)
+    return -1
+
+def NextFireMs(i, after):
+    m = DataBase.msec[i]
+    t = NextFireTime(i, (after-m)//1000)
+    return t*1000+m if t>=0 else -1
+
+def RebuildFireIndex(after):
+    # Never before a fire already dispatched (KICK_EARLY fires ahead of FIRETIME)
+    global PrewarmAt
+    PrewarmAt = 0
+    FireHeap.clear()
+    fired = DataBase.fired
+    for i in range(len(DataBase)):
+        t = NextFireMs(i, max(after, fired[i]*1000+999))
+        if t>=0:
+            FireHeap.append((t-KickLead(i), i, t))
+    heapq.heapify(FireHeap)
+
+def PurgeOneShots(day):
+    # Remove one-shot schedules whose date has passed
+    n = len(DataBase)
+    i = n-1
+    while i >= 0:
+        if DataBase.year[i] and DataBase.month[i]:
+            d = DateDay(DataBase.year[i], DataBase.month[i], DataBase.day[i])
+            if d < day:
+                log('One-shot "%s" expired.', args=(DataBase.name[i],))
+                del DataBase[i]
+        i -= 1
+    if len(DataBase) != n:
+        SaveDataBase()
+
+# High-water mark: local ms up to which fire times have been evaluated. The index is
+# rebuilt from there, so fires skipped by a stalled loop, a clock step or a reboot
+# are caught up if they are at most USER.CATCHUP_GRACE_SECONDS late.
+HighWater = 0
+HwmFileName = 'SwBotKicker.hwm'
+HwmSavedAt = 0
+HwmDirty = False
+CATCHUP_FIRED = 0
+CATCHUP_MISSED = 1
+CATCHUP_SUPERSEDED = 2
+CatchupCounts = array('i', [0, 0, 0])
+
+def SetupHighWater():
+    global HighWater
+    for v in ReadJSONLines(HwmFileName):
+        HighWater = v
+    if HighWater:
+        log('Catch up from %s', args=(DatetimeString(HighWater//1000),))
+
+def SaveHighWater():
+    global HwmSavedAt, HwmDirty
+    WriteAtomic(HwmFileName, (HighWater,))
+    HwmSavedAt = HighWater
+    HwmDirty = False
+
+def FireFrom():
+    return max(HighWater, LocalMs() - USER.CATCHUP_GRACE_SECONDS*1000)
+
+def DayChanged(day):
+    PurgeOneShots(day)
+    BuildDayTable(day)
+    RebuildFireIndex(FireFrom())
+    WakeEvent.set()
+
+def ScheduleChanged():
+    if TableDay >= 0:
+        BuildDayTable(TableDay)
+    RebuildFireIndex(FireFrom())
+    WakeEvent.set()
+
+def PrewarmKicks(now):
+    # Requests and connections, per account, for every kick due within USER.PREWARM_SECONDS
+    global PrewarmAt
+    horizon = now + USER.PREWARM_SECONDS*1000
+    counts = {}
+    later = -1
+    # Heap order: below an entry past the horizon there are only later ones, so the walk
+    # visits the entries within it and their children, not the whole heap
+    stack = [0]
+    while stack:
+        j = stack.pop()
+        if j >= len(FireHeap):
+            continue
+        k, i, t = FireHeap[j]
+        if k > horizon:
+            if later < 0 or k < later:
+                later = k
+            continue
+        stack.append(2*j+1)
+        stack.append(2*j+2)
+        acct, sceneId = SceneAccount(SCENEDIC.get(DataBase.SceneName(i), ''))
+        if acct and sceneId:
+            KickRequest(TagScene(acct.name, sceneId))
+            counts[acct] = counts.get(acct, 0) + 1
+    for acct, n in counts.items():
+        uasyncio.create_task(PrewarmAccount(acct, n))
+    PrewarmAt = later - USER.PREWARM_SECONDS*1000 if later >= 0 else horizon + 86400000
+
+def checkScheduleAndKick(now):
+    global HighWater, PrewarmAt, HwmDirty
+    fired = False
+    while FireHeap and FireHeap[0][0]<=now:
+        k, i, t = heapq.heappop(FireHeap)
+        DataBase.fired[i] = t//1000
+        nt = NextFireMs(i, t)
+        if nt>=0:
+            heapq.heappush(FireHeap, (nt-KickLead(i), i, nt))
+            PrewarmAt = min(PrewarmAt, nt-KickLead(i)-USER.PREWARM_SECONDS*1000)
+        if nt>=0 and nt-KickLead(i)<=now:
+            # Several occurrences fell into a gap: only the latest one runs
+            CatchupCounts[CATCHUP_SUPERSEDED] += 1
+            continue
+        if now-t > USER.CATCHUP_GRACE_SECONDS*1000:
+            CatchupCounts[CATCHUP_MISSED] += 1
+            log('Missed "%s" by %ds', args=(DataBase.name[i], (now-t)//1000), level=LOG_WARN)
+            continue
+        if now-k > 1000:
+            CatchupCounts[CATCHUP_FIRED] += 1
+            log('Catch up "%s" late %dms', args=(DataBase.name[i], now-k), level=LOG_WARN)
+        else:
+            log('Fire "%s" late %dms lead %dms', False, (DataBase.name[i], now-k, t-k))
+        fired = True
+        scenename = DataBase.SceneName(i)
+        if scenename in SCENEDIC:
+            DispatchKick(SCENEDIC[scenename], t)
+        else:
+            log('Scene name "%s" does not found.', args=(scenename,), level=LOG_WARN)
+    # Not up to the FIRETIME of an early kick: other schedules may still be due before it.
+    # Every entry left in FireHeap has KICKTIME > now, so no FIRETIME in it is passed over.
+    # DataBase.fired keeps a rebuild from arming the early kick again.
+    HighWater = max(HighWater, now)
+    # After a fire it is saved with the clock, see the worker. A reboot before that
+    # may repeat the kicks of the last USER.CLOCK_SAVE_SECONDS.
+    if HighWater-HwmSavedAt >= USER.HWM_SAVE_SECONDS*1000:
+        SaveHighWater()
+    if fired:
+        HwmDirty = True
+        PeerNotify()
+
+# Bounded kick executor: at most USER.KICK_PARALLEL ExecuteScene() calls in flight per account,
+# so a burst on one account neither waits for nor blocks another. Retries get one slot less
+# and queue behind on-time kicks.
+KickTasks = []
+KICK_PENDING_MAX = 32
+
+# Failed kicks waiting for another attempt: heap of (due local ms, attempt, SCENE_ID, scheduled local ms, quota class)
+RetryQueue = []
+RETRY_SCHEDULED = 0
+RETRY_SUCCEEDED = 1
+RETRY_GAVEUP = 2
+RetryCounts = array('i', [0, 0, 0])
+
+def DispatchKick(SCENE_ID, due, attempt=0, prio=QUOTA_SCHEDULED):
+    # Scenes of an unknown account fail fast in ExecuteScene(); they take a default account slot
+    acct = SceneAccount(SCENE_ID)[0] or Accounts['']
+    limit = USER.KICK_PARALLEL
+    if attempt:
+        limit = max(1, limit-1)
+    if acct.running < limit:
+        acct.running += 1
+        KickTasks[:] = [k for k in KickTasks if not k.done()]
+        KickTasks.append(uasyncio.create_task(KickTask(acct, SCENE_ID, due, attempt, prio)))
+    elif len(acct.pending) < KICK_PENDING_MAX:
+        item = (SCENE_ID, due, attempt, prio)
+        if attempt==0:
+            i = 0
+            while i < len(acct.pending) and acct.pending[i][2]==0:
+                i += 1
+            acct.pending.insert(i, item)
+        else:
+            acct.pending.append(item)
+    else:
+        log('Kick queue full, scene %s dropped.', args=(SCENE_ID,), level=LOG_ERROR)
+
+def ScheduleRetry(SCENE_ID, due, attempt, prio):
+    # Exponential backoff with jitter, given up after RETRY_ATTEMPTS or RETRY_GIVEUP_SECONDS
+    delay = USER.RETRY_BASE_MS << attempt
+    delay += random.getrandbits(16) % (delay//2+1)
+    at = LocalMs() + delay
+    if attempt >= USER.RETRY_ATTEMPTS or at > due + USER.RETRY_GIVEUP_SECONDS*1000 or len(RetryQueue) >= USER.RETRY_QUEUE_MAX:
+        RetryCounts[RETRY_GAVEUP] += 1
+        log('Give up scene %s after %d attempts.', args=(SCENE_ID, attempt+1), level=LOG_ERROR)
+        return
+    RetryCounts[RETRY_SCHEDULED] += 1
+    heapq.heappush(RetryQueue, (at, attempt+1, SCENE_ID, due, max(prio, QUOTA_RETRY)))
+    log('Retry scene %s in %dms.', args=(SCENE_ID, delay), level=LOG_WARN)
+    WakeEvent.set()
+
+def DispatchRetries(now):
+    while RetryQueue and RetryQueue[0][0]<=now:
+        at, attempt, SCENE_ID, due, prio = heapq.heappop(RetryQueue)
+        DispatchKick(SCENE_ID, due, attempt, prio)
+
+async def KickTask(acct, SCENE_ID, due, attempt, prio):
+    while True:
+        start = utime.ticks_ms()
+        if attempt==0:
+            Observe(HIST_KICK_DISPATCH, LocalMs()-due)
+        try:
+            ok = await ExecuteScene(SCENE_ID, prio)
+        except Exception as e:
+            ok = False
+            CountStatus(None)
+            log('Execute scene %s failed: %s', args=(SCENE_ID, LogRepr(e)), level=LOG_ERROR)
+        Observe(HIST_KICK_API, utime.ticks_diff(utime.ticks_ms(), start))
+        if ok:
+            Observe(HIST_KICK_TOTAL, LocalMs()-due)
+            if attempt:
+                RetryCounts[RETRY_SUCCEEDED] += 1
+                log('Scene %s succeeded on retry %d.', args=(SCENE_ID, attempt))
+        elif ok is False:
+            ScheduleRetry(SCENE_ID, due, attempt, prio)
+        if not acct.pending:
+            break
+        SCENE_ID, due, attempt, prio = acct.pending.pop(0)
+    acct.running -= 1
+    gc.collect()
 
 wdt = None
+WDT_FEED_INTERVAL = 4
 def WDTstart():
     global wdt
     wdt = machine.WDT(timeout=8000)
@@ -608,49 +2328,106 @@ def WDTfeed():
     if wdt!=None:
         wdt.feed()
 
+async def WaitDeadline(deadline):
+    # Sleep until deadline in local ms (or WakeEvent). Coarse mode polls the last second instead.
+    wait = deadline - LocalMs()
+    if not USER.SCHED_PRECISE:
+        wait = wait-1000 if wait>1000 else 100
+    wait = min(max(wait, 0), WDT_FEED_INTERVAL*1000)
+    target = LocalMs()+wait
+    try:
+        await uasyncio.wait_for(WakeEvent.wait(), wait/1000)
+    except uasyncio.TimeoutError:
+        Observe(HIST_LOOP_LAG, LocalMs()-target)
+
+AdjustTasks = []
+async def TimeAdjustTask():
+    global adjusttime
+    try:
+        ok = await AdjustTime()
+    except Exception as e:
+        log('Adjust RTC failed: %s', args=(LogRepr(e),), level=LOG_WARN)
+        ok = 0
+    if ok==0:
+        adjusttime = OffsetUTCtime()+5*60
+    else:
+        adjusttime = OffsetUTCtime()+NTPInterval
+    ScheduleChanged()
+
 async def worker():
     global testtime
     global testscene
     global adjusttime
+    global HighWater
 
     log('Start Worker.')
     nowtime = OffsetUTCtime()
-    adjusttime = nowtime+12*3600
+    adjusttime = nowtime+NTPInterval
     activetime = nowtime+1
-    execNow = -1
+    ready = False
+    DayChanged(LocalMs()//86400000)
 
     WDTstart()
     WDTfeed()
     while True:
         #ledon()
+        WakeEvent.clear()
         rtime = OffsetUTCtime()
-        dtime = utime.localtime(rtime)
-        gc.collect()
-        if execNow != dtime[5]:
-            execNow = dtime[5]
-
-            # Active Sense
-            if rtime>=activetime:
-                logActive()
-                activetime = OffsetUTCtime()+10
-
-            # Kick Test
-            if rtime==testtime:
-                await ExecuteScene(testscene)
-                log('Kick test executed.')
-
-            await checkScheduleAndKick(dtime)
-                                    
-            # Time Adjust
-            if rtime>=adjusttime:
-                if AdjustTime()==0:
-                    adjusttime = OffsetUTCtime()+5*60
-                else:
-                    adjusttime = OffsetUTCtime()+12*3600
+
+        # Active Sense
+        if rtime>=activetime:
+            logActive()
+            activetime = rtime+10
+
+        # Kick Test
+        if testtime and rtime>=testtime:
+            DispatchKick(testscene, testtime*1000, prio=QUOTA_MANUAL)
+            testtime = 0
+            log('Kick test dispatched.')
+
+        # A standby only follows the leader's HighWater, see Elect()
+        now = LocalMs()
+        if not ready and NetworkReady and ClockTrusted():
+            ready = True
+            BootPhase('ready')
+            if not HighWater:
+                # First start: nothing to catch up
+                HighWater = now
+                ScheduleChanged()
+        active = ready and Leader and ClockTrusted()
+        if active:
+            checkScheduleAndKick(now)
+            if RetryQueue and RetryQueue[0][0]<=now:
+                DispatchRetries(now)
+        if now//86400000 != TableDay:
+            DayChanged(now//86400000)
+
+        # Connection prewarm for the upcoming kicks
+        if active and FireHeap and PrewarmAt<=now:
+            PrewarmKicks(now)
+
+        # Time Adjust
+        if rtime>=adjusttime:
+            adjusttime = rtime+24*3600
+            AdjustTasks[:] = [uasyncio.create_task(TimeAdjustTask())]
+
+        if ready and NowMs()-ClockSavedAt >= USER.CLOCK_SAVE_SECONDS*1000:
+            SaveClock()
+            if HwmDirty:
+                SaveHighWater()
 
         #ledoff()
+        SampleMemory()
+        LogFlush()
         WDTfeed()
-        await uasyncio.sleep(0.2)
+        deadline = min(min(activetime, adjusttime)*1000, (TableDay+1)*86400000)
+        if testtime:
+            deadline = min(deadline, testtime*1000)
+        if active and RetryQueue:
+            deadline = min(deadline, RetryQueue[0][0])
+        if active and FireHeap:
+            deadline = min(deadline, FireHeap[0][0], PrewarmAt)
+        await WaitDeadline(deadline)
 
 
 async def mDNS():
@@ -661,6 +2438,46 @@ async def mDNS():
 def inet_aton(ip_str):
     return bytes(map(int, ip_str.split('.')))
 
+def MulticastSocket(group, port):
+    # Non-blocking UDP socket joined to a multicast group
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', port))
+    mreq = struct.pack('4sl', inet_aton(group), 0)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    sock.setblocking(False)
+    return sock
+
+def MDNSQuestionMatches(data, qname):
+    # True if data is a query asking A/ANY of qname (lowercase wire-format name)
+    if len(data)<12 or data[2]&0x80:
+        return False
+    p = 12
+    for q in range((data[4]<<8)|data[5]):
+        name = b''
+        end = -1
+        jumps = 0
+        while p<len(data) and data[p]:
+            n = data[p]
+            if n>=0xC0:
+                if end<0:
+                    end = p+2
+                p = ((n&0x3F)<<8)|data[p+1]
+                jumps += 1
+                if jumps>8:
+                    return False
+                continue
+            name += bytes((n,)) + data[p+1:p+1+n].lower()
+            p += n+1
+        p = end if end>=0 else p+1
+        if p+4>len(data):
+            return False
+        qtype, qclass = struct.unpack_from('!HH', data, p)
+        p += 4
+        if name+b'\x00'==qname and qtype in (1, 255) and qclass&0x7FFF==1:
+            return True
+    return False
+
 async def mDNSresponder():
     MDNS_GROUP = '224.0.0.251'
     MDNS_PORT = 5353
@@ -669,64 +2486,240 @@ async def mDNSresponder():
 
     namelen = len(MDNS_HOSTNAME)
     namebytes = bytes(MDNS_HOSTNAME,'utf-8')
+    qname = bytes((namelen,)) + namebytes.lower() + b'\x05local\x00'
 
-    response_base = struct.pack(f'!HHHHHHB{namelen}s7sHHLH',0,0x8400,0,1,0,0,namelen,namebytes,'\x05local\x00',1,1,MDNS_TTL,4)
+    response_base = struct.pack(f'!HHHHHHB{namelen}s7sHHLH',0,0x8400,0,1,0,0,namelen,namebytes,b'\x05local\x00',1,1,MDNS_TTL,4)
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     try:
-        sock.bind(('', MDNS_PORT))
+        sock = MulticastSocket(MDNS_GROUP, MDNS_PORT)
     except Exception:
         # log('Start mDNS responder failure... (optional)')
         return
-    mreq = struct.pack('4sl', inet_aton(MDNS_GROUP), 0)
-    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    sreader = uasyncio.StreamReader(sock)
+
+    wlan = network.WLAN(network.STA_IF)
+    ipadrs = ''
+    response_packet = b''
+    checked = utime.ticks_add(utime.ticks_ms(), -60000)
+    answered = checked
 
     log(f'Start mDNS responder - {MDNS_HOSTNAME}.local')
     while True:
-        await uasyncio.sleep(0.01)
-        rlist, _, _ = select.select([sock], [], [], 0)
-        if not rlist: continue
+        # Woken by the uasyncio poller only when a packet arrives
+        data = await sreader.read(1024)
+        #print(f'Received mDNS query: {data.hex()}')
+        if not data or not MDNSQuestionMatches(data, qname):
+            continue
+
+        now = utime.ticks_ms()
+        if utime.ticks_diff(now, answered) < 1000:
+            continue
+        if utime.ticks_diff(now, checked) >= 30000:
+            checked = now
+            ip = wlan.ifconfig()[0]
+            if ip != ipadrs:
+                ipadrs = ip
+                response_packet = response_base + inet_aton(ipadrs)
+        answered = now
+        #print("Sending mDNS response...")
+        sock.sendto(response_packet, (MDNS_GROUP, MDNS_PORT))
+        sock.sendto(response_packet, (MDNS_GROUP, MDNS_PORT))
+        #print(f'mDNS response sent: {response_packet.hex()}')
+
+
+# Active/standby kickers on one LAN. Every kicker multicasts a heartbeat every
+# USER.PEER_HEARTBEAT_MS; the live kicker with the highest (PEER_PRIORITY, HOSTNAME)
+# leads and is the only one that fires. A leader keeps its role until it goes
+# silent for USER.PEER_TIMEOUT_MS, so a kicker coming back does not preempt it.
+Leader = not USER.PEER_ENABLE
+# Peer HOSTNAME: [ticks_ms last heard, last heartbeat]
+Peers = {}
+PeerWake = uasyncio.Event()
+PeerPulling = False
+PeerReady = False
+WEB_PORT = 80
+PEER_RETRY_SECONDS = 10
+
+def PeerKey(hb):
+    return (hb['pri'], hb['id'])
+
+def Heartbeat(ip):
+    # The leader's HighWater lets a standby catch up on the kicks of the gap when it takes over
+    return ujson.dumps({'id': USER.HOSTNAME, 'pri': USER.PEER_PRIORITY, 'lead': Leader,
+                        'hw': HighWater, 'st': StoreStamp, 'ip': ip, 'port': WEB_PORT}).encode()
+
+def Elect():
+    global Leader
+    now = utime.ticks_ms()
+    for k in list(Peers):
+        if utime.ticks_diff(now, Peers[k][0]) > USER.PEER_TIMEOUT_MS:
+            del Peers[k]
+            log('Peer %s lost.', args=(k,), level=LOG_WARN)
+    if not PeerReady:
+        return
+    mine = (USER.PEER_PRIORITY, USER.HOSTNAME)
+    claims = [PeerKey(hb) for t, hb in Peers.values() if hb['lead']]
+    if Leader:
+        lead = not claims or max(claims) < mine
+    else:
+        lead = not claims and all(PeerKey(hb) < mine for t, hb in Peers.values())
+    if lead == Leader:
+        return
+    Leader = lead
+    if lead:
+        log('Leader now, catching up from %s.', args=(DatetimeString(HighWater//1000),), level=LOG_WARN)
+        ScheduleChanged()
+    else:
+        log('Standby, leader is %s.', args=(max(claims)[1],), level=LOG_WARN)
+        WakeEvent.set()
+
+def PeerHeard(hb):
+    global HighWater, PeerPulling
+    if hb['id'] == USER.HOSTNAME:
+        return
+    if hb['id'] not in Peers:
+        log('Peer %s joined.', args=(hb['id'],))
+    Peers[hb['id']] = [utime.ticks_ms(), hb]
+    if hb['lead'] and not Leader:
+        HighWater = max(HighWater, hb['hw'])
+    if hb['st'] > StoreStamp and not PeerPulling:
+        PeerPulling = True
+        uasyncio.create_task(PullStore(hb))
+    Elect()
+
+async def PullStore(hb):
+    # Copies schedules, scenes and skip dates from a peer with a newer store through its JSON API
+    global PeerPulling
+    client = APIClient(hb['ip'], {}, port=hb['port'], ssl=False, poolsize=0, timeout=USER.API_TIMEOUT)
+    try:
+        data = []
+        for path in ('/api/scenes', '/api/schedules', '/api/skipdates'):
+            status, body = await client.Request('GET', path)
+            if status != 200:
+                raise OSError(f'{path}: {status}')
+            data.append(ujson.loads(body))
+        records = [ScheduleFromJSON(o) for o in data[1]]
+        dates = [ParseDate(v) for v in data[2] if v]
+    except Exception as e:
+        log('Copy from %s failed: %s', args=(hb['id'], LogRepr(e)), level=LOG_WARN)
+        return
+    finally:
+        PeerPulling = False
+    SCENEDIC.clear()
+    SCENEDIC.update(data[0])
+    # The copy keeps the peer's stamp, so it is not copied back
+    SaveSceneDic(hb['st'])
+    DataBase[:] = records
+    SaveDataBase(hb['st'])
+    SkipDates[:] = dates
+    SaveSkipDates(hb['st'])
+    ScheduleChanged()
+    log('Schedules copied from %s.', args=(hb['id'],))
+    gc.collect()
 
-        data, addr = sock.recvfrom(1024)
-        #print(f'Received mDNS query from {addr}: {data.hex()}')
+def PeerNotify():
+    # Heartbeat now, e.g. right after a kick so the standbys' HighWater follows
+    if USER.PEER_ENABLE:
+        PeerWake.set()
+
+async def PeerTask():
+    global PeerReady, Leader
+    sock = None
+    while sock is None:
+        try:
+            sock = MulticastSocket(USER.PEER_GROUP, USER.PEER_PORT)
+        except Exception as e:
+            # No peer can be heard, so none may be leading: fire alone until the socket opens
+            if not Leader:
+                Leader = True
+                log('Start peer failure, leading alone: %s', args=(LogRepr(e),), level=LOG_ERROR)
+                ScheduleChanged()
+            await uasyncio.sleep(PEER_RETRY_SECONDS)
+    sreader = uasyncio.StreamReader(sock)
+    wlan = network.WLAN(network.STA_IF)
 
-        if namebytes in data:
-            ipadrs = network.WLAN(network.STA_IF).ifconfig()[0]
-            response_packet = response_base + inet_aton(ipadrs)
-            #print("Sending mDNS response...")
-            sock.sendto(response_packet, (MDNS_GROUP, MDNS_PORT))
-            sock.sendto(response_packet, (MDNS_GROUP, MDNS_PORT))
-            #print(f'mDNS response sent: {response_packet.hex()}')
+    async def Receive():
+        while True:
+            data = await sreader.read(512)
+            try:
+                PeerHeard(ujson.loads(data))
+            except (ValueError, KeyError, TypeError):
+                pass
+
+    uasyncio.create_task(Receive())
+    log('Start peer heartbeat - %s:%d', args=(USER.PEER_GROUP, USER.PEER_PORT))
+    # Listen for one timeout before the first election, so a running leader is found
+    start = utime.ticks_ms()
+    while True:
+        PeerWake.clear()
+        try:
+            sock.sendto(Heartbeat(wlan.ifconfig()[0]), (USER.PEER_GROUP, USER.PEER_PORT))
+        except OSError as e:
+            log('Heartbeat failed: %s', args=(LogRepr(e),), level=LOG_WARN)
+        if not PeerReady and utime.ticks_diff(utime.ticks_ms(), start) > USER.PEER_TIMEOUT_MS:
+            PeerReady = True
+        Elect()
+        try:
+            await uasyncio.wait_for_ms(PeerWake.wait(), USER.PEER_HEARTBEAT_MS)
+        except uasyncio.TimeoutError:
+            pass
 
 
 def AppInit():
     ledon()
     loginit()
-    ResetRTC()
+    BootPhase('init')
     DispBootReason()
     DispMACAddress()
-    ConnectNetwork()
-    while AdjustTime()==0:
-        log('Retry')
-        utime.sleep(2)
+    StartNetwork()
 
-    print(f'NOW(Offseted): {DatetimeString(OffsetUTCtime())}')
+    # The stores load while WiFi associates
+    RestoreClock()
+    SetupSceneDic()
+    SetupSceneLatency()
+    SetupSceneCatalog()
+    SetupDataBase()
+    SetupSkipDates()
+    SetupHighWater()
+    SetupStoreStamp()
+    for acct in Accounts.values():
+        acct.quota.Load()
+    BootPhase('config')
     gc.collect()
     ledoff()
 
-    SetupSceneDic()
-    SetupDataBase()
+async def BootNetwork():
+    # The worker is already running on the restored clock; this brings up what needs WiFi
+    global adjusttime
+    await WaitNetwork()
+    BootPhase('wifi')
+    uasyncio.create_task(web())
+    uasyncio.create_task(mDNS())
+    if USER.PEER_ENABLE:
+        uasyncio.create_task(PeerTask())
+    while await AdjustTime()==0:
+        log('Retry')
+        await uasyncio.sleep(2)
+    BootPhase('ntp')
+    print(f'NOW(Offseted): {DatetimeString(OffsetUTCtime())}')
+    adjusttime = OffsetUTCtime()+NTPInterval
+    ScheduleChanged()
+    uasyncio.create_task(CatalogTask())
+
+async def Boot():
+    uasyncio.create_task(worker())
+    uasyncio.create_task(BootNetwork())
+    while True:
+        await uasyncio.sleep(24*3600)
 
 def AppStart():
     gc.collect()
-    uasyncio.create_task(web())
-    uasyncio.create_task(worker())
-    uasyncio.run(mDNS())
+    uasyncio.run(Boot())
 
 def AppMain():
     AppInit()
     AppStart()
     
 
-AppMain()
+if __name__ == '__main__':
+    AppMain()
@@ -0,0 +1,475 @@
+#
+#  SwitchBot Kicker simulator
+#       Runs main.py's worker() on a virtual clock against a fake SwitchBot API (CPython)
+#
+#  python simkicker.py --days 7 --schedules 40 --latency 300 --fail 0.05
+#
+import sys
+import types
+import time
+import calendar
+import asyncio
+import selectors
+import random
+import json
+import argparse
+import tracemalloc
+import os
+import tempfile
+import binascii
+import socket
+import gc
+
+
+class VirtualClock:
+    # Seconds since the start of the simulation, plus the epoch the RTC is set to
+    def __init__(self, epoch):
+        self.epoch = epoch
+        self.t = 0.0
+
+class WallClock(VirtualClock):
+    # Real time for the tests in tests/, which talk to real sockets
+    @property
+    def t(self):
+        return time.monotonic() - self.base
+
+    @t.setter
+    def t(self, v):
+        self.base = time.monotonic() - v
+
+CLOCK = VirtualClock(0)
+
+
+def LocalTime(secs=None):
+    if secs is None:
+        secs = CLOCK.epoch + CLOCK.t
+    g = time.gmtime(secs)
+    return (g.tm_year, g.tm_mon, g.tm_mday, g.tm_hour, g.tm_min, g.tm_sec, g.tm_wday, g.tm_yday)
+
+def SleepSeconds(s):
+    CLOCK.t += s
+
+def InstallShims():
+    # MicroPython modules used by main.py, on top of the virtual clock
+    utime = types.ModuleType('utime')
+    utime.time = lambda: int(CLOCK.epoch + CLOCK.t)
+    utime.localtime = LocalTime
+    utime.gmtime = LocalTime
+    utime.mktime = lambda t: calendar.timegm((t[0], t[1], t[2], t[3], t[4], t[5], 0, 0, 0))
+    utime.sleep = SleepSeconds
+    utime.sleep_ms = lambda ms: SleepSeconds(ms/1000)
+    utime.ticks_ms = lambda: int(CLOCK.t*1000) & 0x3FFFFFFF
+    utime.ticks_add = lambda a, b: (a+b) & 0x3FFFFFFF
+    utime.ticks_diff = lambda a, b: ((a-b+0x20000000) & 0x3FFFFFFF) - 0x20000000
+
+    machine = types.ModuleType('machine')
+    class Pin:
+        OUT = 1
+        def __init__(self, *args):
+            pass
+        def high(self):
+            pass
+        def low(self):
+            pass
+    class RTC:
+        def datetime(self, t=None):
+            if t is not None:
+                CLOCK.epoch = calendar.timegm((t[0], t[1], t[2], t[4], t[5], t[6], 0, 0, 0)) + t[7]/1e6 - CLOCK.t
+            return LocalTime()
+    class WDT:
+        def __init__(self, timeout=0):
+            pass
+        def feed(self):
+            pass
+    machine.Pin = Pin
+    machine.RTC = RTC
+    machine.WDT = WDT
+    machine.PWRON_RESET = 1
+    machine.WDT_RESET = 3
+    machine.reset_cause = lambda: 1
+
+    network = types.ModuleType('network')
+    class WLAN:
+        def __init__(self, *args):
+            pass
+        def active(self, *args):
+            return True
+        def config(self, key):
+            return bytes(6)
+        def connect(self, *args):
+            pass
+        def isconnected(self):
+            return True
+        def ifconfig(self):
+            return ('127.0.0.1', '255.0.0.0', '127.0.0.1', '127.0.0.1')
+    network.STA_IF = 0
+    network.WLAN = WLAN
+    network.hostname = lambda *args: None
+
+    uasyncio = types.ModuleType('uasyncio')
+    uasyncio.__dict__.update(asyncio.__dict__)
+    uasyncio.sleep_ms = lambda ms: asyncio.sleep(ms/1000)
+    uasyncio.wait_for_ms = lambda aw, ms: asyncio.wait_for(aw, ms/1000)
+    class StreamReader:
+        # Over a non-blocking UDP socket, read() returns one datagram
+        def __init__(self, sock):
+            self.sock = sock
+        async def read(self, n):
+            return await asyncio.get_running_loop().sock_recv(self.sock, n)
+    uasyncio.StreamReader = StreamReader
+
+    # main.py awaits app.run(); under CPython that is start_server()
+    import microdot
+    async def run(self, host='0.0.0.0', port=80, **kw):
+        await self.start_server(host=host, port=port, **kw)
+    microdot.Microdot.run = run
+
+    sys.modules.update({'utime': utime, 'machine': machine, 'network': network, 'uasyncio': uasyncio,
+                        'usocket': socket, 'ubinascii': binascii, 'ujson': json})
+    gc.mem_free = lambda: 0
+    gc.mem_alloc = lambda: tracemalloc.get_traced_memory()[0]
+
+
+class VirtualSelector:
+    # Never blocks while timers are pending: the clock jumps to the next timer instead
+    def __init__(self):
+        self.sel = selectors.DefaultSelector()
+
+    def __getattr__(self, name):
+        return getattr(self.sel, name)
+
+    def select(self, timeout=None):
+        events = self.sel.select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:
+            return self.sel.select(1)
+        CLOCK.t += timeout
+        return []
+
+class VirtualLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        super().__init__(VirtualSelector())
+
+    def time(self):
+        return CLOCK.t
+
+
+class FakeSwitchBot:
+    # Keep-alive HTTP/1.1 stand-in for api.switch-bot.com with configurable latency and failures
+    def __init__(self, args, local_ms, now_ms):
+        self.rng = random.Random(args.seed)
+        self.latency = args.latency
+        self.jitter = args.jitter
+        self.fail = args.fail
+        self.drop = args.drop
+        self.stall = args.stall
+        self.stall_s = args.stall_seconds
+        self.local_ms = local_ms
+        self.now_ms = now_ms
+        # Requests per UTC day and token before answering 429, like the real daily limit
+        self.quota = args.server_quota
+        self.day = -1
+        self.today = {}
+        self.rejected = 0
+        self.requests = 0
+        self.failed = 0
+        # (scene ID, local ms the scene ran)
+        self.executed = []
+        # Encoded /v1.0/scenes response; None serves an empty list
+        self.catalog = None
+
+    async def handle(self, r, w):
+        # Small send buffer: a large scene list is not held whole next to the client reading it
+        w.transport.set_write_buffer_limits(high=4096)
+        try:
+            while True:
+                line = await r.readline()
+                if not line:
+                    break
+                length = 0
+                token = ''
+                while True:
+                    h = await r.readline()
+                    if h in (b'\r\n', b''):
+                        break
+                    k, _, v = h.decode().partition(':')
+                    k = k.strip().lower()
+                    if k == 'content-length':
+                        length = int(v)
+                    elif k == 'authorization':
+                        token = v.strip()
+                if length:
+                    await r.readexactly(length)
+                if not await self.respond(line.decode().split()[1], token, w):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        w.close()
+
+    async def respond(self, path, token, w):
+        self.requests += 1
+        day = self.now_ms()//86400000
+        if day != self.day:
+            self.day = day
+            self.today.clear()
+        self.today[token] = self.today.get(token, 0) + 1
+        if self.quota and self.today[token] > self.quota:
+            self.rejected += 1
+            body = b'{"message":"Unauthorized"}'
+            w.write(b'HTTP/1.1 429 Too Many Requests\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+            return True
+        if path == '/v1.0/scenes':
+            body = self.catalog or json.dumps({'statusCode': 100, 'body': [], 'message': 'success'}).encode()
+            w.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body))
+            mv = memoryview(body)
+            for k in range(0, len(body), 2048):
+                w.write(mv[k:k+2048])
+                await w.drain()
+            return True
+        x = self.rng.random()
+        if x < self.drop:
+            self.failed += 1
+            return False
+        if x < self.drop + self.stall:
+            self.failed += 1
+            await asyncio.sleep(self.stall_s)
+            return False
+        d = max(0.0, self.rng.gauss(self.latency, self.jitter))/1000
+        await asyncio.sleep(d/2)
+        if x < self.drop + self.stall + self.fail:
+            self.failed += 1
+            status = b'500 Internal Server Error'
+            body = b'{"statusCode":190,"message":"error"}'
+        else:
+            self.executed.append((path.split('/')[3], self.local_ms()))
+            status = b'200 OK'
+            body = b'{"statusCode":100,"body":{},"message":"success"}'
+        await asyncio.sleep(d/2)
+        w.write(b'HTTP/1.1 ' + status + b'\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+        return True
+
+
+def MakeSchedules(n, rng, start, days):
+    # (NAME,WEEKDAYS,HOUR,MINUTE,SECOND,YEAR,MONTH,DAY,SCENENAME,ACTIVE,MSEC)
+    # Mostly weekly, some skipping SkipDates (weekday 7), some one-shot or yearly dates
+    patterns = ((0,1,2,3,4,5,6), (0,1,2,3,4), (5,6), (0,2,4), (1,3,5), (0,1,2,3,4,7), (0,1,2,3,4,5,6,7))
+    db = []
+    for i in range(n):
+        hour = -1 if i % 10 == 9 else rng.randrange(24)
+        msec = rng.choice((0, 0, rng.randrange(-999, 1000)))
+        Y = M = D = 0
+        if i % 7 == 6:
+            g = time.gmtime(start + rng.randrange(max(1, int(days)))*86400)
+            Y, M, D = (g.tm_year if i % 14 == 6 else 0), g.tm_mon, g.tm_mday
+        db.append((f'sim{i}', rng.choice(patterns), hour, rng.randrange(60), rng.randrange(60),
+                   Y, M, D, f'scene{i}', True, msec))
+    return db
+
+def MakeSkipDates(rng, start, days):
+    return [tuple(time.gmtime(start + rng.randrange(max(1, int(days)))*86400)[:3]) for _ in range(max(1, int(days)//5))]
+
+def ExpectedKicks(db, skips, start_ms, end_ms):
+    # Brute force reference: {scene name: [local ms, ...]}
+    expected = {}
+    day = start_ms//86400000*86400000
+    while day < end_ms:
+        g = time.gmtime(day//1000)
+        skip = (g.tm_year, g.tm_mon, g.tm_mday) in skips
+        for S in db:
+            if not S[9]:
+                continue
+            if S[6]:
+                if (S[6], S[7]) != (g.tm_mon, g.tm_mday) or S[5] not in (0, g.tm_year):
+                    continue
+            elif g.tm_wday not in S[1] or (skip and 7 in S[1]):
+                continue
+            for h in ((S[2],) if S[2] >= 0 else range(24)):
+                for m in ((S[3],) if S[3] >= 0 else range(60)):
+                    t = day + (h*3600 + m*60 + S[4])*1000 + S[10]
+                    if start_ms < t <= end_ms:
+                        expected.setdefault(S[8], []).append(t)
+        day += 86400000
+    for v in expected.values():
+        v.sort()
+    return expected
+
+def Percentile(v, p):
+    return v[min(len(v)-1, int(len(v)*p))] if v else 0
+
+def Score(expected, executed, window):
+    runs = {}
+    for name, t in executed:
+        runs.setdefault(name, []).append(t)
+    missed = duplicate = stray = 0
+    late = []
+    for name, times in expected.items():
+        got = [[] for _ in times]
+        for t in runs.pop(name, []):
+            k = min(range(len(times)), key=lambda j: abs(times[j]-t))
+            if abs(times[k]-t) > window:
+                stray += 1
+            else:
+                got[k].append(t)
+        for t, g in zip(times, got):
+            if not g:
+                missed += 1
+            else:
+                duplicate += len(g)-1
+                late.append(min(g)-t)
+    stray += sum(len(v) for v in runs.values())
+    late.sort()
+    return {'expected': sum(len(v) for v in expected.values()), 'executed': len(late),
+            'missed': missed, 'duplicate': duplicate, 'stray': stray,
+            'late_mean_ms': round(sum(late)/len(late)) if late else 0,
+            'late_p50_ms': Percentile(late, 0.5), 'late_p99_ms': Percentile(late, 0.99),
+            'late_max_ms': late[-1] if late else 0, 'early_min_ms': late[0] if late else 0}
+
+
+async def Simulate(main, args):
+    fake = FakeSwitchBot(args, main.LocalMs, main.NowMs)
+    server = await asyncio.start_server(fake.handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    main.Accounts.clear()
+    for k in range(args.accounts):
+        name = f'a{k}' if k else ''
+        acct = main.Account(name, f'token{k}', '127.0.0.1', port, False)
+        acct.quota = main.RateLimiter(acct.quota.fname, args.quota or main.USER.API_DAILY_LIMIT,
+                                      main.USER.API_RESERVE if args.reserve is None else args.reserve,
+                                      main.USER.API_RATE, main.USER.API_BURST, main.USER.API_BURST_RESERVE)
+        main.Accounts[name] = acct
+
+    async def AdjustTime():
+        return main.OffsetUTCtime()
+    main.AdjustTime = AdjustTime
+    main.ClockSource = 'ntp'
+    main.NetworkReady = True
+
+    rng = random.Random(args.seed)
+    db = MakeSchedules(args.schedules, rng, main.LocalMs()//1000, args.days)
+    skips = MakeSkipDates(rng, main.LocalMs()//1000, args.days)
+    main.DataBase[:] = db
+    main.SkipDates[:] = skips
+    main.SCENEDIC.clear()
+    # Scenes are spread over the accounts round robin
+    names = list(main.Accounts)
+    for k, S in enumerate(db):
+        main.SCENEDIC[S[8]] = main.TagScene(names[k % len(names)], S[8])
+    start = main.LocalMs()
+    end = start + int(args.days*86400000)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    task = asyncio.create_task(main.worker())
+    while CLOCK.t < args.days*86400:
+        # Stalls and steps stay clear of the last hour, which is scored
+        left = args.days*86400 - CLOCK.t
+        if args.hiccup and left > 7200:
+            # Blocking call: the clock runs on without the loop, like a hanging NTP query
+            await asyncio.sleep(min(left-3600, rng.uniform(0, 2*args.hiccup*3600)))
+            SleepSeconds(rng.uniform(0, args.hiccup_seconds))
+        elif args.jump and left > 7200:
+            # RTC stepped forward, as TimeAdjustTask does after a lost NTP sync
+            await asyncio.sleep(min(left-3600, rng.uniform(0, 2*args.jump*3600)))
+            SleepSeconds(rng.uniform(0, args.jump_seconds))
+            main.ScheduleChanged()
+        elif args.manual:
+            # Test kicks from the web page, which must not eat into the scheduled kicks' reserve
+            await asyncio.sleep(min(left, rng.uniform(0, 7200/args.manual)))
+            main.DispatchKick('manual', main.LocalMs(), prio=main.QUOTA_MANUAL)
+        else:
+            await asyncio.sleep(min(left, 3600))
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+    mem = tracemalloc.get_traced_memory() if args.tracemalloc else (0, 0)
+    task.cancel()
+    server.close()
+
+    hours = args.days*24
+    # Scene names were registered as their own scene IDs
+    manual = [k for k in fake.executed if k[0] == 'manual']
+    report = Score(ExpectedKicks(db, skips, start, end), [k for k in fake.executed if k[0] != 'manual'], args.window*1000)
+    report.update({'days': args.days, 'schedules': args.schedules, 'remaining': len(main.DataBase),
+                   'wall_s': round(wall, 2),
+                   'cpu_ms_per_hour': round(cpu*1000/hours, 2),
+                   'api_requests': fake.requests, 'api_failed': fake.failed,
+                   'retries': list(main.RetryCounts), 'catchup': list(main.CatchupCounts),
+                   'manual': len(manual), 'api_rejected': fake.rejected,
+                   'quota_remaining': sum(a.quota.Remaining() for a in main.Accounts.values()),
+                   'quota_denied': [sum(a.quota.denied[c] for a in main.Accounts.values()) for c in range(3)],
+                   'accounts': args.accounts,
+                   'connections': {a.name or 'default': a.api.Stats() for a in main.Accounts.values()}})
+    if args.tracemalloc:
+        report['heap_peak_kb'] = round(mem[1]/1024, 1)
+        report['heap_end_kb'] = round(mem[0]/1024, 1)
+    return report
+
+def PrintReport(r):
+    print(f'simulated {r["days"]} days, {r["schedules"]} schedules ({r["remaining"]} left) in {r["wall_s"]}s wall')
+    print(f'kicks expected:{r["expected"]} executed:{r["executed"]} missed:{r["missed"]} '
+          f'duplicate:{r["duplicate"]} stray:{r["stray"]}')
+    print(f'late ms mean:{r["late_mean_ms"]} p50:{r["late_p50_ms"]} p99:{r["late_p99_ms"]} '
+          f'max:{r["late_max_ms"]} min:{r["early_min_ms"]}')
+    print(f'api requests:{r["api_requests"]} failed:{r["api_failed"]} '
+          f'retries scheduled/succeeded/gave_up:{r["retries"]} connections:{r["connections"]}')
+    print(f'catch-up fired/missed/superseded:{r["catchup"]}')
+    print(f'quota remaining today:{r["quota_remaining"]} denied scheduled/retry/manual:{r["quota_denied"]} '
+          f'manual kicks:{r["manual"]} answered 429:{r["api_rejected"]}')
+    print(f'cpu {r["cpu_ms_per_hour"]}ms per simulated hour', end='')
+    if 'heap_peak_kb' in r:
+        print(f', heap peak {r["heap_peak_kb"]}KB end {r["heap_end_kb"]}KB', end='')
+    print()
+
+def Main():
+    p = argparse.ArgumentParser(description='Replay schedules on a virtual clock against a fake SwitchBot API.')
+    p.add_argument('--days', type=float, default=7)
+    p.add_argument('--schedules', type=int, default=40)
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--start', default='2025-01-06', help='local start date (YYYY-MM-DD)')
+    p.add_argument('--latency', type=float, default=300, help='mean API response time (ms)')
+    p.add_argument('--jitter', type=float, default=50, help='API response time deviation (ms)')
+    p.add_argument('--fail', type=float, default=0, help='share of requests answered with 500')
+    p.add_argument('--drop', type=float, default=0, help='share of connections reset without answer')
+    p.add_argument('--stall', type=float, default=0, help='share of requests never answered')
+    p.add_argument('--stall-seconds', type=float, default=30)
+    p.add_argument('--hiccup', type=float, default=0, help='mean hours between blocking loop stalls')
+    p.add_argument('--hiccup-seconds', type=float, default=120, help='longest blocking loop stall')
+    p.add_argument('--jump', type=float, default=0, help='mean hours between forward clock steps')
+    p.add_argument('--jump-seconds', type=float, default=120, help='largest forward clock step')
+    p.add_argument('--accounts', type=int, default=1, help='SwitchBot accounts the scenes are spread over')
+    p.add_argument('--manual', type=float, default=0, help='test kicks per hour')
+    p.add_argument('--quota', type=int, default=0, help='client daily request limit (default API_DAILY_LIMIT)')
+    p.add_argument('--reserve', type=int, help='requests kept for scheduled kicks (default API_RESERVE)')
+    p.add_argument('--server-quota', type=int, default=0, help='requests per day the fake API accepts before 429')
+    p.add_argument('--window', type=float, default=90, help='seconds a kick may be off and still count')
+    p.add_argument('--coarse', action='store_true', help='SCHED_PRECISE = False')
+    p.add_argument('--early', action='store_true', help='KICK_EARLY = True')
+    p.add_argument('--tracemalloc', action='store_true', help='report heap use (slower)')
+    p.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = p.parse_args()
+
+    y, m, d = (int(x) for x in args.start.split('-'))
+    InstallShims()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import usersettings
+    CLOCK.epoch = calendar.timegm((y, m, d, 0, 0, 0, 0, 0, 0)) - usersettings.UTC_OFFSET
+    usersettings.SCHED_PRECISE = not args.coarse
+    usersettings.KICK_EARLY = args.early
+    usersettings.LOG_FLASH = False
+    os.chdir(tempfile.mkdtemp(prefix='simkicker'))
+
+    loop = VirtualLoop()
+    asyncio.set_event_loop(loop)
+    import main
+    main.loginit()
+    main.print = lambda *a, **k: None
+    report = loop.run_until_complete(Simulate(main, args))
+    if args.json:
+        print(json.dumps(report))
+    else:
+        PrintReport(report)
+
+if __name__ == '__main__':
+    Main()
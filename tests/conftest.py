@@ -0,0 +1,32 @@
+#
+#  Tests for main.py under CPython, on the MicroPython shims of simkicker.py
+#  and a real-time clock. microdot must be installed.
+#
+#  python -m pytest -q tests
+#
+import os
+import sys
+import time
+import importlib
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import simkicker
+simkicker.CLOCK = simkicker.WallClock(time.time())
+simkicker.InstallShims()
+import usersettings
+
+
+@pytest.fixture
+def kicker(tmp_path, monkeypatch):
+    # A freshly imported main.py per test, with its files in tmp_path
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(usersettings, 'LOG_FLASH', False)
+    sys.modules.pop('main', None)
+    main = importlib.import_module('main')
+    main.loginit()
+    main.print = lambda *a, **k: None
+    yield main
+    sys.modules.pop('main', None)
@@ -0,0 +1,47 @@
+#
+#  One kicker process for test_peers.py, on the shims of simkicker.py and a real-time clock
+#
+#  python peernode.py NAME PRIORITY WEBPORT PEERPORT APIPORT DIR
+#
+import os
+import sys
+import time
+import asyncio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import simkicker
+simkicker.CLOCK = simkicker.WallClock(time.time())
+simkicker.InstallShims()
+import usersettings
+
+name, priority, webport, peerport, apiport, path = sys.argv[1:]
+os.chdir(path)
+usersettings.HOSTNAME = name
+usersettings.PEER_ENABLE = True
+usersettings.PEER_PRIORITY = int(priority)
+usersettings.PEER_PORT = int(peerport)
+usersettings.LOG_FLASH = False
+usersettings.UTC_OFFSET = 0
+import main
+
+# The clock is the host's, already synchronized; WiFi is up
+main.WEB_PORT = int(webport)
+main.ClockSource = 'ntp'
+main.NetworkReady = True
+# The stand-in API tells the nodes apart by their token
+main.Accounts[''].api = main.APIClient('127.0.0.1', {'Authorization': 'Bearer ' + name}, port=int(apiport), ssl=False)
+main.loginit()
+main.SetupSceneDic()
+main.SetupDataBase()
+main.SetupSkipDates()
+main.SetupHighWater()
+main.SetupStoreStamp()
+
+async def Run():
+    asyncio.create_task(main.web())
+    asyncio.create_task(main.PeerTask())
+    await main.worker()
+
+asyncio.run(Run())
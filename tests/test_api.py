@@ -0,0 +1,117 @@
+#
+#  Validation of schedules and dates from the JSON API and the edit form
+#
+import pytest
+
+
+@pytest.mark.parametrize('v, expected', [
+    ('2025-02-28', (2025, 2, 28)),
+    ('2024-02-29', (2024, 2, 29)),
+    ('02-29', (0, 2, 29)),
+    ('12-31', (0, 12, 31)),
+    ('', (0, 0, 0)),
+])
+def test_date_parses(kicker, v, expected):
+    assert kicker.ParseDate(v) == expected
+
+
+@pytest.mark.parametrize('v', ['2025-02-30', '2025-02-29', '2025-04-31', '02-30', '11-31', '2025-13-01', '1999-01-01', 20250101])
+def test_impossible_date_is_rejected(kicker, v):
+    with pytest.raises(ValueError):
+        kicker.ParseDate(v)
+
+
+def test_impossible_one_shot_is_not_stored(kicker):
+    kicker.SCENEDIC['scene'] = 'id'
+    with pytest.raises(ValueError, match='no such date 2025-02-30'):
+        kicker.ScheduleFromJSON({'name': 'bad', 'scene': 'scene', 'date': '2025-02-30'})
+
+
+class Request:
+    def __init__(self, method, json=None, form=None):
+        self.method = method
+        self.json = json
+        self.form = form or {}
+
+
+@pytest.fixture
+def handlers(kicker, monkeypatch):
+    # The route handlers of the Microdot app web_server() builds, which is not started
+    import asyncio
+    import microdot
+    apps = []
+
+    async def capture(self, *args, **kw):
+        apps.append(self)
+    monkeypatch.setattr(microdot.Microdot, 'run', capture)
+    asyncio.run(kicker.web())
+    routes = {(m, p.url_pattern): f for methods, p, f, _, _ in apps[0].url_map for m in methods}
+
+    def call(method, path, **kw):
+        r = asyncio.run(routes[(method, path)](Request(method, **kw)))
+        body = r[0] if isinstance(r[0], str) else ''.join(x if isinstance(x, str) else bytes(x).decode() for x in r[0])
+        return body, r[1]
+    return call
+
+
+def Schedule(**kw):
+    o = {'name': 's', 'weekdays': [0, 1, 2, 3, 4], 'hour': 7, 'minute': 0, 'second': 0, 'scene': 'scene'}
+    o.update(kw)
+    return o
+
+
+def test_valid_schedules_are_stored(kicker, handlers):
+    kicker.SCENEDIC['scene'] = 'id'
+    body, status = handlers('PUT', '/api/schedules', json=[Schedule(), Schedule(active=False)])
+    assert status == 200
+    body, status = handlers('PATCH', '/api/schedules', json=[{'id': 1, 'active': True}, {'id': 0, 'delete': True}])
+    assert status == 200
+    assert [S[9] for S in kicker.DataBase] == [True]
+
+
+@pytest.mark.parametrize('method, body', [
+    ('PUT', [Schedule(active='false')]),
+    ('PUT', [Schedule(active=0)]),
+    ('PUT', [Schedule(scene='nosuch')]),
+    ('PUT', [Schedule(scene='(_initial_)')]),
+    ('PUT', [{k: v for k, v in Schedule().items() if k != 'scene'}]),
+    ('PATCH', [{'id': True, 'hour': 8}]),
+    ('PATCH', [{'id': True, 'delete': True}]),
+    ('PATCH', [{'id': 0, 'active': 'false'}]),
+    ('PATCH', [{'id': 0, 'scene': 'nosuch'}]),
+    ('PATCH', [Schedule(scene='nosuch')]),
+], ids=['active-string', 'active-int', 'scene', 'initial', 'no-scene', 'id-true', 'delete-id-true',
+        'patch-active', 'patch-scene', 'append-scene'])
+def test_invalid_schedules_are_refused(kicker, handlers, method, body):
+    kicker.SCENEDIC['scene'] = 'id'
+    handlers('PUT', '/api/schedules', json=[Schedule(name='a'), Schedule(name='b')])
+    before = list(kicker.DataBase)
+    text, status = handlers(method, '/api/schedules', json=body)
+    assert status == 400
+    assert list(kicker.DataBase) == before
+
+
+def test_weekday_set_outside_the_menu_survives_the_edit_page(kicker, handlers):
+    kicker.SCENEDIC['scene'] = 'id'
+    handlers('PUT', '/api/schedules', json=[Schedule(weekdays=[0, 6, 7])])
+    label = '月曜日 日曜日(除外日以外)'
+    index, status = handlers('GET', '/')
+    assert label in index
+    page, status = handlers('POST', '/edit', form={'id': '0', 'action': 'change'})
+    select = page.split('<select name="weekday">')[1].split('</select>')[0]
+    assert select.count(' selected') == 1
+    assert f'<option value="(0, 6, 7)" selected>{label}</option>' in select
+    # The browser sends the selected option back
+    form = {'id': '0', 'action': 'change', 'name': 's', 'weekday': '(0, 6, 7)', 'hour': '7', 'minute': '0',
+            'second': '0', 'msec': '0', 'date': '', 'scenename': 'scene', 'active': '1'}
+    handlers('POST', '/apply', form=form)
+    assert kicker.DataBase[0][1] == (0, 6, 7)
+
+
+def test_menu_weekday_set_is_selected_in_place(kicker, handlers):
+    kicker.SCENEDIC['scene'] = 'id'
+    handlers('PUT', '/api/schedules', json=[Schedule(weekdays=[5, 6])])
+    page, status = handlers('POST', '/edit', form={'id': '0', 'action': 'change'})
+    select = page.split('<select name="weekday">')[1].split('</select>')[0]
+    assert select.count('<option') == len(kicker.WDPAT)
+    assert '<option value="(5, 6)" selected>' in select
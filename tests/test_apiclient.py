@@ -0,0 +1,131 @@
+#
+#  APIClient keep-alive pool against a local HTTPS stand-in that counts TLS handshakes
+#
+import asyncio
+import shutil
+import ssl
+import subprocess
+import pytest
+
+
+@pytest.fixture(scope='module')
+def tls(tmp_path_factory):
+    # (server context, client context) for a throwaway self-signed localhost certificate
+    if shutil.which('openssl') is None:
+        pytest.skip('openssl is not installed')
+    d = tmp_path_factory.mktemp('tls')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+                    '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-keyout', str(d/'key.pem'), '-out', str(d/'cert.pem')], check=True, capture_output=True)
+    server = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server.load_cert_chain(str(d/'cert.pem'), str(d/'key.pem'))
+    client = ssl.create_default_context(cafile=str(d/'cert.pem'))
+    return server, client
+
+
+class StandIn:
+    # Keep-alive HTTPS server; drops a connection without notice after `limit` requests
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.handshakes = 0
+        self.requests = 0
+
+    async def handle(self, r, w):
+        self.handshakes += 1
+        n = 0
+        try:
+            while not self.limit or n < self.limit:
+                line = await r.readline()
+                if not line:
+                    break
+                length = 0
+                while True:
+                    h = await r.readline()
+                    if h in (b'\r\n', b''):
+                        break
+                    k, _, v = h.partition(b':')
+                    if k.strip().lower() == b'content-length':
+                        length = int(v)
+                if length:
+                    await r.readexactly(length)
+                n += 1
+                self.requests += 1
+                body = b'{"statusCode":100,"body":{},"message":"success"}'
+                w.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+                await w.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ssl.SSLError):
+            pass
+        w.close()
+
+
+async def Serve(tls, standin):
+    server = await asyncio.start_server(standin.handle, '127.0.0.1', 0, ssl=tls[0])
+    return server, server.sockets[0].getsockname()[1]
+
+
+def test_requests_share_one_handshake(kicker, tls):
+    async def run():
+        standin = StandIn()
+        server, port = await Serve(tls, standin)
+        api = kicker.APIClient('localhost', {}, port=port, ssl=tls[1])
+        statuses = [(await api.Request('POST', '/v1.0/scenes/x/execute'))[0] for i in range(10)]
+        server.close()
+        return standin, api, statuses
+
+    standin, api, statuses = asyncio.run(run())
+    assert statuses == [200]*10
+    assert standin.handshakes == 1
+    assert api.Stats() == {'opened': 1, 'reused': 9, 'stale': 0, 'idle': 1}
+
+
+def test_dropped_connections_are_reopened(kicker, tls):
+    async def run():
+        standin = StandIn(limit=3)
+        server, port = await Serve(tls, standin)
+        api = kicker.APIClient('localhost', {}, port=port, ssl=tls[1])
+        statuses = []
+        for i in range(12):
+            statuses.append((await api.Request('POST', '/v1.0/scenes/x/execute'))[0])
+            await asyncio.sleep(0.01)
+        server.close()
+        return standin, api, statuses
+
+    standin, api, statuses = asyncio.run(run())
+    assert statuses == [200]*12
+    assert standin.requests == 12
+    assert standin.handshakes == 4
+    assert api.Stats()['stale'] == 3
+
+
+def test_idle_connection_expires(kicker, tls):
+    async def run():
+        standin = StandIn()
+        server, port = await Serve(tls, standin)
+        api = kicker.APIClient('localhost', {}, port=port, ssl=tls[1], idlemax=0.2)
+        await api.Request('GET', '/v1.0/scenes')
+        await asyncio.sleep(0.3)
+        await api.Request('GET', '/v1.0/scenes')
+        server.close()
+        return standin, api
+
+    standin, api = asyncio.run(run())
+    assert standin.handshakes == 2
+    assert api.Stats()['stale'] == 1
+
+
+def test_kicks_report_connections_in_metrics(kicker, tls):
+    async def run():
+        standin = StandIn()
+        server, port = await Serve(tls, standin)
+        kicker.Accounts[''] = kicker.Account('', 'token', 'localhost', port, tls[1])
+        results = [await kicker.ExecuteScene('scene1') for i in range(5)]
+        server.close()
+        return standin, results
+
+    standin, results = asyncio.run(run())
+    assert results == [True]*5
+    assert standin.handshakes == 1
+    assert kicker.MetricsDict()['api_connections']['default'] == {'opened': 1, 'reused': 4, 'stale': 0, 'idle': 1}
+    text = ''.join(kicker.MetricsText())
+    assert 'kicker_api_connections_total{account="",kind="opened"} 1\n' in text
+    assert 'kicker_api_connections_total{account="",kind="reused"} 4\n' in text
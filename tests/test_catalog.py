@@ -0,0 +1,60 @@
+#
+#  Scene catalog refresh against a local HTTP stand-in of /v1.0/scenes
+#
+import asyncio
+import json
+import os
+
+
+def ScenesBody(n):
+    body = [{'sceneId': f'id{i}', 'sceneName': f'Scene {i}'} for i in range(n)]
+    return json.dumps({'statusCode': 100, 'body': body, 'message': 'success'}).encode()
+
+
+async def Serve(cut=0):
+    # Sends the scene list; with cut, stops that many bytes short and stalls
+    closed = []
+
+    async def handle(r, w):
+        while (await r.readline()) not in (b'\r\n', b''):
+            pass
+        data = ScenesBody(50)
+        w.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(data) + data[:len(data)-cut])
+        await w.drain()
+        # Until the client hangs up
+        closed.append(await r.read() == b'')
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1], closed
+
+
+def test_catalog_is_written(kicker):
+    async def run():
+        server, port, closed = await Serve()
+        acct = kicker.Account('', 'token', '127.0.0.1', port, False)
+        ok = await kicker.RefreshCatalog(acct)
+        server.close()
+        return acct, ok
+
+    acct, ok = asyncio.run(run())
+    assert ok
+    assert list(kicker.CatalogScenes(acct))[-1] == ('Scene 49', 'id49')
+    assert acct.api.Stats()['idle'] == 1
+
+
+def test_broken_body_leaves_no_temp_file_or_socket(kicker):
+    async def run():
+        server, port, closed = await Serve(cut=100)
+        acct = kicker.Account('', 'token', '127.0.0.1', port, False)
+        acct.api.timeout = 0.3
+        ok = await kicker.RefreshCatalog(acct)
+        await asyncio.sleep(0.1)
+        server.close()
+        return acct, ok, closed
+
+    acct, ok, closed = asyncio.run(run())
+    assert ok is False
+    assert closed == [True]
+    assert not os.path.exists(acct.catname + '.tmp')
+    assert not os.path.exists(acct.catname)
+    assert acct.api.Stats()['idle'] == 0
+    assert not acct.busy
@@ -0,0 +1,59 @@
+#
+#  Kick executor slots per account
+#
+import asyncio
+
+
+def test_burst_on_one_account_does_not_hold_another(kicker, monkeypatch):
+    kicker.Accounts['b'] = kicker.Account('b', 'token')
+    started = []
+
+    async def run():
+        release = asyncio.Event()
+
+        async def execute(SCENE_ID, prio):
+            started.append(SCENE_ID)
+            if not SCENE_ID.startswith('b:'):
+                await release.wait()
+            return True
+        monkeypatch.setattr(kicker, 'ExecuteScene', execute)
+        due = kicker.LocalMs()
+        for i in range(8):
+            kicker.DispatchKick(f'a{i}', due)
+        kicker.DispatchKick('b:x', due)
+        await asyncio.sleep(0.05)
+        a, b = kicker.Accounts[''], kicker.Accounts['b']
+        state = (list(started), a.running, len(a.pending), b.running)
+        release.set()
+        await asyncio.gather(*kicker.KickTasks)
+        return state
+
+    started_before, running, pending, b_running = asyncio.run(run())
+    assert running == kicker.USER.KICK_PARALLEL == 3 and pending == 5
+    assert started_before == ['a0', 'a1', 'a2', 'b:x']
+    assert b_running == 0
+    assert started == ['a0', 'a1', 'a2', 'b:x'] + [f'a{i}' for i in range(3, 8)]
+    assert kicker.Accounts[''].running == 0
+
+
+def test_retries_leave_a_slot_for_on_time_kicks(kicker, monkeypatch):
+    async def run():
+        release = asyncio.Event()
+
+        async def execute(SCENE_ID, prio):
+            await release.wait()
+            return True
+        monkeypatch.setattr(kicker, 'ExecuteScene', execute)
+        due = kicker.LocalMs()
+        for i in range(3):
+            kicker.DispatchKick(f'r{i}', due, attempt=1)
+        kicker.DispatchKick('k', due)
+        a = kicker.Accounts['']
+        state = (a.running, [p[0] for p in a.pending])
+        release.set()
+        await asyncio.gather(*kicker.KickTasks)
+        return state
+
+    running, pending = asyncio.run(run())
+    assert running == 3
+    assert pending == ['r2']
@@ -0,0 +1,67 @@
+#
+#  Scene latency EWMA and the early-kick lead, against a stand-in with a set response time
+#
+import asyncio
+import time
+import usersettings
+
+
+async def StandIn(latency):
+    # Keep-alive server answering every request after latency[0] seconds
+    async def handle(r, w):
+        while True:
+            length = 0
+            while (line := await r.readline()) not in (b'\r\n', b''):
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            if not line:
+                break
+            await r.readexactly(length)
+            await asyncio.sleep(latency[0])
+            body = b'{"statusCode":100,"body":{},"message":"success"}'
+            w.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+            await w.drain()
+        w.close()
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+def test_latency_converges_persists_and_sets_the_lead(kicker, monkeypatch):
+    monkeypatch.setattr(usersettings, 'API_RATE', 100)
+    monkeypatch.setattr(usersettings, 'KICK_EARLY', True)
+    latency = [0.2]
+
+    async def run():
+        server, port = await StandIn(latency)
+        kicker.Accounts[''] = kicker.Account('', 'token', '127.0.0.1', port, False)
+        assert await kicker.ExecuteScene('id')
+        first = next(kicker.ReadJSONLines(kicker.LatFileName))['id']
+        latency[0] = 0.08
+        for k in range(10):
+            assert await kicker.ExecuteScene('id')
+        saved = next(kicker.ReadJSONLines(kicker.LatFileName))['id']
+        # Ten minutes on, the next sample is written
+        kicker.LatencySavedAt = kicker.utime.ticks_add(kicker.utime.ticks_ms(), -600001)
+        assert await kicker.ExecuteScene('id')
+        for conn in kicker.Accounts[''].api.idle:
+            await kicker.Accounts[''].api._close(conn)
+        server.close()
+        return first, saved
+
+    first, saved = asyncio.run(run())
+    est = kicker.SceneLatency['id']
+    # The first sample is taken as it is; then a quarter of each error per sample
+    assert 200 <= first < 260
+    assert saved == first
+    assert 80 <= est < 100
+    kicker.SceneLatency = {}
+    kicker.SetupSceneLatency()
+    assert kicker.SceneLatency['id'] == est
+
+    kicker.SCENEDIC['scene'] = 'id'
+    T = (kicker.LocalMs()//1000 + 60)*1000
+    lt = time.gmtime(T//1000)
+    kicker.DataBase.append(('s', (0,1,2,3,4,5,6), lt.tm_hour, lt.tm_min, lt.tm_sec, 0, 0, 0, 'scene', True, 0))
+    kicker.RebuildFireIndex(kicker.LocalMs())
+    # Half the round trip: the scene runs when the request reaches the server
+    assert kicker.FireHeap[0] == (T - est*usersettings.KICK_EARLY_SHARE//100, 0, T)
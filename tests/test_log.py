@@ -0,0 +1,49 @@
+#
+#  Flash log: batched appends, errors written sooner but not per line
+#
+import os
+import pytest
+import usersettings
+
+
+@pytest.fixture
+def flashlog(kicker, monkeypatch):
+    monkeypatch.setattr(usersettings, 'LOG_FLASH', True)
+    kicker.LogFlushedAt = kicker.utime.ticks_ms()
+    return kicker
+
+
+def FlashLines(kicker):
+    if not os.path.exists(kicker.LogFileName):
+        return 0
+    with open(kicker.LogFileName, encoding='utf-8') as file:
+        return len(file.readlines())
+
+
+def test_errors_are_flushed_once_per_interval(flashlog):
+    for i in range(5):
+        flashlog.log('execute failed %d', args=(i,), level=flashlog.LOG_ERROR)
+    assert FlashLines(flashlog) == 0
+    flashlog.LogFlushedAt -= usersettings.LOG_FLASH_ERROR_SECONDS*1000
+    flashlog.log('give up', level=flashlog.LOG_ERROR)
+    assert FlashLines(flashlog) == 6
+    for i in range(5):
+        flashlog.log('execute failed %d', args=(i,), level=flashlog.LOG_ERROR)
+    assert FlashLines(flashlog) == 6
+    # The worker writes the pending errors out once the interval has passed
+    flashlog.LogFlush()
+    assert FlashLines(flashlog) == 6
+    flashlog.LogFlushedAt -= usersettings.LOG_FLASH_ERROR_SECONDS*1000
+    flashlog.LogFlush()
+    assert FlashLines(flashlog) == 11
+
+
+def test_info_lines_wait_for_the_batch(flashlog):
+    for i in range(usersettings.LOG_FLASH_BATCH-1):
+        flashlog.log('line %d', args=(i,))
+    flashlog.LogFlushedAt -= usersettings.LOG_FLASH_ERROR_SECONDS*1000
+    flashlog.LogFlush()
+    assert FlashLines(flashlog) == 0
+    flashlog.log('last')
+    flashlog.LogFlush()
+    assert FlashLines(flashlog) == usersettings.LOG_FLASH_BATCH
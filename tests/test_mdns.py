@@ -0,0 +1,109 @@
+#
+#  mDNS question parsing on crafted packets, and the responder on a local multicast socket pair
+#
+import asyncio
+import socket
+import struct
+import pytest
+import usersettings
+
+QNAME = b'\x0bswbotkicker\x05local\x00'
+
+
+def Name(name):
+    return b''.join(bytes((len(x),)) + x for x in name.split(b'.')) + b'\x00'
+
+def Packet(questions, flags=0):
+    # questions: [(wire-format name, qtype, qclass)]
+    data = struct.pack('!HHHHHH', 0, flags, len(questions), 0, 0, 0)
+    for name, qtype, qclass in questions:
+        data += name + struct.pack('!HH', qtype, qclass)
+    return data
+
+def Query(name, qtype=1, qclass=1, flags=0):
+    return Packet([(Name(name), qtype, qclass)], flags)
+
+
+@pytest.mark.parametrize('data', [
+    Query(b'swbotkicker.local'),
+    Query(b'SwBotKicker.LOCAL'),
+    Query(b'swbotkicker.local', qtype=255),
+    # QU bit: unicast response requested
+    Query(b'swbotkicker.local', qclass=0x8001),
+    Packet([(Name(b'other.local'), 1, 1), (Name(b'swbotkicker.local'), 1, 1)]),
+    # Second question points at "local" in the first: 12 header + 1 + 5 = offset 18
+    Packet([(Name(b'other.local'), 1, 1), (b'\x0bswbotkicker\xc0\x12', 1, 1)]),
+    # Whole name by pointer to the first question
+    Packet([(Name(b'swbotkicker.local'), 28, 1), (b'\xc0\x0c', 1, 1)]),
+], ids=['plain', 'case', 'any', 'qu', 'second', 'pointer', 'whole-pointer'])
+def test_question_matches(kicker, data):
+    assert kicker.MDNSQuestionMatches(data, QNAME)
+
+
+@pytest.mark.parametrize('data', [
+    Query(b'swbotkicker.local', flags=0x8400),
+    Query(b'other.local'),
+    Query(b'swbotkicker.local', qtype=28),
+    Query(b'swbotkicker.local', qclass=3),
+    Query(b'swbotkicker.local.evil'),
+    Query(b'xswbotkicker.local'),
+    Query(b'swbotkicker'),
+    # Pointer to itself
+    Packet([(b'\xc0\x0c', 1, 1)]),
+    Query(b'swbotkicker.local')[:-3],
+    b'\x00\x00\x00\x00\x00\x01',
+    b'xx swbotkicker yy',
+], ids=['response', 'other', 'aaaa', 'chaos', 'suffix', 'prefix', 'nolocal', 'loop', 'truncated', 'short', 'garbage'])
+def test_question_does_not_match(kicker, data):
+    assert not kicker.MDNSQuestionMatches(data, QNAME)
+
+
+def test_responder_sleeps_until_a_packet_arrives(kicker, monkeypatch):
+    monkeypatch.setattr(usersettings, 'HOSTNAME', 'swbotkicker')
+    try:
+        listener = kicker.MulticastSocket('224.0.0.251', 5353)
+    except OSError as e:
+        pytest.skip(f'no multicast: {e}')
+    reads = []
+
+    class CountingReader(kicker.uasyncio.StreamReader):
+        async def read(self, n):
+            data = await super().read(n)
+            reads.append(data)
+            return data
+    monkeypatch.setattr(kicker.uasyncio, 'StreamReader', CountingReader)
+
+    async def run():
+        task = asyncio.create_task(kicker.mDNSresponder())
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        await asyncio.sleep(1.0)
+        idle = len(reads)
+        for data in (Query(b'SWBOTKICKER.local'), Query(b'swbotkicker.local'), Query(b'other.local'),
+                     Query(b'swbotkicker.local', qtype=28), b'xx swbotkicker yy'):
+            sender.sendto(data, ('224.0.0.251', 5353))
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(1.1)
+        sender.sendto(Query(b'swbotkicker.local', qtype=255), ('224.0.0.251', 5353))
+        await asyncio.sleep(0.3)
+        task.cancel()
+        sender.close()
+        answers = []
+        while True:
+            try:
+                data = listener.recv(1024)
+            except OSError:
+                break
+            if data[2] & 0x80:
+                answers.append(data)
+        listener.close()
+        return idle, answers
+
+    idle, answers = asyncio.run(run())
+    # The former loop slept 10 ms between select() polls, ~100 wakeups/s
+    assert idle == 0
+    # Two answers (the first two queries are within the 1 s limit), each sent twice
+    assert len(answers) == 4
+    assert answers[0][-4:] == bytes((127, 0, 0, 1))
+    # 6 queries plus its own 4 answers looped back, nothing else
+    assert len(reads) == 10
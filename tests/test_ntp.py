@@ -0,0 +1,208 @@
+#
+#  NTP sync against a local UDP NTP stand-in with injected delay, offset and drift
+#
+import asyncio
+import struct
+import time
+import pytest
+import usersettings
+
+NTP_DELTA = 2208988800
+
+
+class NTPStandIn(asyncio.DatagramProtocol):
+    # Answers with its clock set `offset` seconds ahead. Each request waits delays[i] ms
+    # on the way in and again on the way out, and `process` ms between receive and transmit.
+    def __init__(self, offset=0.0, delays=(0,), process=0):
+        self.offset = offset
+        self.delays = delays
+        self.process = process
+        self.requests = 0
+        self.silent = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def now(self):
+        return time.time() + self.offset
+
+    def datagram_received(self, data, addr):
+        if not self.silent:
+            d = self.delays[self.requests % len(self.delays)]/1000
+            self.requests += 1
+            asyncio.ensure_future(self.reply(data, addr, d))
+
+    async def reply(self, data, addr, d):
+        def stamp(t):
+            return struct.pack('!II', int(t)+NTP_DELTA, int((t % 1)*2**32))
+        await asyncio.sleep(d)
+        t2 = self.now()
+        await asyncio.sleep(self.process/1000)
+        t3 = self.now()
+        await asyncio.sleep(d)
+        self.transport.sendto(bytes((0x24, 2, 0, 0)) + bytes(20) + data[40:48] + stamp(t2) + stamp(t3), addr)
+
+
+@pytest.fixture
+def ntp(monkeypatch):
+    # Starts a stand-in inside the running loop: server = await ntp(...)
+    async def start(**kw):
+        server = NTPStandIn(**kw)
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(lambda: server, local_addr=('127.0.0.1', 0))
+        monkeypatch.setattr(usersettings, 'NTP_HOST', '127.0.0.1')
+        monkeypatch.setattr(usersettings, 'NTP_PORT', transport.get_extra_info('sockname')[1])
+        return server
+    return start
+
+
+def ClockError(kicker, server):
+    return kicker.NowMs() - server.now()*1000
+
+
+def test_sample_offset_excludes_delay_and_processing(kicker, ntp):
+    async def run():
+        server = await ntp(offset=1.5, delays=(40,), process=30)
+        sample = await kicker.NTPSample(('127.0.0.1', usersettings.NTP_PORT))
+        return sample, -ClockError(kicker, server)
+
+    (offset, delay), expected = asyncio.run(run())
+    # The software clock starts on a whole utime.time() second, so expected is not exactly 1500
+    assert abs(offset - expected) < 15
+    # 40 ms each way; the 30 ms between receive and transmit is not network delay
+    assert 70 <= delay < 110
+
+
+def test_lowest_delay_sample_sets_the_clock(kicker, ntp, monkeypatch):
+    monkeypatch.setattr(usersettings, 'NTP_SAMPLES', 4)
+
+    async def run():
+        server = await ntp(offset=-42.0, delays=(150, 10, 100, 60))
+        assert await kicker.AdjustTime() > 0
+        return server, ClockError(kicker, server)
+
+    server, err = asyncio.run(run())
+    assert server.requests == 4
+    assert 15 <= kicker.NTPDelay < 50
+    assert abs(err) < 15
+    assert kicker.ClockSource == 'ntp'
+
+
+def test_drift_model_and_adaptive_interval(kicker, ntp, monkeypatch):
+    monkeypatch.setattr(usersettings, 'NTP_SAMPLES', 2)
+
+    async def run():
+        server = await ntp(offset=3.0, delays=(5,))
+        await kicker.AdjustTime()
+        assert kicker.ClockDrift == 0 and kicker.NTPInterval == 3600
+        # 10000 s since that sync, in which the stand-in gained 40 ms on us: 4 ppm slow
+        kicker.NTPLastSync = kicker.NowMs() - 10000000
+        server.offset += 0.040
+        await kicker.AdjustTime()
+        return server, ClockError(kicker, server)
+
+    server, err = asyncio.run(run())
+    assert abs(kicker.ClockDrift*1e6 + 4) < 1
+    # NTP_ERROR_MS of error builds up in about 200/4e-6 ms
+    assert 40000 < kicker.NTPInterval < 65000
+    assert abs(err) < 15
+
+
+def test_large_residual_is_not_taken_as_drift(kicker, ntp):
+    async def run():
+        server = await ntp(offset=0.0)
+        await kicker.AdjustTime()
+        kicker.NTPLastSync = kicker.NowMs() - 1000000
+        server.offset += 60
+        await kicker.AdjustTime()
+        return server, ClockError(kicker, server)
+
+    server, err = asyncio.run(run())
+    assert kicker.ClockDrift == 0
+    assert abs(err) < 15
+
+
+def test_unanswered_sync_does_not_block_the_loop(kicker, ntp, monkeypatch):
+    monkeypatch.setattr(usersettings, 'NTP_SAMPLES', 1)
+
+    async def run():
+        server = await ntp()
+        server.silent = True
+        ticks = []
+
+        async def ticker():
+            for i in range(50):
+                ticks.append(i)
+                await asyncio.sleep(0.01)
+        result = await asyncio.gather(kicker.AdjustTime(), ticker())
+        return result[0], len(ticks)
+
+    result, ticks = asyncio.run(run())
+    assert result == 0
+    assert ticks == 50
+    assert kicker.NTPaddr is None
+    assert kicker.ClockSource == 'none'
+
+
+def test_sample_sleeps_until_the_reply(kicker, ntp, monkeypatch):
+    sleeps = []
+    sleep_ms = kicker.uasyncio.sleep_ms
+    monkeypatch.setattr(kicker.uasyncio, 'sleep_ms', lambda ms: sleeps.append(ms) or sleep_ms(ms))
+
+    async def run():
+        server = await ntp(delays=(100,))
+        answered = await kicker.NTPSample(('127.0.0.1', usersettings.NTP_PORT), 1000)
+        server.silent = True
+        t = time.monotonic()
+        unanswered = await kicker.NTPSample(('127.0.0.1', usersettings.NTP_PORT), 300)
+        return answered, unanswered, time.monotonic() - t
+
+    answered, unanswered, waited = asyncio.run(run())
+    assert answered is not None and unanswered is None
+    assert 0.3 <= waited < 0.4
+    # The former loop polled every 2 ms: about 100 wakeups for the reply, 150 for the timeout
+    assert sleeps == []
+
+
+def test_time_adjust_task_retries_after_an_error(kicker, monkeypatch):
+    async def failing():
+        raise OSError(-2)
+    monkeypatch.setattr(kicker, 'AdjustTime', failing)
+    kicker.adjusttime = kicker.OffsetUTCtime() + 24*3600
+    asyncio.run(kicker.TimeAdjustTask())
+    assert abs(kicker.adjusttime - (kicker.OffsetUTCtime() + 5*60)) <= 1
+
+
+def test_lookup_and_send_errors_leave_the_boot_retrying(kicker, ntp, monkeypatch):
+    monkeypatch.setattr(usersettings, 'NTP_SAMPLES', 1)
+    getaddrinfo = kicker.socket.getaddrinfo
+    failures = {'lookup': 2}
+
+    def lookup(host, port):
+        if failures['lookup']:
+            failures['lookup'] -= 1
+            raise OSError(-2, 'Name or service not known')
+        return getaddrinfo(host, port)
+    monkeypatch.setattr(kicker.socket, 'getaddrinfo', lookup)
+
+    async def sleep(s):
+        await asyncio.sleep(0)
+    monkeypatch.setattr(kicker.uasyncio, 'sleep', sleep)
+
+    async def run():
+        server = await ntp(offset=2.0)
+        assert await kicker.AdjustTime() == 0
+        assert kicker.NTPaddr is None
+        # No route to the server on the first exchange
+        kicker.NTPaddr = ('127.0.0.1', 0)
+        assert await kicker.AdjustTime() == 0
+        assert kicker.NTPaddr is None
+        await asyncio.wait_for(kicker.BootNetwork(), 5)
+        return server, ClockError(kicker, server)
+
+    monkeypatch.setattr(kicker, 'CatalogTask', lambda: asyncio.sleep(0))
+    monkeypatch.setattr(kicker, 'web', lambda: asyncio.sleep(0))
+    monkeypatch.setattr(kicker, 'mDNS', lambda: asyncio.sleep(0))
+    server, err = asyncio.run(run())
+    assert failures['lookup'] == 0
+    assert kicker.ClockSource == 'ntp'
+    assert abs(err) < 15
@@ -0,0 +1,162 @@
+#
+#  Active/standby kickers: three processes on loopback multicast, one stand-in SwitchBot API
+#
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import pytest
+
+NODE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'peernode.py')
+
+
+def FreePort(kind=socket.SOCK_STREAM):
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def MulticastLoops(kicker, port):
+    # True if a datagram sent to the peer group comes back on this host
+    try:
+        sock = kicker.MulticastSocket(kicker.USER.PEER_GROUP, port)
+    except OSError:
+        return False
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+            sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            sender.sendto(b'ping', (kicker.USER.PEER_GROUP, port))
+        for i in range(20):
+            try:
+                return sock.recv(16) == b'ping'
+            except BlockingIOError:
+                time.sleep(0.01)
+        return False
+    finally:
+        sock.close()
+
+
+async def StandInAPI(kicks):
+    # Records (time, token, scene ID) of every scene execution
+    async def handle(r, w):
+        while True:
+            line = (await r.readline()).decode()
+            if not line:
+                break
+            sceneId = line.split()[1].split('/')[3]
+            token = ''
+            n = 0
+            while True:
+                line = (await r.readline()).decode()
+                if line in ('\r\n', ''):
+                    break
+                k, _, v = line.partition(':')
+                if k.lower() == 'authorization':
+                    token = v.split()[-1]
+                elif k.lower() == 'content-length':
+                    n = int(v)
+            if n:
+                await r.readexactly(n)
+            kicks.append((time.time(), token, sceneId))
+            body = b'{"statusCode":100,"body":{},"message":"success"}'
+            w.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def HTTP(method, port, path, body=None):
+    r, w = await asyncio.open_connection('127.0.0.1', port)
+    data = json.dumps(body).encode() if body is not None else b''
+    w.write(f'{method} {path} HTTP/1.0\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n'.encode() + data)
+    resp = await r.read()
+    w.close()
+    return json.loads(resp.split(b'\r\n\r\n', 1)[1])
+
+
+async def Until(f, timeout=5.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            if await f():
+                return True
+        except OSError:
+            pass
+        await asyncio.sleep(0.1)
+    return False
+
+
+def test_standby_takes_over_without_missed_or_duplicate_kicks(kicker, tmp_path):
+    peerport = FreePort(socket.SOCK_DGRAM)
+    if not MulticastLoops(kicker, peerport):
+        pytest.skip('no loopback multicast')
+    kicks = []
+    procs = {}
+
+    async def run():
+        server, apiport = await StandInAPI(kicks)
+        ports = {}
+        for name, priority in (('n1', 3), ('n2', 2), ('n3', 1)):
+            ports[name] = FreePort()
+            os.mkdir(tmp_path / name)
+            procs[name] = subprocess.Popen(
+                [sys.executable, NODE, name, str(priority), str(ports[name]), str(peerport), str(apiport), str(tmp_path / name)],
+                stdout=open(tmp_path / f'{name}.out', 'w'), stderr=subprocess.STDOUT)
+        for port in ports.values():
+            assert await Until(lambda: Listening(port))
+        # One schedule a second, each with its own scene, put on the leader and copied to the standbys
+        await HTTP('PUT', ports['n1'], '/api/scenes', {f'scene{i}': f'id{i}' for i in range(60)})
+        schedules = [{'name': f's{i}', 'weekdays': [0, 1, 2, 3, 4, 5, 6], 'hour': -1, 'minute': -1,
+                      'second': i, 'scene': f'scene{i}'} for i in range(60)]
+        await HTTP('PUT', ports['n1'], '/api/schedules', schedules)
+        for port in ports.values():
+            assert await Until(lambda: Copied(port))
+        start = time.time()
+        await asyncio.sleep(4)
+        procs['n1'].kill()
+        killed = time.time()
+        await asyncio.sleep(5)
+        end = time.time()
+        server.close()
+        return start, killed, end
+
+    async def Listening(port):
+        return await HTTP('GET', port, '/api/schedules') == []
+
+    async def Copied(port):
+        return len(await HTTP('GET', port, '/api/schedules')) == 60
+
+    try:
+        start, killed, end = asyncio.run(run())
+    finally:
+        for p in procs.values():
+            p.kill()
+            p.wait()
+    # Every second of the window (UTC_OFFSET 0, shorter than a minute) is kicked once,
+    # by n1 and then by n2; the kicks missed in the takeover are caught up late
+    seconds = [f'id{s % 60}' for s in range(int(start) + 1, int(end) - 1)]
+    fired = {}
+    for t, token, sceneId in kicks:
+        fired.setdefault(sceneId, []).append((t, token))
+    assert [s for s in seconds if s not in fired] == []
+    assert [(s, fired[s]) for s in seconds if len(fired[s]) > 1] == []
+    tokens = [fired[s][0][1] for s in seconds]
+    assert tokens == sorted(tokens) and tokens[0] == 'n1' and tokens[-1] == 'n2'
+    assert max(t for t, token, sceneId in kicks if token == 'n1') < killed
+
+
+def test_leads_alone_when_the_peer_socket_fails(kicker, monkeypatch):
+    def failing(group, port):
+        raise OSError(19)
+    monkeypatch.setattr(kicker, 'MulticastSocket', failing)
+    kicker.Leader = False
+
+    async def run():
+        try:
+            await asyncio.wait_for(kicker.PeerTask(), 0.2)
+        except asyncio.TimeoutError:
+            pass
+    asyncio.run(run())
+    assert kicker.Leader
@@ -0,0 +1,105 @@
+#
+#  API quota: accounting across the untrusted clock of a boot, and priority of scheduled kicks
+#
+import asyncio
+import json
+import time
+
+
+def Limiter(kicker, day, used):
+    with open('test.quo', 'w') as file:
+        file.write(json.dumps({'day': day, 'used': used}) + '\n')
+    q = kicker.RateLimiter('test.quo', 1000, 100, 1, 10)
+    q.Load()
+    return q
+
+
+def test_count_survives_requests_before_the_clock_is_trusted(kicker):
+    today = kicker.NowMs()//86400000
+    # Saved count plus QUOTA_SAVE_EVERY, as after a reboot
+    q = Limiter(kicker, today, 200)
+    assert kicker.ClockSource == 'none'
+    assert q.Remaining() == 1000-216
+    assert asyncio.run(q.Acquire(kicker.QUOTA_MANUAL))
+    assert q.day == today and q.used == 217
+    kicker.ClockSource = 'ntp'
+    assert q.Remaining() == 1000-217
+
+
+def test_new_day_resets_once_the_clock_is_trusted(kicker):
+    today = kicker.NowMs()//86400000
+    q = Limiter(kicker, today-1, 900)
+    assert asyncio.run(q.Acquire(kicker.QUOTA_SCHEDULED))
+    assert q.used == 917
+    kicker.ClockSource = 'ntp'
+    assert q.Remaining() == 1000
+    assert q.day == today
+
+
+def test_scheduled_kicks_do_not_wait_behind_manual_traffic(kicker):
+    q = kicker.RateLimiter('test.quo', 1000, 100, 1, 10, 3)
+
+    async def run():
+        for k in range(7):
+            assert await q.Acquire(kicker.QUOTA_MANUAL)
+        # The bucket is down to the scheduled kicks' share: manual traffic waits
+        manual = asyncio.ensure_future(q.Acquire(kicker.QUOTA_MANUAL))
+        await asyncio.sleep(0.05)
+        assert not manual.done()
+        t = time.monotonic()
+        for k in range(3):
+            assert await q.Acquire(kicker.QUOTA_SCHEDULED)
+        ms = (time.monotonic() - t)*1000
+        manual.cancel()
+        return ms
+
+    assert asyncio.run(run()) < 20
+
+
+async def QuotaStandIn(allowed, counts):
+    # Answers 429 after `allowed` requests, like the daily limit of the API
+    async def handle(r, w):
+        while True:
+            length = 0
+            while (line := await r.readline()) not in (b'\r\n', b''):
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            if not line:
+                break
+            await r.readexactly(length)
+            counts.append(1)
+            if len(counts) > allowed:
+                w.write(b'HTTP/1.1 429 Too Many Requests\r\nContent-Length: 2\r\n\r\n{}')
+            else:
+                body = b'{"statusCode":100,"body":{},"message":"success"}'
+                w.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+            await w.drain()
+        w.close()
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+def test_reserve_keeps_scheduled_kicks_going_until_the_api_refuses(kicker):
+    counts = []
+
+    async def run():
+        server, port = await QuotaStandIn(18, counts)
+        acct = kicker.Accounts[''] = kicker.Account('', 'token', '127.0.0.1', port, False)
+        acct.quota = kicker.RateLimiter('test.quo', 20, 5, 1000, 50, 3)
+        manual = [await kicker.ExecuteScene('id', kicker.QUOTA_MANUAL) for k in range(20)]
+        scheduled = [await kicker.ExecuteScene('id', kicker.QUOTA_SCHEDULED) for k in range(5)]
+        after = await kicker.ExecuteScene('id', kicker.QUOTA_SCHEDULED)
+        for conn in acct.api.idle:
+            await acct.api._close(conn)
+        server.close()
+        return acct, manual, scheduled, after
+
+    acct, manual, scheduled, after = asyncio.run(run())
+    # Manual kicks stop at the reserve of the last 5 requests
+    assert manual == [True]*15 + [None]*5
+    assert acct.quota.denied[kicker.QUOTA_MANUAL] == 5
+    # Scheduled kicks use it, until the API answers 429; none of them is retried
+    assert scheduled == [True]*3 + [None]*2
+    assert after is None
+    assert len(counts) == 19
+    assert acct.quota.Remaining() <= 0
@@ -0,0 +1,90 @@
+#
+#  Kick retries against a local stand-in that answers 500, 404, resets or stalls on cue
+#
+import asyncio
+import time
+import pytest
+import usersettings
+
+BASE = 100
+TIMEOUT = 0.3
+
+
+async def StandIn(script):
+    # One answer per request from script: a status, 'reset' or 'stall'; then 200.
+    # Every answer closes the connection, so each attempt is one request.
+    arrivals = []
+
+    async def handle(r, w):
+        length = 0
+        while (line := await r.readline()) not in (b'\r\n', b''):
+            if line.lower().startswith(b'content-length:'):
+                length = int(line.split(b':')[1])
+        await r.readexactly(length)
+        arrivals.append(time.monotonic())
+        what = script[len(arrivals)-1] if len(arrivals) <= len(script) else 200
+        if what == 'stall':
+            await asyncio.sleep(TIMEOUT*3)
+        elif what != 'reset':
+            body = b'{"statusCode":100,"body":{},"message":"success"}'
+            w.write(b'HTTP/1.1 %d X\r\nConnection: close\r\nContent-Length: %d\r\n\r\n' % (what, len(body)) + body)
+            await w.drain()
+        w.close()
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1], arrivals
+
+
+@pytest.fixture
+def kick(kicker, monkeypatch):
+    monkeypatch.setattr(usersettings, 'RETRY_BASE_MS', BASE)
+    monkeypatch.setattr(usersettings, 'RETRY_ATTEMPTS', 3)
+
+    async def run(script, seconds):
+        server, port, arrivals = await StandIn(script)
+        acct = kicker.Accounts[''] = kicker.Account('', 'token', '127.0.0.1', port, False)
+        acct.api.timeout = TIMEOUT
+        kicker.DispatchKick('id', kicker.LocalMs())
+        # The worker's part: due retries are dispatched as they come
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            kicker.DispatchRetries(kicker.LocalMs())
+            await asyncio.sleep(0.005)
+        server.close()
+        return arrivals
+    return lambda script, seconds: asyncio.run(run(script, seconds))
+
+
+def Gaps(arrivals):
+    return [(b-a)*1000 for a, b in zip(arrivals, arrivals[1:])]
+
+
+def test_server_errors_resets_and_timeouts_are_retried_with_backoff(kicker, kick):
+    arrivals = kick([500, 'reset', 'stall'], 3.0)
+    assert len(arrivals) == 4
+    assert list(kicker.RetryCounts) == [3, 1, 0]
+    # BASE << attempt plus up to half of it as jitter; the stalled attempt first waits out the timeout
+    for k, (gap, extra) in enumerate(zip(Gaps(arrivals), (0, 0, TIMEOUT*1000))):
+        delay = BASE << k
+        assert delay <= gap - extra < delay*1.5 + 60
+
+
+def test_retries_give_up_after_the_last_attempt(kicker, kick):
+    arrivals = kick([500, 503, 502, 500, 500], 2.0)
+    # The first try and RETRY_ATTEMPTS retries
+    assert len(arrivals) == 4
+    assert list(kicker.RetryCounts) == [3, 0, 1]
+
+
+@pytest.mark.parametrize('status', [400, 401, 403, 404])
+def test_client_errors_are_not_retried(kicker, kick, status):
+    arrivals = kick([status], 0.5)
+    assert len(arrivals) == 1
+    assert list(kicker.RetryCounts) == [0, 0, 0]
+    assert kicker.Accounts[''].quota.used == 1
+
+
+def test_quota_exceeded_is_not_retried(kicker, kick):
+    arrivals = kick([429], 0.5)
+    assert len(arrivals) == 1
+    assert list(kicker.RetryCounts) == [0, 0, 0]
+    assert kicker.Accounts[''].quota.Remaining() <= 0
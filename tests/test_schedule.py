@@ -0,0 +1,110 @@
+#
+#  Fire index and high-water mark
+#
+import time
+import usersettings
+
+
+def At(kicker, ms):
+    # (HOUR, MINUTE, SECOND, MSEC) of a local ms
+    lt = time.gmtime(ms//1000)
+    return lt.tm_hour, lt.tm_min, lt.tm_sec, ms % 1000
+
+
+def Entry(kicker, i):
+    return [e for e in kicker.FireHeap if e[1] == i][0]
+
+
+def test_early_kick_does_not_skip_schedules_due_before_it(kicker, monkeypatch):
+    monkeypatch.setattr(usersettings, 'KICK_EARLY', True)
+    fired = []
+    monkeypatch.setattr(kicker, 'DispatchKick', lambda SCENE_ID, due, attempt=0, prio=0: fired.append((SCENE_ID, due)))
+    T = (kicker.LocalMs()//1000 + 30)*1000
+    for name, ms in (('A', T), ('B', T-500)):
+        h, m, sec, msec = At(kicker, ms)
+        kicker.DataBase.append((name, (0,1,2,3,4,5,6), h, m, sec, 0, 0, 0, 'scene'+name, True, msec))
+        kicker.SCENEDIC['scene'+name] = 'id'+name
+    # A's scene answers in 1600 ms and runs halfway, so A is kicked at T-800, before B's T-500
+    kicker.SceneLatency['idA'] = 1600
+    kicker.HighWater = kicker.LocalMs()
+    kicker.DayChanged(kicker.LocalMs()//86400000)
+    assert Entry(kicker, 0) == (T-800, 0, T)
+    assert Entry(kicker, 1) == (T-500, 1, T-500)
+
+    kicker.checkScheduleAndKick(T-800)
+    assert fired == [('idA', T)]
+    assert kicker.HighWater <= T-500
+    # A web edit, a new latency sample, an NTP adjust or a leader change
+    kicker.ScheduleChanged()
+    assert Entry(kicker, 1) == (T-500, 1, T-500)
+    assert Entry(kicker, 0)[2] > T
+
+    kicker.checkScheduleAndKick(T-500)
+    assert fired == [('idA', T), ('idB', T-500)]
+    kicker.ScheduleChanged()
+    kicker.checkScheduleAndKick(T+1000)
+    assert len(fired) == 2
+
+
+class CountingHeap(list):
+    # Counts the entries read by index or iteration; heapq itself bypasses both
+    reads = 0
+
+    def __getitem__(self, j):
+        CountingHeap.reads += 1
+        return list.__getitem__(self, j)
+
+    def __iter__(self):
+        for j in range(len(self)):
+            yield self[j]
+
+
+def test_prewarm_walks_only_the_kicks_within_its_horizon(kicker, monkeypatch):
+    monkeypatch.setattr(kicker, 'PrewarmAccount', lambda acct, n: (acct.name, n))
+    tasks = []
+    monkeypatch.setattr(kicker.uasyncio, 'create_task', tasks.append)
+    now = (kicker.LocalMs()//1000)*1000
+    kicker.SCENEDIC['scene'] = 'id'
+    for j in range(1000):
+        h, m, sec, msec = At(kicker, now + 3000 + j*1000)
+        kicker.DataBase.append((f's{j}', (0,1,2,3,4,5,6), h, m, sec, 0, 0, 0, 'scene', True, 0))
+    kicker.RebuildFireIndex(now)
+    heap = CountingHeap(kicker.FireHeap)
+    monkeypatch.setattr(kicker, 'FireHeap', heap)
+    CountingHeap.reads = 0
+    kicker.PrewarmKicks(now)
+    # 3 s to 5 s ahead: three kicks; the next one comes within the horizon 1 s later
+    assert tasks == [('', 3)]
+    assert kicker.PrewarmAt == now + 6000 - usersettings.PREWARM_SECONDS*1000
+    assert CountingHeap.reads <= 2*3 + 1
+
+
+def test_high_water_saves_are_coalesced(kicker, monkeypatch):
+    fired = []
+    monkeypatch.setattr(kicker, 'DispatchKick', lambda SCENE_ID, due, attempt=0, prio=0: fired.append(due))
+    saves = []
+    write = kicker.WriteAtomic
+    def Count(fname, records):
+        if fname == kicker.HwmFileName:
+            saves.append(records[0])
+        write(fname, records)
+    monkeypatch.setattr(kicker, 'WriteAtomic', Count)
+    T = (kicker.LocalMs()//1000 + 30)*1000
+    kicker.SCENEDIC['scene'] = 'id'
+    for j in range(60):
+        h, m, sec, msec = At(kicker, T + j*1000)
+        kicker.DataBase.append((f's{j}', (0,1,2,3,4,5,6), h, m, sec, 0, 0, 0, 'scene', True, 0))
+    kicker.HighWater = kicker.LocalMs()
+    kicker.SaveHighWater()
+    kicker.DayChanged(kicker.LocalMs()//86400000)
+    saves.clear()
+    for j in range(60):
+        kicker.checkScheduleAndKick(T + j*1000)
+    assert len(fired) == 60
+    assert saves == []
+    assert kicker.HwmDirty
+    # The worker's clock save writes it once
+    kicker.SaveHighWater()
+    assert saves == [T + 59000]
+    kicker.SetupHighWater()
+    assert kicker.HighWater == T + 59000
@@ -0,0 +1,102 @@
+#
+#  Config store: journal, snapshot and the StoreStamp they carry across a reboot
+#
+import importlib
+import json
+import os
+
+
+def Schedule(i):
+    return [f's{i}', [0, 1, 2, 3, 4, 5, 6], 7, i % 60, 0, 0, 0, 0, 'scene', True, 0]
+
+
+def Reboot(kicker):
+    main = importlib.reload(kicker)
+    main.loginit()
+    main.print = lambda *a, **k: None
+    main.SetupSceneDic()
+    main.SetupDataBase()
+    main.SetupSkipDates()
+    main.SetupStoreStamp()
+    return main
+
+
+def test_edit_stamp_is_journaled_without_a_file_of_its_own(kicker):
+    kicker.DataBase[:] = [Schedule(i) for i in range(3)]
+    kicker.SaveDataBase()
+    files = set(os.listdir())
+    kicker.DataBase[1] = Schedule(10)
+    kicker.PutSchedule(1)
+    stamp = kicker.StoreStamp
+    assert set(os.listdir()) == files | {kicker.CnfFileName + '.jnl'}
+    main = Reboot(kicker)
+    assert main.StoreStamp == stamp
+    assert main.DataBase[1][0] == 's10'
+
+
+def test_compaction_keeps_the_stamp(kicker):
+    kicker.DataBase[:] = [Schedule(0)]
+    kicker.SaveDataBase()
+    for i in range(kicker.JOURNAL_MAX):
+        kicker.DataBase[0] = Schedule(i)
+        kicker.PutSchedule(0)
+    stamp = kicker.StoreStamp
+    assert not os.path.exists(kicker.CnfFileName + '.jnl')
+    with open(kicker.CnfFileName) as file:
+        assert json.loads(file.readline())[1] == stamp
+    assert Reboot(kicker).StoreStamp == stamp
+
+
+def test_copied_store_keeps_the_peer_stamp(kicker):
+    kicker.SkipDates[:] = [(0, 12, 31)]
+    kicker.SaveSkipDates(12345)
+    kicker.SCENEDIC['scene'] = 'id'
+    kicker.SaveSceneDic(12345)
+    main = Reboot(kicker)
+    assert main.StoreStamp == 12345
+    assert main.SkipDates == [(0, 12, 31)]
+
+
+
+def test_eval_format_files_are_migrated(kicker):
+    with open('SwBotKicker.cnf', 'w') as file:
+        file.write(repr([tuple(Schedule(0)), tuple(Schedule(1))]))
+    with open('SwBotKicker.dic', 'w') as file:
+        file.write(repr({'scene': 'id'}))
+    main = Reboot(kicker)
+    assert [S[0] for S in main.DataBase] == ['s0', 's1']
+    assert main.SCENEDIC == {'scene': 'id'}
+    assert os.path.exists('SwBotKicker.cnf.bak') and not os.path.exists('SwBotKicker.cnf')
+    with open(main.CnfFileName) as file:
+        assert json.loads(file.readline()) == [1, 0]
+
+
+def test_journal_replays_into_the_table(kicker):
+    kicker.DataBase[:] = [Schedule(i) for i in range(5)]
+    kicker.SaveDataBase()
+    kicker.DataBase[2] = Schedule(20)
+    kicker.PutSchedule(2)
+    kicker.DeleteSchedule(0)
+    kicker.DataBase.append(Schedule(50))
+    kicker.PutSchedule(len(kicker.DataBase)-1)
+    main = Reboot(kicker)
+    assert [S[0] for S in main.DataBase] == ['s1', 's20', 's3', 's4', 's50']
+
+
+def test_load_does_not_hold_the_records_twice(kicker):
+    import gc
+    import tracemalloc
+    kicker.DataBase[:] = [Schedule(i) for i in range(1000)]
+    kicker.SaveDataBase()
+    kicker.DataBase.clear()
+    tracemalloc.start()
+    try:
+        gc.collect()
+        base = tracemalloc.get_traced_memory()[0]
+        kicker.SetupDataBase()
+        size, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert len(kicker.DataBase) == 1000
+    # The table itself plus a line at a time; a list of the records first was several times the table
+    assert peak - base < 2*(size - base)
@@ -3,20 +3,93 @@ NET_SSID = '<<YOUR_WIFI_SSID>>'
 NET_PASS = '<<YOUR_WIFI_PASSWORD>>'
 
 SB_API_TOKEN = '<<YOUR_SWITCHBOT_API_TOKEN>>'
+# Further SwitchBot accounts {'name': 'token', ...}, each with its own connections and quota.
+# Their scenes are registered as 'name:sceneId'. Every account adds about KICK_PARALLEL TLS connections of RAM.
+SB_ACCOUNTS = {}
 
 NTP_HOST = 'pool.ntp.org'
+NTP_PORT = 123
+NTP_SAMPLES = 4
+# Clock error (ms) tolerated between NTP syncs; the sync interval adapts to the measured drift
+NTP_ERROR_MS = 200
 UTC_OFFSET = 9*3600
 
 HOSTNAME = 'swbotkicker'
 
+# Seconds before each scheduled kick to open and verify the API connection
+PREWARM_SECONDS = 5
+# Wake exactly at each schedule's millisecond (False: poll during the last second)
+SCHED_PRECISE = True
+# Fire early by each scene's measured API response time
+KICK_EARLY = False
+# Percent of that response time before the scene runs: the request's way to the server
+KICK_EARLY_SHARE = 50
+# Maximum number of scenes executed at the same time
+KICK_PARALLEL = 3
+# Kicks missed by a stalled loop, a clock step or a reboot still run if at most this many seconds late
+CATCHUP_GRACE_SECONDS = 300
+# Seconds between saves of the last evaluated time. After a fire it is saved with the clock,
+# every CLOCK_SAVE_SECONDS; a reboot before that may repeat those kicks.
+HWM_SAVE_SECONDS = 600
+# Active/standby kickers: enable on every kicker of the LAN, each with its own HOSTNAME.
+# The live kicker with the highest PEER_PRIORITY (then HOSTNAME) fires; the others stand by.
+PEER_ENABLE = False
+PEER_PRIORITY = 0
+PEER_GROUP = '239.255.77.77'
+PEER_PORT = 5354
+# Heartbeat interval, and the silence after which a kicker is taken for gone (ms)
+PEER_HEARTBEAT_MS = 200
+PEER_TIMEOUT_MS = 700
+# Before NTP answers, kicks fire on the RTC if it ran through the reset and its error bound
+# (CLOCK_DRIFT_PPM since the last NTP sync) is within CLOCK_BOUND_MS. The time is saved every CLOCK_SAVE_SECONDS.
+CLOCK_DRIFT_PPM = 30
+CLOCK_BOUND_MS = 5000
+CLOCK_SAVE_SECONDS = 300
+# Seconds to wait for a SwitchBot API connection or response
+API_TIMEOUT = 10
+# Failed kicks are retried with exponential backoff from RETRY_BASE_MS (plus jitter),
+# at most RETRY_ATTEMPTS times and never later than RETRY_GIVEUP_SECONDS after the schedule
+RETRY_BASE_MS = 1000
+RETRY_ATTEMPTS = 4
+RETRY_GIVEUP_SECONDS = 60
+RETRY_QUEUE_MAX = 16
+# SwitchBot API requests allowed per day (UTC); the last API_RESERVE of them are kept for scheduled kicks
+API_DAILY_LIMIT = 10000
+API_RESERVE = 500
+# Token bucket for API requests: API_RATE per second on average, bursts of up to API_BURST
+API_RATE = 1
+API_BURST = 10
+# Tokens of that burst only scheduled kicks may take, so test kicks and scene list reads never delay them
+API_BURST_RESERVE = 3
+# Seconds the scene list fetched from SwitchBot is cached on flash
+SCENE_CACHE_TTL = 24*3600
+# Largest request body accepted by the /api JSON endpoints (bytes)
+API_BODY_MAX = 32*1024
+
+# Number of log lines kept in RAM and shown on the index page
+LOG_LINES = 16
+# Also keep the log on flash, written in batches to rotated segment files
+LOG_FLASH = False
+LOG_FLASH_BATCH = 16
+LOG_FLASH_SECONDS = 300
+# Errors are written sooner, but at most once per this many seconds
+LOG_FLASH_ERROR_SECONDS = 10
+LOG_FLASH_SEGMENT = 16*1024
+LOG_FLASH_SEGMENTS = 4
+
 # PLEASE CHANGE TO YOUR LANGUAGE
 DESC_TEXT_SCHEDULESETTING = '実行する時刻とシーンを設定してください'
 DESC_TEXT_REGISTSCENES    = '登録するシーンを選択してください'
 DESC_TEXT_NOSCHEDULE      = '--- スケジュールが設定されていません ---'
 
 DESC_TEXT_SELECTDELSCENES = '登録削除するシーンを選択してください'
+DESC_TEXT_MISSINGSCENES   = 'SwitchBotに存在しないシーン'
+DESC_TEXT_QUOTA           = 'API残り回数'
+DESC_TEXT_LEADER          = '稼働中'
+DESC_TEXT_STANDBY         = '待機中'
 
 DESC_TEXT_EVERYDAY = '毎　日'
+DESC_TEXT_EVERYDAY_SKIP = '毎日(除外日以外)'
 DESC_TEXT_MONDAY   = '月曜日'
 DESC_TEXT_TUESDAY  = '火曜日'
 DESC_TEXT_WEDNESDAY= '水曜日'
@@ -26,10 +99,12 @@ DESC_TEXT_SATURDAY = '土曜日'
 DESC_TEXT_SUNDAY   = '日曜日'
 DESC_TEXT_MON2THU  = '月～木'
 DESC_TEXT_WEEKDAYS = '月～金'
+DESC_TEXT_WEEKDAYS_SKIP = '月～金(除外日以外)'
 DESC_TEXT_FRI2SUN  = '金土日'
 DESC_TEXT_WEEKEND  = '土・日'
 DESC_TEXT_MONWEFRI = '月水金'
 DESC_TEXT_TUETHSAT = '火木土'
+DESC_TEXT_SKIP     = '(除外日以外)'
 
 DESC_BUTTON_REGIST = '登録'
 DESC_BUTTON_APPEND = '追加'